@@ -25,7 +25,8 @@ def play(botSocket, srvConf):
     while True:
         try:
             # Get information to determine if bot is alive (health > 0) and if a new game has started.
-            getInfoReply = botSocket.sendRecvMessage({'type': 'getInfoRequest'})
+            # endTurn tells a -lockstep server this robot is done with the last step.
+            getInfoReply = botSocket.sendRecvMessage({'type': 'getInfoRequest', 'endTurn': True})
         except nbipc.NetBotSocketException as e:
             # We are always allowed to make getInfoRequests, even if our health == 0. Something serious has gone wrong.
             log(str(e), "FAILURE")
@@ -137,7 +138,9 @@ def main():
 
     try:
         botSocket = nbipc.NetBotSocket(args.myIP, args.myPort, args.serverIP, args.serverPort)
-        joinReply = botSocket.sendRecvMessage({'type': 'joinRequest', 'name': robotName}, retries=300, delay=1, delayMultiplier=1)
+        # codec asks the server to use smaller compact messages (see netbots_ipc.CompactCodec).
+        joinReply = botSocket.sendRecvMessage({'type': 'joinRequest', 'name': robotName, 'codec': 'compact'},
+                                              retries=300, delay=1, delayMultiplier=1)
     except nbipc.NetBotSocketException as e:
         log("Is netbot server running at" + args.serverIP + ":" + str(args.serverPort) + "?")
         log(str(e), "FAILURE")
@@ -100,21 +100,29 @@ class Follower(Robot):
         log(name + ": Running!")
 
         self.stop = False  # when this becomes True the run method must return.
+        getLocationReply = None
         while not self.stop:
             try:
+                if getLocationReply is None:
+                    getLocationReply = botSocket.sendRecvMessage({'type': 'getLocationRequest'})
+
                 # Store my location in mydata so friend can see it.
-                getLocationReply = botSocket.sendRecvMessage({'type': 'getLocationRequest'})
                 mydata.x = getLocationReply['x']
                 mydata.y = getLocationReply['y']
 
                 # Compute distance to friend and set speed based on distance (slower as we get closer).
                 distanceToFriend = nbmath.distance(mydata.x, mydata.y, friendsData.x, friendsData.y)
-                botSocket.sendRecvMessage({'type': 'setSpeedRequest',
-                                           'requestedSpeed': min(100, distanceToFriend / 1000 * 100)})
 
                 # Compute angle to friend and go in that direction.
                 angleToFriend = nbmath.angle(mydata.x, mydata.y, friendsData.x, friendsData.y)
-                botSocket.sendRecvMessage({'type': 'setDirectionRequest', 'requestedDirection': angleToFriend})
+
+                # Send speed and direction, and get our new location for next time, in one message.
+                replies = botSocket.sendRecvBatch([
+                    {'type': 'setSpeedRequest', 'requestedSpeed': min(100, distanceToFriend / 1000 * 100)},
+                    {'type': 'setDirectionRequest', 'requestedDirection': angleToFriend},
+                    {'type': 'getLocationRequest'}
+                    ])
+                getLocationReply = replies[2] if replies[2]['type'] == 'getLocationReply' else None
 
                 log(f"{name}: Distance to friend == {distanceToFriend:>4.2f}, Angle to friend == {angleToFriend:>4.2f},", "INFO")
 
@@ -28,9 +28,10 @@ stepmax = 5000  # Max steps in each game
 # Do not change the following without considering the code below that uses these values
 botsMax = 64 # Max bots in div tournament
 botsInDivision = 4  # This cannot be changed without significant changes to the code below.
+unixDir = None  # Directory of Unix domain sockets used instead of UDP ports (see -unix).
 
 def rundivision(bots, divisionName, divisionDir, robotsDir, botkeys, serverPort):
-    global games, stepmax, stepsec
+    global games, stepmax, stepsec, unixDir
 
     pythoncmd = ['python3']
     srvoptions = [
@@ -46,6 +47,9 @@ def rundivision(bots, divisionName, divisionDir, robotsDir, botkeys, serverPort)
         '-onlylastsb',
         '-jsonsb'
         ]
+    # with -unix, servers and robots use Unix domain sockets in unixDir instead of UDP ports.
+    if unixDir:
+        srvoptions[1:1] = ['-ip', unixDir]
 
     fd = []
 
@@ -64,6 +68,8 @@ def rundivision(bots, divisionName, divisionDir, robotsDir, botkeys, serverPort)
         f = open(os.path.join(divisionDir, bot['file'] + ".output.txt"), "w")
         fd.append(f)
         cmdline = pythoncmd + [os.path.join(robotsDir, bot['file']), '-p', str(bot['port']),'-sp', str(serverPort)]
+        if unixDir:
+            cmdline += ['-ip', unixDir, '-sip', unixDir]
         log(str(divisionName) + ": " + str(cmdline), "VERBOSE")
         p = subprocess.Popen(cmdline, stdout=f, stderr=subprocess.STDOUT)
         botProcs.append(p)
@@ -134,7 +140,7 @@ def quit(signal=None, frame=None):
 
 
 def main():
-    global bots, botsMax, botsInDivision, serverMax
+    global bots, botsMax, botsInDivision, serverMax, unixDir
 
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-robots', metavar='dir', dest='robotsDir', type=str,
@@ -142,6 +148,7 @@ def main():
     parser.add_argument('-output', metavar='dir', dest='outputDir', type=str,
                         required=True, help='Full directory path to send output. Directory should exist and be empty. (eg. /tmp/tournament.2020-50-02-11:37:23)')
     parser.add_argument('-copy', dest='copy', action='store_true', default=False, help='Copy robots dir to output dir.')
+    parser.add_argument('-unix', dest='unix', action='store_true', default=False, help='Servers and robots talk over Unix domain sockets in <output>/sockets instead of UDP ports. Not available on Windows.')
     parser.add_argument('-md5sum', dest='md5sum', action='store_true', default=False, help='Print MD5sum for each robot.')
     parser.add_argument('-debug', dest='debug', action='store_true', default=False, help='Print DEBUG level log messages.')
     parser.add_argument('-verbose', dest='verbose', action='store_true', default=False, help='Print VERBOSE level log messages. Note, -debug includes -verbose.')
@@ -159,6 +166,8 @@ def main():
     
     setLogFile(os.path.join(outputDir,"output.txt"))
     resultsfilename = os.path.join(outputDir,"results.txt")
+    if args.unix:
+        unixDir = os.path.join(os.path.abspath(outputDir), "sockets")
 
     # pick random ports for robots. These port numbers will be assigned to a robot for the entire tournament.
     ports = random.sample(range(20100,20199), botsMax)
@@ -173,7 +182,7 @@ def main():
                 log("Only " + botsMax + " robots can be in robots dir.","FAILURE")
                 quit()
             log("Adding bot " + file + " at port " + str(port))
-            bots['127.0.0.1:' + str(port)] = {'port': port, 'file': file}
+            bots[(unixDir or '127.0.0.1') + ':' + str(port)] = {'port': port, 'file': file}
         if args.md5sum:
             p = subprocess.Popen(["md5sum",os.path.join(robotsDir, file)], stdout=subprocess.PIPE, stderr=sys.stdout.buffer)
             log("md5sum " + p.stdout.read().decode("utf-8").rstrip())
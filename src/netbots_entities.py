@@ -0,0 +1,133 @@
+"""
+Records the server uses for bots, shells and explosions.
+
+These use __slots__ so they are smaller and faster to read and write than dicts.
+Fields have the same names as the dicts sent to viewers and saved by -jsonsb, except
+'class' which is a python keyword so it is stored as botClass. Use toDict() (or the
+*ToDicts() functions for a whole dict of records) to get the dict form.
+"""
+
+
+class Bot:
+    __slots__ = ('name', 'botClass', 'health', 'x', 'y', 'currentSpeed', 'requestedSpeed',
+                 'currentDirection', 'requestedDirection', 'points', 'firedCount', 'shellDamage',
+                 'missedSteps', 'winHealth', 'winCount',
+                 # Copies of last fire and scan requests. This data is not stored elsewhere
+                 # and is useful for viewer to display.
+                 'lastFireDirection', 'lastFireDistance', 'lastScanStart', 'lastScanEnd',
+                 # Server only fields that are not included in toDict().
+                 'hitSeverity', 'classValues')
+
+    def __init__(self, name="template", botClass="default", currentSpeed=0, currentDirection=0):
+        self.name = name
+        self.botClass = botClass
+        self.health = 0
+        self.x = 500
+        self.y = 500
+        self.currentSpeed = currentSpeed
+        self.requestedSpeed = 0
+        self.currentDirection = currentDirection
+        self.requestedDirection = 0
+        self.points = 0
+        self.firedCount = 0
+        self.shellDamage = 0
+        self.missedSteps = 0
+        self.winHealth = 0
+        self.winCount = 0
+        self.lastFireDirection = 0
+        self.lastFireDistance = 10
+        self.lastScanStart = 0
+        self.lastScanEnd = 0
+        self.hitSeverity = 0.0  # hitSeverity == 0 means robot did not hit anything this step.
+        self.classValues = None  # netbots_server.ClassValues of botClass
+
+    def toDict(self):
+        return {
+            'name': self.name,
+            'class': self.botClass,
+            'health': self.health,
+            'x': self.x,
+            'y': self.y,
+            'currentSpeed': self.currentSpeed,
+            'requestedSpeed': self.requestedSpeed,
+            'currentDirection': self.currentDirection,
+            'requestedDirection': self.requestedDirection,
+            'points': self.points,
+            'firedCount': self.firedCount,
+            'shellDamage': self.shellDamage,
+            'missedSteps': self.missedSteps,
+            'winHealth': self.winHealth,
+            'winCount': self.winCount,
+            'last': {
+                'fireCanonRequest': {'direction': self.lastFireDirection, 'distance': self.lastFireDistance},
+                'scanRequest': {'startRadians': self.lastScanStart, 'endRadians': self.lastScanEnd},
+                }
+            }
+
+
+class Shell:
+    __slots__ = ('x', 'y', 'direction', 'distanceRemaining')
+
+    def __init__(self, x=500, y=500, direction=0, distanceRemaining=100):
+        self.x = x
+        self.y = y
+        self.direction = direction
+        self.distanceRemaining = distanceRemaining
+
+    def toDict(self):
+        return {
+            'x': self.x,
+            'y': self.y,
+            'direction': self.direction,
+            'distanceRemaining': self.distanceRemaining
+            }
+
+    def __eq__(self, other):
+        return isinstance(other, Shell) and self.x == other.x and self.y == other.y and \
+            self.direction == other.direction and self.distanceRemaining == other.distanceRemaining
+
+
+class Explosion:
+    __slots__ = ('x', 'y', 'stepsAgo', 'src')
+
+    def __init__(self, x=500, y=500, src=""):
+        self.x = x
+        self.y = y
+        self.stepsAgo = 0
+        self.src = src  # this is needed by viewer to color this explosion
+
+    def toDict(self):
+        return {
+            'x': self.x,
+            'y': self.y,
+            'stepsAgo': self.stepsAgo,
+            'src': self.src
+            }
+
+    def __eq__(self, other):
+        return isinstance(other, Explosion) and self.x == other.x and self.y == other.y and \
+            self.stepsAgo == other.stepsAgo and self.src == other.src
+
+
+class Location:
+    """ A point in the arena, such as a bot start location. """
+    __slots__ = ('x', 'y')
+
+    def __init__(self, x=500, y=500):
+        self.x = x
+        self.y = y
+
+
+def botsToDicts(bots):
+    """ Convert {key: Bot, ...} to {key: dict, ...} """
+    return {k: bot.toDict() for k, bot in bots.items()}
+
+
+def shellsToDicts(shells):
+    """ Convert {key: Shell, ...} to {key: dict, ...} """
+    return {k: shell.toDict() for k, shell in shells.items()}
+
+
+def explosionsToDicts(explosions):
+    """ Convert {key: Explosion, ...} to {key: dict, ...} """
+    return {k: expl.toDict() for k, expl in explosions.items()}
@@ -1,18 +1,28 @@
 import socket
 import random
+import atexit
+import errno
 import time
 import re
 import math
 import argparse
+import struct
+import os
+import queue
+import select
+import threading
 
 from netbots_log import log
+from netbots_log import isEnabled
+import netbots_shm as nbshm
 
 try:
     import msgpack as umsgpack
     log("Using binary python msgpack.")
 except:
-    import umsgpack
-    log("Using pure python msgpack. Install binary msgpack for better performance.", "WARNING")
+    # netbots_pack is much faster than the general purpose umsgpack but only packs NetBots msgs.
+    import netbots_pack as umsgpack
+    log("Using pure python msgpack (netbots_pack). Install binary msgpack for better performance.", "WARNING")
 
 """
 **About Messages**
@@ -41,8 +51,9 @@ server and the server returns the reply message or an Error message.
 """
 MsgDef = {
     # msg type              other required msg fields
-    'joinRequest': {'name': ['str', 1, 16], 'class_o': ['str', 1, 16]},
-    'joinReply': {'conf': 'dict'},
+    'joinRequest': {'name': ['str', 1, 16], 'class_o': ['str', 1, 16], 'arena_o': ['int', 1, 1000], 'codec_o': ['str', 1, 16],
+                    'shm_o': 'bool'},
+    'joinReply': {'conf': 'dict', 'codec_o': ['str', 1, 16], 'shm_o': 'dict'},
 
     'getInfoRequest': {},
     'getInfoReply': {'gameNumber': 'int', 'gameStep': 'int', 'health': ['(int,float)', 0, 100], 'points': 'int'},
@@ -71,21 +82,268 @@ MsgDef = {
     'scanRequest': {'startRadians': ['(int,float)', 0, math.pi * 2], 'endRadians': ['(int,float)', 0, math.pi * 2]},
     'scanReply': {'distance': ['(int,float)', 0, 32767]},
 
-    'addViewerRequest': {},
+    'batchRequest': {'requests': 'list'},
+    'batchReply': {'replies': 'list'},
+
+    'subscribeRequest': {'everySteps_o': ['int', 0, 1000]},
+    'subscribeReply': {},
+
+    'addViewerRequest': {'arena_o': ['int', 1, 1000]},
     'addViewerReply': {'conf': 'dict'},
 
     # The msg types below do not have, nor expect, a matching reply
+    'botState': {'gameNumber': 'int', 'gameStep': 'int', 'health': ['(int,float)', 0, 100], 'points': 'int',
+                 'x': ['(int,float)', 0, 32767], 'y': ['(int,float)', 0, 32767],
+                 'requestedSpeed': ['(int,float)', 0, 100], 'currentSpeed': ['(int,float)', 0, 100],
+                 'requestedDirection': ['(int,float)', 0, math.pi * 2], 'currentDirection': ['(int,float)', 0, math.pi * 2],
+                 'shellInProgress': 'bool'},
     'viewData': {'state': 'dict', 'bots': 'dict', 'shells': 'dict', 'explosions': 'dict'},
     'viewKeepAlive': {},
     'Error': {'result': 'str'}
 }
 
 
+# Names that can be used as field types in MsgDef.
+MsgFieldTypes = {'int': int, 'float': float, 'str': str, 'bool': bool, 'dict': dict, 'list': list}
+
+# Fields that are allowed in every message. msgID and replyData are always optional and have
+# no specific format. endTurn marks the last request a robot will send this step (server -lockstep).
+MsgCommonFields = ('type', 'msgID', 'replyData', 'endTurn')
+
+
+def compileMsgSpec(msgtype, msgspec):
+    """
+    Return a function that validates (returns True or False) a msg of msgtype against msgspec
+    from MsgDef. Type names, optional markers and ranges are worked out here, once, so the
+    returned function only has to check the msg.
+    """
+    fields = []  # [(fld, optional, types, typeName, isStr, min, max), ...]
+    for fld, fldspec in msgspec.items():
+        optional = fld.endswith('_o')
+        if optional:
+            # remove magic suffix marking field as optional
+            fld = fld[:-2]
+        if isinstance(fldspec, list):
+            typeName, lo, hi = fldspec
+        else:
+            typeName, lo, hi = fldspec, None, None
+        types = tuple(MsgFieldTypes[t] for t in typeName.strip('()').split(','))
+        fields.append((fld, optional, types, typeName, typeName == 'str', lo, hi))
+    allowed = frozenset([f[0] for f in fields] + list(MsgCommonFields))
+
+    def validate(msg):
+        for fld, optional, types, typeName, isStr, lo, hi in fields:
+            if fld not in msg:
+                if optional:
+                    # optional field is not present, which is valid.
+                    continue
+                log("Msg does not contain required '" + fld + "' key: " + str(msg), "ERROR")
+                return False
+            value = msg[fld]
+            if not isinstance(value, types):
+                log("Msg '" + fld + "' key has value of type " + str(type(value)) +
+                    " but expected " + typeName + ": " + str(msg), "ERROR")
+                return False
+            if lo is None:
+                continue
+            if isStr:
+                if len(value) < lo or len(value) > hi:
+                    log("Msg '" + fld + "' key has a string value " + str(value) +
+                        " with length out of range [" + str(lo) + "," +
+                        str(hi) + "] : " + str(msg), "ERROR")
+                    return False
+            elif value < lo or value > hi:
+                log("Msg '" + fld + "' key has a value " + str(value) +
+                    " which is out of range [" + str(lo) + "," +
+                    str(hi) + "] : " + str(msg), "ERROR")
+                return False
+
+        # All fields defined for message type have now been examined and are valid
+        if not allowed.issuperset(msg):
+            # message has fields it should not have.
+            unvalidedFields = [fld for fld in msg if fld not in allowed]
+            log("Msg contains field(s) " + str(unvalidedFields) + " which is not defined for message type " + msgtype + ": " + str(msg), "ERROR")
+            for fld in unvalidedFields:
+                if fld.endswith('_o'):
+                    log("Optional message fields should not include '_o' suffix in field name.", "WARNING")
+                    break
+            return False
+
+        # message is valid and has no extra fields.
+        return True
+
+    return validate
+
+
+def compileMsgDef(msgDef):
+    """ Return {msgtype: validate function, ...} for every msg type in msgDef. """
+    return {msgtype: compileMsgSpec(msgtype, msgspec) for msgtype, msgspec in msgDef.items()}
+
+
+# MsgDef compiled by compileMsgDef(). If MsgDef is changed then MsgValidators must be compiled again.
+MsgValidators = compileMsgDef(MsgDef)
+
+
+class CompactCodec:
+    """
+    Compact binary format for msgs that only have int, float, bool, and str fields. A compact msg is
+    struct packed (little endian) as:
+
+        CompactMarker, type code, flags, [msgID], fields...
+
+    type code is the position of the msg type in MsgDef (of the types that can be packed) so both
+    ends must use the same MsgDef. flags bit 0 means msgID is present, bit 1 means endTurn is
+    present and bit 2 is its value. Bits 3 to 7 mark which optional fields are present. Fields
+    follow in MsgDef order: int as 'i', float and (int,float) as 'd', bool as '?' and str as
+    'H' length followed by utf-8 bytes. Note, ints in (int,float) fields are unpacked as floats.
+    """
+
+    # 0xC1 is never used by msgpack so compact msgs can be told apart from msgpack msgs.
+    CompactMarker = 0xC1
+    FieldFormats = {'int': 'i', 'float': 'd', '(int,float)': 'd', 'bool': '?', 'str': 's'}
+
+    def __init__(self, msgDef):
+        self.byType = {}  # {msgtype: (code, fields), ...} fields is [(fld, optional, format), ...]
+        self.byCode = {}  # {code: (msgtype, fields), ...}
+        # {msgtype or code: (names, Struct without msgID, Struct with msgID), ...} for msg types that
+        # have no str or optional fields so they always have the same layout and can be packed in one call.
+        self.fixed = {}
+        for msgtype, msgspec in msgDef.items():
+            fields = []
+            for fld, fldspec in msgspec.items():
+                optional = fld.endswith('_o')
+                if optional:
+                    fld = fld[:-2]
+                typeName = fldspec[0] if isinstance(fldspec, list) else fldspec
+                if typeName not in self.FieldFormats:
+                    # dicts (and anything else without a fixed layout) are always sent as msgpack.
+                    fields = None
+                    break
+                fields.append((fld, optional, self.FieldFormats[typeName]))
+            if fields is not None and sum(1 for f in fields if f[1]) <= 5:
+                code = len(self.byCode)
+                self.byType[msgtype] = (code, fields)
+                self.byCode[code] = (msgtype, fields)
+                if all(not optional and f != 's' for fld, optional, f in fields):
+                    fmt = ''.join(f for fld, optional, f in fields)
+                    names = [fld for fld, optional, f in fields]
+                    self.fixed[msgtype] = (code, names, struct.Struct('<BBB' + fmt), struct.Struct('<BBBH' + fmt))
+                    self.fixed[code] = self.fixed[msgtype]
+
+    def pack(self, msg):
+        """ Return msg as compact bytes or None if msg can't be packed in compact format. """
+        if 'replyData' in msg:
+            return None
+
+        fixed = self.fixed.get(msg['type'])
+        if fixed:
+            code, names, noID, withID = fixed
+            flags = 0
+            if 'endTurn' in msg:
+                flags = 6 if msg['endTurn'] else 2
+            try:
+                if 'msgID' in msg:
+                    return withID.pack(self.CompactMarker, code, flags | 1, msg['msgID'], *[msg[n] for n in names])
+                return noID.pack(self.CompactMarker, code, flags, *[msg[n] for n in names])
+            except struct.error:
+                return None
+
+        if msg['type'] not in self.byType:
+            return None
+        code, fields = self.byType[msg['type']]
+
+        fmt = '<BBB'
+        values = [self.CompactMarker, code, 0]
+        flags = 0
+        if 'msgID' in msg:
+            flags |= 1
+            fmt += 'H'
+            values.append(msg['msgID'])
+        if 'endTurn' in msg:
+            flags |= 6 if msg['endTurn'] else 2
+
+        bit = 8
+        for fld, optional, f in fields:
+            if optional:
+                if fld not in msg:
+                    bit <<= 1
+                    continue
+                flags |= bit
+                bit <<= 1
+            if f == 's':
+                b = msg[fld].encode()
+                fmt += 'H' + str(len(b)) + 's'
+                values.append(len(b))
+                values.append(b)
+            else:
+                fmt += f
+                values.append(msg[fld])
+        values[2] = flags
+
+        try:
+            return struct.pack(fmt, *values)
+        except struct.error:
+            # a value does not fit its compact format (eg. int > 2**31 or msgID > 65535).
+            return None
+
+    def unpack(self, b):
+        """ Return msg from compact bytes b. Raises an exception if b is not a valid compact msg. """
+        msgtype, fields = self.byCode[b[1]]
+        flags = b[2]
+
+        fixed = self.fixed.get(b[1])
+        if fixed:
+            code, names, noID, withID = fixed
+            if flags & 1:
+                values = withID.unpack(b)
+                msg = dict(zip(names, values[4:]))
+                msg['msgID'] = values[3]
+            else:
+                msg = dict(zip(names, noID.unpack(b)[3:]))
+            msg['type'] = msgtype
+            if flags & 2:
+                msg['endTurn'] = bool(flags & 4)
+            return msg
+
+        msg = {'type': msgtype}
+        offset = 3
+        if flags & 1:
+            msg['msgID'] = struct.unpack_from('<H', b, offset)[0]
+            offset += 2
+        if flags & 2:
+            msg['endTurn'] = bool(flags & 4)
+
+        bit = 8
+        for fld, optional, f in fields:
+            if optional:
+                present = flags & bit
+                bit <<= 1
+                if not present:
+                    continue
+            if f == 's':
+                n = struct.unpack_from('<H', b, offset)[0]
+                offset += 2
+                msg[fld] = bytes(b[offset:offset + n]).decode()
+                offset += n
+            else:
+                msg[fld] = struct.unpack_from('<' + f, b, offset)[0]
+                offset += struct.calcsize(f)
+
+        if offset != len(b):
+            raise ValueError("Compact msg is " + str(len(b)) + " bytes but expected " + str(offset) + " bytes.")
+        return msg
+
+
+compactCodec = CompactCodec(MsgDef)
+
+# Codecs a robot can ask for in joinRequest 'codec'. If the server agrees it returns the codec in
+# joinReply and both ends send with that codec from then on. Msgs in any codec are always accepted.
+Codecs = ('msgpack', 'compact')
+
+
 def isValidMsg(msg):
     """ Returns True if msg is a valid message, otherwise returns false. """
 
-    global MsgDef
-
     if not isinstance(msg, dict):
         log("Msg is type " + str(type(msg)) + " but must be dict type: " + str(msg), "ERROR")
         return False
@@ -93,70 +351,26 @@ def isValidMsg(msg):
         log("Msg does not contain 'type' key: " + str(msg), "ERROR")
         return False
 
-    unvalidedFields = list(msg.keys())
-    # type is validated below as part of loop so does not need specific validation.
-    unvalidedFields.remove('type')
-    # msgId and replyData are always optional and have no specific format. So they are always valid if present.
-    if 'msgID' in unvalidedFields:
-        unvalidedFields.remove('msgID')
-    if 'replyData' in unvalidedFields:
-        unvalidedFields.remove('replyData')
-
-    for msgtype, msgspec in MsgDef.items():
-        if msgtype == msg['type']:
-            for fld, fldspec in msgspec.items():
-                if fld.endswith('_o'):
-                    # remove magic suffix marking field as optional
-                    fld = fld.rstrip('_o')
-                    if fld not in msg:
-                        # optional field is not present, which is valid.
-                        continue
-                elif fld not in msg:
-                    log("Msg does not contain required '" + fld + "' key: " + str(msg), "ERROR")
-                    return False
-                if isinstance(fldspec, list):
-                    if not isinstance(msg[fld], eval(fldspec[0])):
-                        log("Msg '" + fld + "' key has value of type " + str(type(msg[fld])) +
-                            " but expected " + fldspec[0] + ": " + str(msg), "ERROR")
-                        return False
-                    if fldspec[0] is 'str':
-                        if len(msg[fld]) < fldspec[1] or len(msg[fld]) > fldspec[2]:
-                            log("Msg '" + fld + "' key has a string value " + str(msg[fld]) +
-                                " with length out of range [" + str(fldspec[1]) + "," +
-                                str(fldspec[2]) + "] : " + str(msg), "ERROR")
-                            return False
-                    elif msg[fld] < fldspec[1] or msg[fld] > fldspec[2]:
-                        log("Msg '" + fld + "' key has a value " + str(msg[fld]) +
-                            " which is out of range [" + str(fldspec[1]) + "," +
-                            str(fldspec[2]) + "] : " + str(msg), "ERROR")
-                        return False
-                else:
-                    if not isinstance(msg[fld], eval(fldspec)):
-                        log("Msg '" + fld + "' key has value of type " + str(type(msg[fld])) +
-                            " but expected " + fldspec + ": " + str(msg), "ERROR")
-                        return False
-                unvalidedFields.remove(fld)
-            # All fields defined for message type have now been examined and are valid
-            if len(unvalidedFields):
-                # message has fields it should not have.
-                log("Msg contains field(s) " + str(unvalidedFields) + " which is not defined for message type " + msg['type'] + ": " + str(msg), "ERROR")
-                for fld in unvalidedFields:
-                    if fld.endswith('_o'):
-                        log("Optional message fields should not include '_o' suffix in field name.", "WARNING")
-                        break
-                return False
-            else:
-                # message is valid and has no extra fields.
-                return True
-    log("Msg 'type' key has value '" + str(msg['type']) + "' which is not known: " + str(msg), "ERROR")
-    return False
+    if 'endTurn' in msg and not isinstance(msg['endTurn'], bool):
+        log("Msg 'endTurn' key has value of type " + str(type(msg['endTurn'])) + " but expected bool: " + str(msg), "ERROR")
+        return False
+
+    try:
+        validate = MsgValidators[msg['type']]
+    except (KeyError, TypeError):
+        log("Msg 'type' key has value '" + str(msg['type']) + "' which is not known: " + str(msg), "ERROR")
+        return False
+
+    return validate(msg)
 
 
 def isValidIP(ip):
-    """ Returns True if ip is valid IP address, otherwise returns false. """
+    """ Returns True if ip is valid IP address or Unix socket directory (see isUnixDir()), otherwise returns false. """
     if not isinstance(ip, str):
         log("IP is type " + str(type(ip)) + " but must be type str.", "ERROR")
         return False
+    if isUnixDir(ip):
+        return True
     if not re.match(r'^[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}$', ip):
         log("IP address has bad format, expected something like 'int.int.int.int' but got " + ip, "ERROR")
         return False
@@ -185,6 +399,41 @@ def isValidPort(p):
     return True
 
 
+def isUnixDir(ip):
+    """
+    Returns True if ip is a directory path (contains '/') instead of an IP address. NetBotSockets
+    with a directory as their IP use Unix domain datagram sockets in that directory instead of UDP.
+    """
+    return '/' in ip
+
+
+def unixPath(ip, port):
+    """ Returns path of the Unix domain socket for port in directory ip. eg. /tmp/netbots/20000.sock """
+    return os.path.join(ip, str(port) + ".sock")
+
+
+def removeStaleUnixSocket(path):
+    """ Remove the Unix domain socket at path if no process is bound to it (eg. it was left by a crash). """
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(family=socket.AF_UNIX, type=socket.SOCK_DGRAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+    except OSError:
+        pass
+    finally:
+        probe.close()
+
+
+def removeUnixSocket(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
 def formatIpPort(ip, port):
     """ Formats ip and port into a single string. eg. 127.168.32.11:20012 """
     return str(ip) + ":" + str(port)
@@ -195,6 +444,47 @@ class NetBotSocketException(Exception):
     pass
 
 
+def toAddress(dest):
+    """ Return (ip, port) for dest, which may be 'ip:port' or (ip, port). """
+    if isinstance(dest, str):
+        ip, port = dest.rsplit(":", 1)
+        return (ip, int(port))
+    return (dest[0], dest[1])
+
+
+class Peer:
+    """
+    Msg counts and codec for one address a NetBotSocket sends to or receives from. NetBotSocket
+    keeps these in a dict keyed by the (ip, port) tuple from recvfrom() so counting a msg does
+    not need to build an 'ip:port' str.
+    """
+    __slots__ = ('ip', 'port', 'sockaddr', 'sent', 'recv', 'sendTypes', 'recvTypes', 'codec', 'shm',
+                 'tokens', 'tokenTime', 'throttled', '_name')
+
+    def __init__(self, ip, port, sockaddr=None):
+        self.ip = ip
+        self.port = port
+        self.sockaddr = sockaddr or (ip, port)  # address to send to: (ip, port) or path of Unix domain socket.
+        self.sent = 0  # Number of messages sent to OS socket
+        self.recv = 0  # Number of messages recv from OS socket
+        self.sendTypes = {}  # {msgType: count, ...}
+        self.recvTypes = {}  # {msgType: count, ...}
+        self.codec = None  # codec (see Codecs) used to send to this peer. None is msgpack.
+        self.shm = None  # netbots_shm.ShmChannel used instead of UDP to send to this peer, if any.
+        # Token bucket (see NetBotSocket.setRateLimit()). A new peer starts with a full bucket.
+        self.tokens = 0.0
+        self.tokenTime = -math.inf  # time.perf_counter() tokens was last updated.
+        self.throttled = 0  # Number of datagrams from this peer skipped by the rate limit.
+        self._name = None
+
+    @property
+    def name(self):
+        """ 'ip:port' of this peer. Built the first time it is needed. """
+        if self._name is None:
+            self._name = formatIpPort(self.ip, self.port)
+        return self._name
+
+
 class NetBotSocket:
     """NetBot Msg filtering and basic reliable send/recv for UDP soket. """
 
@@ -206,28 +496,37 @@ class NetBotSocket:
         sourcePort: port to listen on. This is an integer number.
         destinationIP and destinationPort are stored with setDestinationAddress()
 
+        If sourceIP is a directory path (see isUnixDir()) then a Unix domain datagram socket is bound
+        to sourcePort.sock in that directory instead (see unixPath()), so robots and servers on the
+        same computer do not use up UDP ports. Such a socket can only talk to others in the same way,
+        so destinationIP should be the same directory. Not available on Windows.
+
 
         Returns NetBotSocket object.
 
         Raises socket related exceptions.
         """
 
-        self.sent = {}  # Number of messages sent to OS socket
-        self.recv = {}  # Number of messages recv from OS socket
+        self.peers = {}  # {(ip, port): Peer, ...} msg counts and codec of each address sent to or recv from.
         self.sendRecvMessageCalls = 0  # Number of calls to sendRecvMessage
         self.sendRecvMessageResends = 0  # Number of resends made by sendRecvMessage
         self.sendRecvMessageTime = 0  # Total time in sendRecvMessage
-        self.sendTypes = {}
-        self.recvTypes = {}
+        self.botState = None  # last botState msg received (see subscribeRequest and getBotState())
 
         self.sendrecvDelay = 0.1
 
         self.sourceIP = sourceIP
         self.sourcePort = sourcePort
         log("Creating socket with sourceIP=" + sourceIP + ", sourcePort=" + str(sourcePort), "VERBOSE")
-        self.s = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.unix = isUnixDir(sourceIP)
+        self.unixAddresses = {}  # {path: (ip, port), ...} cache of Unix domain socket paths msgs came from.
+        self.s = socket.socket(family=socket.AF_UNIX if self.unix else socket.AF_INET, type=socket.SOCK_DGRAM)
         try:
-            self.s.bind((sourceIP, sourcePort))
+            if self.unix:
+                self.sourcePort = sourcePort = self.bindUnix(sourceIP, sourcePort)
+            else:
+                self.s.bind((sourceIP, sourcePort))
+                self.sourcePort = self.s.getsockname()[1]
             log("Source Socket Binding Successful. Listening on " + formatIpPort(sourceIP, sourcePort))
         except Exception as e:
             self.s.close()
@@ -237,13 +536,323 @@ class NetBotSocket:
         self.s.settimeout(0)
         self.destinationIP = destinationIP
         self.destinationPort = destinationPort
-        self.bufferSize = 4096
+        # Big enough for any UDP datagram so msgs from peers with a larger mtu are not truncated.
+        self.bufferSize = 65536
+        # Msgs longer than mtu bytes are sent as fragments of at most mtu bytes (see setMtu()).
+        self.mtu = 4096
+        self.fragmentID = 0  # ID of the last msg sent as fragments.
+        # {((ip, port), fragmentID): [count, received, {index: bytes, ...}, time first fragment arrived, bytes], ...}
+        self.fragments = {}
+        self.fragmentsBytes = 0  # Memory used by self.fragments, counting FragmentOverhead for each fragment.
+        self.fragmentsEvicted = 0  # Msgs that were never completed because fragments were lost.
+        # Datagrams are received into this one buffer and decoded from it, so receiving does not
+        # allocate a new bytes object for every msg. Decoded msgs never refer to the buffer.
+        self.recvBuffer = bytearray(self.bufferSize)
+        self.recvView = memoryview(self.recvBuffer)
+
+        # Receive thread (see startRecvThread()). None when msgs are received straight from the socket.
+        self.recvThread = None
+        self.recvQueue = None  # queue.Queue of (networkbytes, (ip, port)) received by recvThread.
+        self.recvQueueDrops = 0  # Datagrams recvThread dropped because recvQueue was full.
+        self.doorbell = None  # (recv socket, send socket) pair. Readable when recvQueue has msgs.
+        self.doorbellRung = False
+
+        # Shared memory transport (see startSharedMemory()).
+        self.shmDoorbell = None  # netbots_shm.ShmDoorbell that robots ring (server only).
+        self.shmChannels = {}  # {(ip, port): netbots_shm.ShmChannel, ...}
+
+        # Rate limit on msgs from each peer (see setRateLimit()). 0 is no limit.
+        self.rate = 0
+        self.burst = 0
+
         random.seed()
         self.msgID = random.randrange(0, 65000, 1)
 
     def settimeout(self, t):
         self.s.settimeout(t)
 
+    def bindUnix(self, directory, port):
+        """
+        Bind socket to unixPath(directory, port), creating directory if needed, and return port.
+        If port is 0 then the first free port from 40000 up is used.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for p in [port] if port else range(40000, 65001):
+            path = unixPath(directory, p)
+            removeStaleUnixSocket(path)
+            try:
+                self.s.bind(path)
+            except OSError as e:
+                if port or e.errno != errno.EADDRINUSE:
+                    raise
+                continue
+            atexit.register(removeUnixSocket, path)
+            return p
+        raise NetBotSocketException("No free port for Unix domain socket in " + directory)
+
+    def setRateLimit(self, rate, burst):
+        """
+        Limit msgs received by recvMessages() from each peer to rate msgs/sec, with bursts of up to
+        burst msgs. Each peer has a token bucket that holds up to burst tokens and refills at rate
+        tokens/sec. Each datagram (or fragment) received takes a token and datagrams from a peer
+        with an empty bucket are skipped before they are decoded, so a peer flooding the socket
+        costs little more than reading its datagrams. rate 0 turns the limit off.
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+
+    def admit(self, address):
+        """ Take a token from the bucket of the peer at address ((ip, port)). Returns False if it is empty. """
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = self.getPeer(*address)
+        now = time.perf_counter()
+        tokens = peer.tokens + (now - peer.tokenTime) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        peer.tokenTime = now
+        if tokens < 1:
+            peer.tokens = tokens
+            peer.throttled += 1
+            return False
+        peer.tokens = tokens - 1
+        return True
+
+    def fromUnixPath(self, path):
+        """ Return (ip, port) of the Unix domain socket at path. ip is the directory (see unixPath()). """
+        address = self.unixAddresses.get(path)
+        if address is None:
+            directory, filename = os.path.split(path)
+            try:
+                address = (directory, int(filename[:-5]))
+            except ValueError:
+                raise NetBotSocketException("Received msg from a Unix domain socket not named like unixPath(): " +
+                                            str(path))
+            self.unixAddresses[path] = address
+        return address
+
+    def fileno(self):
+        """
+        Return file descriptor of socket so NetBotSocket can be used with select and selectors.
+        If the receive thread is running this is a file descriptor that is readable while
+        msgs are queued, so register NetBotSocket with selectors after startRecvThread().
+        """
+        if self.doorbell:
+            return self.doorbell[0].fileno()
+        return self.s.fileno()
+
+    # Header of a fragment of a msg longer than mtu. 0xFF is not a CompactCodec type code.
+    # CompactMarker, FragmentCode, fragmentID, fragment index, fragment count
+    FragmentCode = 0xFF
+    FragmentHeader = struct.Struct('<BBHHH')
+    FragmentTimeout = 2.0  # Secs to wait for the rest of a msg's fragments before discarding them.
+    FragmentMaxPending = 256  # Max msgs that can be waiting for fragments at the same time.
+    FragmentMaxPendingPerPeer = 8  # Max msgs from one address that can be waiting for fragments at the same time.
+    FragmentMaxBytes = 1024 * 1024  # Longest msg that can be sent as fragments.
+    FragmentMinSize = 512  # Fewest msg bytes in each fragment but the last, so mtu can't be less than 520.
+    FragmentOverhead = 128  # About how many bytes of memory are used to keep a fragment besides its msg bytes.
+    FragmentMaxPendingBytes = 16 * 1024 * 1024  # Max memory used by all msgs waiting for fragments.
+
+    def setMtu(self, mtu):
+        """
+        Send msgs longer than mtu bytes as fragments of at most mtu bytes. The receiving NetBotSocket
+        puts them back together. Use a value that fits in one packet on the network (eg. 1400 for
+        ethernet) if large msgs (eg. viewData with many bots) are often lost. The default is 4096.
+        """
+        if mtu < self.FragmentHeader.size + self.FragmentMinSize or mtu > self.bufferSize:
+            raise NetBotSocketException("mtu must be between " + str(self.FragmentHeader.size + self.FragmentMinSize) +
+                                        " and " + str(self.bufferSize) + ".")
+        self.mtu = mtu
+
+    def fragment(self, networkbytes):
+        """ Return list of fragments (bytes) of networkbytes, each at most mtu bytes long. """
+        size = self.mtu - self.FragmentHeader.size
+        count = (len(networkbytes) + size - 1) // size
+        if count > 0xFFFF or len(networkbytes) > self.FragmentMaxBytes:
+            raise NetBotSocketException("Could not send because msg is too long for mtu.")
+        self.fragmentID = (self.fragmentID + 1) & 0xFFFF
+        return [self.FragmentHeader.pack(CompactCodec.CompactMarker, self.FragmentCode, self.fragmentID, i, count) +
+                networkbytes[i * size:(i + 1) * size] for i in range(count)]
+
+    def reassemble(self, fragment, address):
+        """
+        Store fragment from address and return the whole msg (bytes) if this was its last missing
+        fragment, otherwise None. Msgs still missing fragments after FragmentTimeout secs are discarded.
+
+        The header is not trusted: fragments of msgs longer than FragmentMaxBytes and fragments
+        other than the last with fewer than FragmentMinSize bytes are rejected. Fragments are kept
+        in a dict, not a list of count slots, so memory used only grows with the fragments actually
+        received, and the oldest msgs are discarded to keep it under FragmentMaxPendingBytes.
+        """
+        marker, code, fragmentID, index, count = self.FragmentHeader.unpack_from(fragment)
+        size = len(fragment) - self.FragmentHeader.size
+        # all fragments but the last are the same size, so count * size is about the length of the msg.
+        if index >= count or size < 1 or \
+                (index < count - 1 and (size < self.FragmentMinSize or count * size > self.FragmentMaxBytes + size)):
+            raise NetBotSocketException("Received fragment invalid format.")
+
+        key = (address, fragmentID)
+        pending = self.fragments.get(key)
+        if pending is None or pending[0] != count:
+            if pending is not None:
+                self.dropFragments(key)
+            self.evictFragments(address)
+            pending = self.fragments[key] = [count, 0, {}, time.perf_counter(), 0]
+
+        chunks = pending[2]
+        if index not in chunks:
+            used = size + self.FragmentOverhead
+            while self.fragmentsBytes + used > self.FragmentMaxPendingBytes:
+                self.dropFragments(next(k for k in self.fragments if k != key))
+            # copy because fragment may be a view of recvBuffer, which is reused.
+            chunks[index] = bytes(fragment[self.FragmentHeader.size:])
+            pending[1] += 1
+            pending[4] += used
+            self.fragmentsBytes += used
+        if pending[1] < count:
+            return None
+
+        del self.fragments[key]
+        self.fragmentsBytes -= pending[4]
+        return b''.join([chunks[i] for i in range(count)])
+
+    def evictFragments(self, address):
+        """
+        Discard msgs that have waited FragmentTimeout secs for fragments, and the oldest if there
+        are too many in all or from address, to make room for a new msg from address.
+        """
+        self.expireFragments()
+        fromAddress = [k for k in self.fragments if k[0] == address]
+        for key in fromAddress[:max(0, len(fromAddress) - self.FragmentMaxPendingPerPeer + 1)]:
+            self.dropFragments(key)
+        while len(self.fragments) >= self.FragmentMaxPending:
+            self.dropFragments(next(iter(self.fragments)))
+
+    def expireFragments(self):
+        """
+        Discard msgs that have waited FragmentTimeout secs for fragments. Servers should call this
+        regularly (eg. once per step) so memory is freed even when no new fragmented msgs arrive.
+        """
+        if not self.fragments:
+            return
+        now = time.perf_counter()
+        for key in [k for k, p in self.fragments.items() if now - p[3] > self.FragmentTimeout]:
+            self.dropFragments(key)
+
+    def dropFragments(self, key):
+        """ Discard the fragments received so far of msg key and count it as lost. """
+        self.fragmentsBytes -= self.fragments.pop(key)[4]
+        self.fragmentsEvicted += 1
+
+    def setRecvBufferSize(self, size):
+        """
+        Ask the OS for a socket receive buffer of size bytes and return the size it is actually
+        using (eg. linux doubles size and limits it to net.core.rmem_max). Datagrams that arrive
+        while the receive buffer is full are dropped by the OS (see getKernelDrops()).
+        """
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        return self.s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+    def getKernelDrops(self):
+        """
+        Return the number of datagrams the OS dropped because the socket receive buffer was full,
+        or None if it is not known. Only linux (/proc/net/udp) is supported.
+        """
+        try:
+            inode = os.fstat(self.s.fileno()).st_ino
+            with open("/proc/net/udp") as f:
+                f.readline()  # skip column headings
+                for line in f:
+                    fields = line.split()
+                    if int(fields[9]) == inode:
+                        return int(fields[12])
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def startRecvThread(self, maxQueued=10000):
+        """
+        Start a thread that receives datagrams as soon as they arrive and queues them, so they
+        are not lost in a full OS receive buffer while the program is busy. Up to maxQueued
+        datagrams are queued, others are dropped and counted in recvQueueDrops.
+
+        recvMessage() and recvMessages() then take msgs from the queue and fileno() is readable
+        while msgs are queued, so select and selectors still work.
+        """
+        if self.recvThread:
+            return
+        self.recvQueue = queue.Queue(maxQueued)
+        self.doorbell = socket.socketpair()
+        for s in self.doorbell:
+            s.setblocking(False)
+        self.recvThread = threading.Thread(target=self.recvLoop, name="NetBotSocketRecv", daemon=True)
+        self.recvThread.start()
+
+    def stopRecvThread(self):
+        """ Stop the receive thread. Msgs still queued are discarded. """
+        if not self.recvThread:
+            return
+        thread = self.recvThread
+        self.recvThread = None
+        thread.join()
+        for s in self.doorbell:
+            s.close()
+        self.doorbell = None
+        self.recvQueue = None
+
+    def recvLoop(self):
+        """ Body of the receive thread started by startRecvThread(). """
+        buffer = bytearray(self.bufferSize)
+        while self.recvThread:
+            try:
+                ready = select.select([self.s], [], [], 0.2)[0]
+                if not ready:
+                    continue
+                n, address = self.s.recvfrom_into(buffer)
+                networkbytes = bytes(buffer[:n])
+            except (BlockingIOError, socket.timeout, ConnectionResetError):
+                continue
+            except (OSError, ValueError):
+                # socket was closed.
+                return
+
+            try:
+                self.recvQueue.put_nowait((networkbytes, address))
+            except queue.Full:
+                self.recvQueueDrops += 1
+                continue
+            self.ringDoorbell()
+
+    def ringDoorbell(self):
+        """ Make fileno() readable because there are msgs in recvQueue. """
+        if not self.doorbellRung:
+            self.doorbellRung = True
+            try:
+                self.doorbell[1].send(b'\0')
+            except (BlockingIOError, OSError):
+                pass
+
+    def answerDoorbell(self):
+        """ Make fileno() not readable. Call before taking msgs from recvQueue. """
+        try:
+            while self.doorbell[0].recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        # cleared after reading the doorbell, otherwise a ring from recvLoop() in between would be
+        # read here but leave doorbellRung set, so msgs queued later would never ring it again.
+        self.doorbellRung = False
+
+    def getQueued(self):
+        """
+        Return the next (networkbytes, address) from recvQueue. Waits up to the socket timeout
+        (see settimeout()). Raises queue.Empty if there is nothing to receive.
+        """
+        timeout = self.s.gettimeout()
+        if timeout:
+            return self.recvQueue.get(timeout=timeout)
+        return self.recvQueue.get_nowait()
+
     def setDelay(self, delay):
         self.sendrecvDelay = delay
 
@@ -258,19 +867,26 @@ class NetBotSocket:
                 "\n  Avg sendRecvMessage Time: " + \
                 '%.6f' % (self.sendRecvMessageTime / self.sendRecvMessageCalls) + " secs."
 
-        for src in self.sent.keys():
-            output += "\n\n               === To/From: " + src + " ==="\
-                "\n             Messages Sent: " + str(self.sent[src]) +\
-                "\n             Messages Recv: " + str(self.recv[src])
+        if self.fragmentsEvicted:
+            output += "\n      Fragmented Msgs Lost: " + str(self.fragmentsEvicted)
 
-            if src in self.sendTypes:
+        for peer in self.peers.values():
+            if not peer.sent and not peer.recv and not peer.throttled:
+                continue
+            output += "\n\n               === To/From: " + peer.name + " ==="\
+                "\n             Messages Sent: " + str(peer.sent) +\
+                "\n             Messages Recv: " + str(peer.recv)
+            if peer.throttled:
+                output += "\n         Messages Throttled: " + str(peer.throttled)
+
+            if peer.sendTypes:
                 output += "\n\n                Messages Sent by Type"
-                for t, c in sorted(self.sendTypes[src].items(), key=lambda x: x[0]):
+                for t, c in sorted(peer.sendTypes.items(), key=lambda x: x[0]):
                     output += "\n" + '%26s' % (t) + ": " + str(c)
 
-            if src in self.recvTypes:
+            if peer.recvTypes:
                 output += "\n\n                Messages Recv by Type"
-                for t, c in sorted(self.recvTypes[src].items(), key=lambda x: x[0]):
+                for t, c in sorted(peer.recvTypes.items(), key=lambda x: x[0]):
                     output += "\n" + '%26s' % (t) + ": " + str(c)
 
             output += "\n"
@@ -293,12 +909,60 @@ class NetBotSocket:
         self.destinationIP = destinationIP
         self.destinationPort = destinationPort
 
-    def serialize(self, msg):
+    def getPeer(self, ip, port):
+        """ Return the Peer for ip:port, adding it if this is the first time ip:port is used. """
+        peer = self.peers.get((ip, port))
+        if peer is None:
+            peer = self.peers[(ip, port)] = Peer(ip, port, unixPath(ip, port) if self.unix else None)
+        return peer
+
+    def peerName(self, ip, port):
+        """ Return 'ip:port'. The str is only built once for each peer. """
+        return self.getPeer(ip, port).name
+
+    def setCodec(self, dest, codec):
+        """ Use codec (see Codecs) for msgs sent to dest ('ip:port' or (ip, port)). None means msgpack. """
+        if codec == 'msgpack':
+            codec = None
+        elif codec is not None and codec not in Codecs:
+            raise NetBotSocketException("Unknown codec: " + str(codec))
+        self.getPeer(*toAddress(dest)).codec = codec
+
+    def getCodec(self, dest):
+        """ Return codec (see Codecs) used for msgs sent to dest ('ip:port' or (ip, port)). None means msgpack. """
+        peer = self.peers.get(toAddress(dest))
+        return peer.codec if peer else None
+
+    def serialize(self, msg, codec=None):
+        if codec == 'compact':
+            b = compactCodec.pack(msg)
+            if b is not None:
+                return b
         return umsgpack.packb(msg, use_bin_type=True)
 
     def deserialize(self, b):
+        if b and b[0] == CompactCodec.CompactMarker:
+            return compactCodec.unpack(b)
         return umsgpack.unpackb(b, raw=False)
 
+    def packMessage(self, msg, destinationIP, destinationPort):
+        """
+        Check msg, destinationIP, and destinationPort and return msg serialized with the
+        codec agreed with destinationIP:destinationPort. The result can be sent (more than
+        once) with sendMessage(..., packedAndChecked=True). Raises NetBotSocketException
+        if anything does not have a valid format.
+        """
+        if not isValidMsg(msg):
+            raise NetBotSocketException("Could not send because msg is not valid format.")
+        if not isValidIP(destinationIP):
+            raise NetBotSocketException("Could not send because destinationIP is not valid format.")
+        if not isValidPort(destinationPort):
+            raise NetBotSocketException("Could not send because destinationPort is not valid format.")
+
+        # Convert data from python objects to network binary format
+        peer = self.peers.get((destinationIP, destinationPort))
+        return self.serialize(msg, peer.codec if peer else None)
+
     def sendMessage(self, msg, destinationIP=None, destinationPort=None, packedAndChecked=False):
         """
         Sends msg to destinationIP:destinationPort and then returns immediately.
@@ -324,39 +988,41 @@ class NetBotSocket:
             destinationPort = self.destinationPort
 
         if not packedAndChecked:
-            if not isValidMsg(msg):
-                raise NetBotSocketException("Could not send because msg is not valid format.")
-            if not isValidIP(destinationIP):
-                raise NetBotSocketException("Could not send because destinationIP is not valid format.")
-            if not isValidPort(destinationPort):
-                raise NetBotSocketException("Could not send because destinationPort is not valid format.")
-
-            # Convert data from python objects to network binary format
-            networkbytes = self.serialize(msg)
+            networkbytes = self.packMessage(msg, destinationIP, destinationPort)
         else:
             networkbytes = msg
 
-        log("Sending msg to " + destinationIP + ":" + str(destinationPort) +
-            " len=" + str(len(networkbytes)) + " bytes " + str(msg), "DEBUG")
-        self.s.sendto(networkbytes, (destinationIP, destinationPort))
+        if isEnabled("DEBUG"):
+            log("Sending msg to " + destinationIP + ":" + str(destinationPort) +
+                " len=" + str(len(networkbytes)) + " bytes " + str(msg), "DEBUG")
 
-        dest = formatIpPort(destinationIP, destinationPort)
-        if dest in self.sent:
-            self.sent[dest] += 1
-        else:
-            self.sent[dest] = 1
+        peer = self.peers.get((destinationIP, destinationPort))
+        if peer is None:
+            peer = self.getPeer(destinationIP, destinationPort)
+
+        try:
+            if peer.shm is not None and peer.shm.active:
+                if not peer.shm.send(networkbytes):
+                    log("Shared memory ring to " + peer.name + " is full. Msg dropped.", "DEBUG")
+            elif len(networkbytes) > self.mtu:
+                for fragment in self.fragment(networkbytes):
+                    self.s.sendto(fragment, peer.sockaddr)
+            else:
+                self.s.sendto(networkbytes, peer.sockaddr)
+        except OSError as e:
+            # Unlike UDP, sending to a Unix domain socket fails if its receive buffer is full or
+            # nothing is bound to it. Treat it like a lost datagram.
+            if not self.unix:
+                raise
+            log("Could not send msg to " + peer.name + ": " + str(e) + ". Msg dropped.", "DEBUG")
+
+        peer.sent += 1
 
         if not packedAndChecked:
             msgtype = msg['type']
         else:
             msgtype = "Serialized"
-
-        if dest not in self.sendTypes:
-            self.sendTypes[dest] = {}
-        if msgtype in self.sendTypes[dest]:
-            self.sendTypes[dest][msgtype] += 1
-        else:
-            self.sendTypes[dest][msgtype] = 1
+        peer.sendTypes[msgtype] = peer.sendTypes.get(msgtype, 0) + 1
 
     def recvMessage(self):
         """
@@ -382,43 +1048,264 @@ class NetBotSocket:
         (non-blocking), which is the default in NetBotSocket.
 
         """
-        try:
-            bytesAddressPair = self.s.recvfrom(self.bufferSize)
-            # Convert data from network binary format to python objects
-            msg = self.deserialize(bytesAddressPair[0])
-            ip = bytesAddressPair[1][0]
-            port = bytesAddressPair[1][1]
-            log("Received msg from " + ip + ":" + str(port) + " len=" +
-                str(len(bytesAddressPair[0])) + " bytes " + str(msg), "DEBUG")
-
-            src = formatIpPort(ip, port)
-            if src in self.recv:
-                self.recv[src] += 1
+        if self.shmChannels and self.recvQueue is None:
+            return self.recvMessageShm()
+
+        # keep receiving while datagrams are fragments of msgs that are not complete yet.
+        result = None
+        while result is None:
+            if self.recvQueue is not None:
+                self.answerDoorbell()
+                try:
+                    networkbytes, address = self.getQueued()
+                except queue.Empty:
+                    raise NetBotSocketException("Receive buffer empty.")
+                if not self.recvQueue.empty():
+                    self.ringDoorbell()
             else:
-                self.recv[src] = 1
+                try:
+                    n, address = self.s.recvfrom_into(self.recvBuffer)
+                except (BlockingIOError, socket.timeout):
+                    # There was no data in the receive buffer.
+                    raise NetBotSocketException("Receive buffer empty.")
+                except (ConnectionResetError):
+                    # Windows raises this when it gets back an ICMP destination unreachable packet
+                    log("The destination ip:port returned ICMP destination unreachable. Is the destination running?", "WARNING")
+                    raise NetBotSocketException(
+                        "The destination ip:port returned ICMP destination unreachable. Is the destination running?")
+                networkbytes = self.recvView[:n]
+
+            result = self.decodeMessage(networkbytes, address)
+
+        return result
+
+    def recvMessages(self, maxMsgs=0, msgs=None):
+        """
+        Receive up to maxMsgs (0 means all) msgs that are immediately ready to receive
+        and return them as a list of (msg, ip, port) tuples, in the order they arrived.
+        This is faster than calling recvMessage() until the receive buffer is empty.
 
-            if src not in self.recvTypes:
-                self.recvTypes[src] = {}
-            if msg['type'] in self.recvTypes[src]:
-                self.recvTypes[src][msg['type']] += 1
+        If msgs (a list) is given then it is cleared, filled, and returned so the same
+        list can be reused for every call.
+
+        Returns an empty list if the receive buffer is empty. Msgs that are not valid
+        (see Messages below) or can't be decoded are skipped, as are msgs from peers over
+        the rate limit (see setRateLimit()).
+        """
+        if msgs is None:
+            msgs = []
+        else:
+            msgs.clear()
+
+        recvQueue = self.recvQueue
+        if recvQueue is not None:
+            self.answerDoorbell()
+
+        while not maxMsgs or len(msgs) < maxMsgs:
+            if recvQueue is not None:
+                try:
+                    networkbytes, address = recvQueue.get_nowait()
+                except queue.Empty:
+                    break
             else:
-                self.recvTypes[src][msg['type']] = 1
+                try:
+                    n, address = self.s.recvfrom_into(self.recvBuffer)
+                except (BlockingIOError, socket.timeout):
+                    break
+                except (ConnectionResetError):
+                    # Windows raises this when it gets back an ICMP destination unreachable packet
+                    log("The destination ip:port returned ICMP destination unreachable. Is the destination running?", "WARNING")
+                    continue
+                networkbytes = self.recvView[:n]
+
+            self.decodeInto(msgs, networkbytes, address)
+
+        if recvQueue is not None and not recvQueue.empty():
+            self.ringDoorbell()
 
-        except (BlockingIOError, socket.timeout):
-            # There was no data in the receive buffer.
-            raise NetBotSocketException("Receive buffer empty.")
-        except (ConnectionResetError):
-            # Windows raises this when it gets back an ICMP destination unreachable packet
-            log("The destination ip:port returned ICMP destination unreachable. Is the destination running?", "WARNING")
-            raise NetBotSocketException(
-                "The destination ip:port returned ICMP destination unreachable. Is the destination running?")
+        if self.shmChannels:
+            self.recvSharedMemory(msgs, maxMsgs)
+
+        return msgs
+
+    def decodeInto(self, msgs, networkbytes, address):
+        """
+        Append (msg, ip, port) from decodeMessage() to msgs. Msgs that are not valid or can't be decoded
+        are skipped, as are msgs from peers over the rate limit (see setRateLimit()).
+        """
+        try:
+            if self.rate:
+                if self.unix and type(address) is not tuple:
+                    address = self.fromUnixPath(address)
+                if not self.admit(address):
+                    return
+            result = self.decodeMessage(networkbytes, address)
+            if result is not None:
+                msgs.append(result)
+        except NetBotSocketException:
+            pass
+        except Exception as e:
+            source = formatIpPort(*address) if type(address) is tuple else str(address)
+            log("Skipped datagram from " + source + " that could not be decoded: " + str(type(e)) + " " + str(e),
+                "WARNING")
+
+    def recvSharedMemory(self, msgs, maxMsgs=0):
+        """ Append msgs waiting in shared memory channels to msgs, up to maxMsgs (0 means all) msgs in total. """
+        for address, channel in list(self.shmChannels.items()):
+            channel.answer()
+            while not maxMsgs or len(msgs) < maxMsgs:
+                try:
+                    networkbytes = channel.recv()
+                except nbshm.ShmProtocolError as e:
+                    self.shmProtocolError(address, e)
+                    break
+                if networkbytes is None:
+                    # ask the other end to ring the doorbell when it sends again, unless it just did.
+                    if channel.wait():
+                        break
+                    continue
+                channel.active = True
+                self.decodeInto(msgs, networkbytes, address)
+
+    def recvMessageShm(self):
+        """
+        recvMessage() for a robot that has shared memory channels. Returns the next msg from a
+        channel or the socket, waiting for one up to the socket timeout (see settimeout()).
+        """
+        timeout = self.s.gettimeout()
+        waitUntil = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            for address, channel in list(self.shmChannels.items()):
+                channel.answer()
+                try:
+                    networkbytes = channel.recv()
+                    # ask the server to ring the doorbell when it sends again, unless it just did.
+                    if networkbytes is None and not channel.wait():
+                        networkbytes = channel.recv()
+                except nbshm.ShmProtocolError as e:
+                    self.shmProtocolError(address, e)
+                    continue
+                if networkbytes is not None:
+                    return self.decodeMessage(networkbytes, address)
+
+            remaining = None if waitUntil is None else max(0, waitUntil - time.perf_counter())
+            ready = select.select([self.s] + [c.recvDoorbell for c in self.shmChannels.values()], [], [], remaining)[0]
+            if self.s in ready:
+                n, address = self.s.recvfrom_into(self.recvBuffer)
+                result = self.decodeMessage(self.recvView[:n], address)
+                if result is not None:
+                    return result
+            elif not ready:
+                raise NetBotSocketException("Receive buffer empty.")
+
+    def startSharedMemory(self):
+        """
+        Let robots on this computer ask for shared memory (joinRequest 'shm') instead of UDP. Returns an
+        object to select on (with selectors) that is readable when robots send msgs by shared memory, or
+        None if shared memory is not supported (eg. on Windows).
+        """
+        if not nbshm.available:
+            return None
+        try:
+            self.shmDoorbell = nbshm.ShmDoorbell.create(self.sourcePort)
+        except OSError as e:
+            log("Shared memory not available: " + str(e), "WARNING")
+            return None
+        return self.shmDoorbell
+
+    def openSharedMemory(self, dest):
+        """
+        Create a shared memory channel for the robot at dest ('ip:port' or (ip, port)). Returns the info
+        the robot needs to attach to the channel (see joinReply 'shm') or None if the robot can't use
+        shared memory. Msgs are sent to the robot by UDP until the robot sends a msg on the channel.
+        """
+        address = toAddress(dest)
+        if not self.shmDoorbell or not (self.unix or address[0].startswith("127.")):
+            return None
+        self.closeSharedMemory(address)
+        try:
+            channel = nbshm.ShmChannel.create(self.shmDoorbell)
+        except Exception as e:
+            log("Could not create shared memory for " + formatIpPort(*address) + ": " + str(e), "WARNING")
+            return None
+        self.getPeer(*address).shm = channel
+        self.shmChannels[address] = channel
+        return channel.info
+
+    def attachSharedMemory(self, dest, info):
+        """ Send and receive msgs to and from dest ('ip:port' or (ip, port)) on the shared memory channel in info. """
+        address = toAddress(dest)
+        peer = self.getPeer(*address)
+        if peer.shm and peer.shm.info['name'] == info['name']:
+            return
+        self.closeSharedMemory(address)
+        channel = nbshm.ShmChannel.attach(info)
+        peer.shm = channel
+        self.shmChannels[address] = channel
+        log("Using shared memory to talk to " + peer.name + ".", "VERBOSE")
+
+    def shmProtocolError(self, address, e):
+        """ Close the shared memory channel with address because the other end broke the ring protocol. """
+        log(str(e) + " Closing shared memory with " + self.peers[address].name + ", using UDP instead.", "WARNING")
+        self.closeSharedMemory(address)
+
+    def closeSharedMemory(self, dest):
+        """ Stop using shared memory with dest ('ip:port' or (ip, port)) and go back to UDP. """
+        address = toAddress(dest)
+        channel = self.shmChannels.pop(address, None)
+        if channel:
+            channel.close()
+            self.peers[address].shm = None
+
+    def decodeMessage(self, networkbytes, address):
+        """
+        Decode the datagram networkbytes (bytes or memoryview) received from address and return
+        msg, ip, port. Returns None if networkbytes is a fragment and the rest of the msg has not
+        been received yet. Raises NetBotSocketException if msg is not a valid message.
+        """
+        if self.unix and type(address) is not tuple:
+            address = self.fromUnixPath(address)
+
+        if len(networkbytes) >= self.FragmentHeader.size and networkbytes[0] == CompactCodec.CompactMarker and \
+                networkbytes[1] == self.FragmentCode:
+            networkbytes = self.reassemble(networkbytes, address)
+            if networkbytes is None:
+                return None
+
+        # Convert data from network binary format to python objects
+        msg = self.deserialize(networkbytes)
+        ip, port = address
+        if isEnabled("DEBUG"):
+            log("Received msg from " + ip + ":" + str(port) + " len=" +
+                str(len(networkbytes)) + " bytes " + str(msg), "DEBUG")
+
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = self.getPeer(ip, port)
+        peer.recv += 1
+        msgtype = msg['type']
+        peer.recvTypes[msgtype] = peer.recvTypes.get(msgtype, 0) + 1
 
         if not isValidMsg(msg):
             raise NetBotSocketException("Received message invalid format.")
 
+        # Keep the latest state pushed by the server so getBotState() can return it, even if
+        # it arrived while sendRecvMessage() was waiting for a reply.
+        if msg['type'] == 'botState':
+            self.botState = msg
+
         # If we get a joinReply then use the server conf to tune our send delay in sendRecvMessage()
+        # and, if the server agreed to the codec we asked for, use it from now on.
         if msg['type'] == 'joinReply':
             self.setDelay(msg['conf']['stepSec'] * 2)
+            if 'codec' in msg and msg['codec'] in Codecs:
+                self.setCodec((ip, port), msg['codec'])
+            # and if the server agreed to shared memory, use it from now on.
+            if 'shm' in msg:
+                try:
+                    self.attachSharedMemory((ip, port), msg['shm'])
+                except Exception as e:
+                    log("Could not use shared memory, using UDP: " + str(e), "WARNING")
 
         return msg, ip, port
 
@@ -508,3 +1395,41 @@ class NetBotSocket:
 
         self.sendRecvMessageTime += time.perf_counter() - startTime
         return replyMsg
+
+    def getBotState(self):
+        """
+        Return the latest botState msg the server has pushed to this socket, or None if none
+        have been received yet. The server only pushes botState after a subscribeRequest.
+
+        getBotState does not wait. It reads all msgs already in the receive buffer to find the
+        latest botState. Any other msgs in the buffer are discarded, so getBotState should not be
+        mixed with sendMessage and recvMessage (asynchronous) without careful consideration.
+        """
+        while True:
+            try:
+                self.recvMessage()
+            except NetBotSocketException:
+                # receive buffer is empty (or had an invalid msg).
+                break
+        return self.botState
+
+    def sendRecvBatch(self, requests, destinationIP=None, destinationPort=None,
+                      retries=10, delay=None, delayMultiplier=1.2):
+        """
+        Sends a list of request msgs to destinationIP:destinationPort in one batchRequest
+        and returns the list of replies, in the same order. The server processes all the
+        requests together in the same step. Each request in the batch counts as one msg
+        against the server's botMsgsPerStep so a batch may only contain up to botMsgsPerStep
+        requests.
+
+        Unlike sendRecvMessage, if the reply to a request is an "Error" message then it is
+        returned in the list and no exception is raised. Other arguments and exceptions are
+        the same as sendRecvMessage.
+        """
+        for msg in requests:
+            if not isValidMsg(msg):
+                raise NetBotSocketException("Could not send because a msg in batch is not valid format.")
+
+        replyMsg = self.sendRecvMessage({'type': 'batchRequest', 'requests': requests}, destinationIP,
+                                        destinationPort, retries, delay, delayMultiplier)
+        return replyMsg['replies']
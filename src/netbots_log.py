@@ -1,12 +1,14 @@
-
-import inspect
-import os
+import atexit
+import queue
+import sys
+import threading
 from datetime import datetime
 
 # global printing of debug and info log level messages on/off
 logDebug = False
 logVerbose = False
 logFile = False
+logFileWriter = None  # LogFileWriter for logFile, or None if not writing to a file.
 
 
 def setLogLevel(debug=False, verbose=False):
@@ -23,18 +25,87 @@ def setLogLevel(debug=False, verbose=False):
     logVerbose = verbose
     log("DEBUG logging = " + str(logDebug) + ". VERBOSE logging = " + str(logVerbose), "INFO")
 
+
+class LogFileWriter:
+    """
+    Append lines to a file from a background thread so log() does not wait on the disk.
+    The file is kept open and all lines waiting in the queue are written and flushed together.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lines = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="LogFileWriter", daemon=True)
+        self.thread.start()
+
+    def write(self, line):
+        self.lines.put(line)
+
+    def run(self):
+        with open(self.filename, "a+") as f:
+            while True:
+                batch = [self.lines.get()]
+                try:
+                    while True:
+                        batch.append(self.lines.get_nowait())
+                except queue.Empty:
+                    pass
+
+                closing = None in batch
+                if closing:
+                    batch = batch[:batch.index(None)]
+                for line in batch:
+                    f.write(line + "\n")
+                f.flush()
+                if closing:
+                    return
+
+    def close(self):
+        """ Write all lines logged so far and close the file. """
+        self.lines.put(None)
+        self.thread.join()
+
+
+def closeLogFile():
+    """ Stop writing to logFile, waiting for all lines logged so far to be written. """
+
+    global logFileWriter
+
+    if logFileWriter:
+        logFileWriter.close()
+        logFileWriter = None
+
+
+atexit.register(closeLogFile)
+
+
 def setLogFile(filename=False):
     """
     Turn writing to file on or off. Off by default.
     """
 
-    global logFile
+    global logFile, logFileWriter
 
+    closeLogFile()
     logFile = filename
+    if logFile:
+        logFileWriter = LogFileWriter(logFile)
     log("logFile set to " + str(logFile), "INFO")
 
 
-def log(msg, level="INFO"):
+def isEnabled(level):
+    """
+    Return True if log() will output msgs of level. Use this to skip building
+    expensive msgs, eg. if isEnabled("DEBUG"): log("..." + str(bigDict), "DEBUG")
+    """
+    if level == "DEBUG":
+        return logDebug
+    if level == "VERBOSE":
+        return logVerbose
+    return True
+
+
+def log(msg, level="INFO", *args):
     """
     Print msg to standard output in the format: LogLevel Time Function: msg
 
@@ -47,29 +118,31 @@ def log(msg, level="INFO"):
             ERROR: Can not continue as planned.
             FAILURE: program will need to quit or initialize.
 
+    msg is only formatted if it will be output so it is cheap to log at a level that is off:
+            msg may be a function that returns the msg, eg. log(lambda: str(bigDict), "DEBUG")
+            if args are given then msg is formatted with msg % args, eg. log("msg %s", "DEBUG", bigDict)
     """
 
-    global logDebug, logVerbose, logFile
-
     if level == "DEBUG" and logDebug == False:
         return
 
     if level == "VERBOSE" and logVerbose == False:
         return
 
+    if callable(msg):
+        msg = msg()
+    if args:
+        msg = msg % args
+
     try:
-        # Get the execution frame of the calling function and use it to determine the calling filename and function name
-        # This will fail if called from a python interactive shell.
-        frame = inspect.stack()[1]
-        module = inspect.getmodule(frame[0])
-        filename = os.path.basename(module.__file__)
-        modulename = module.__name__
-        function = frame[0].f_code.co_name
+        # Get the execution frame of the calling function and use it to determine the calling module and function name
+        frame = sys._getframe(1)
+        modulename = frame.f_globals['__name__']
+        function = frame.f_code.co_name
         if function != '<module>':
             function = function + '()'
     except Exception as e:
         modulename = '-'
-        filename = '-'
         function = '-'
 
     time = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
@@ -78,6 +151,5 @@ def log(msg, level="INFO"):
 
     print(output)
 
-    if logFile:
-        with open(logFile,"a+") as f: 
-            f.write(output + "\n")
+    if logFileWriter:
+        logFileWriter.write(output)
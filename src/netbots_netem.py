@@ -0,0 +1,112 @@
+import heapq
+import itertools
+import random
+import zlib
+
+"""
+Network emulation for the NetBots server (-netloss, -netburst, -netlatency, -netjitter,
+-netbw, and -netseed).
+
+Each robot gets its own emulated network link with its own random number generator,
+seeded from -netseed and the robot's address, so a robot's losses do not depend on how
+many msgs other robots send and the same seed gives the same losses in every run.
+
+Loss is either random (-netloss) or bursty (-netburst) using a Gilbert-Elliott model: a
+link is in a good or a bad state and moves between them at random for each msg. All msgs
+are lost in the bad state and -netloss % of msgs are lost in the good state.
+
+Delayed msgs (latency, jitter, and time to send at the -netbw bandwidth) are kept in one
+heap ordered by the time they are due, so scheduling and delivering a msg costs
+O(log n) for n msgs in flight. The server calls service() from its main loop.
+"""
+
+
+class Link:
+    """ Emulated network link between the server and one robot. """
+    __slots__ = ('rand', 'bad', 'busyUntil')
+
+    def __init__(self, seed):
+        self.rand = random.Random(seed)
+        self.bad = False  # Gilbert-Elliott state. True while in a loss burst.
+        self.busyUntil = 0.0  # time the link finishes sending the msgs already queued on it (bandwidth cap).
+
+
+class NetEm:
+    """
+    loss: % of msgs lost (in the good state if burst is used).
+    burst: (start, end) % chance for each msg that a loss burst starts and, once started, ends.
+    latency: secs each msg is delayed.
+    jitter: each msg is delayed a random 0 to jitter secs more than latency.
+    bandwidth: bytes/sec each link can send. 0 is unlimited.
+    seed: seed for all links. None picks one at random.
+    """
+    # Msgs are dropped instead of queued once a link has this many secs of msgs waiting to be sent.
+    MaxQueueSecs = 1.0
+
+    def __init__(self, loss=0.0, burst=(0.0, 0.0), latency=0.0, jitter=0.0, bandwidth=0, seed=None):
+        self.loss = loss / 100
+        self.burstStart = burst[0] / 100
+        self.burstEnd = burst[1] / 100
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.seed = random.randrange(2 ** 32) if seed is None else seed
+        self.delays = latency > 0 or jitter > 0 or bandwidth > 0  # msgs must be scheduled instead of sent now.
+        self.links = {}  # {src: Link, ...}
+        self.heap = []  # [(time due, seq, function, args), ...] msgs in flight.
+        self.seq = itertools.count()  # keeps msgs due at the same time in the order they were scheduled.
+        self.queueDrops = 0  # msgs dropped because their link had MaxQueueSecs of msgs waiting.
+
+    def link(self, src):
+        """ Return the Link for src, adding it if this is the first msg to or from src. """
+        link = self.links.get(src)
+        if link is None:
+            link = self.links[src] = Link(self.seed ^ zlib.crc32(str(src).encode()))
+        return link
+
+    def lose(self, src):
+        """ Returns True if the next msg to or from src is lost. """
+        link = self.link(src)
+        if self.burstStart:
+            if link.bad:
+                if link.rand.random() < self.burstEnd:
+                    link.bad = False
+            elif link.rand.random() < self.burstStart:
+                link.bad = True
+            if link.bad:
+                return True
+        return self.loss > 0 and link.rand.random() < self.loss
+
+    def schedule(self, src, nbytes, now, function, *args):
+        """
+        Call function(*args) when a msg of nbytes to or from src, sent at now (time.perf_counter()),
+        arrives. Only nbytes > 0 count towards the bandwidth cap. Returns False if the msg was
+        dropped because the link is full.
+        """
+        link = self.link(src)
+        due = now
+        if self.bandwidth and nbytes:
+            start = link.busyUntil if link.busyUntil > now else now
+            if start - now > self.MaxQueueSecs:
+                self.queueDrops += 1
+                return False
+            due = link.busyUntil = start + nbytes / self.bandwidth
+        due += self.latency
+        if self.jitter:
+            due += link.rand.random() * self.jitter
+        heapq.heappush(self.heap, (due, next(self.seq), function, args))
+        return True
+
+    def nextDue(self):
+        """ Return the time the next msg is due or None if no msgs are in flight. """
+        return self.heap[0][0] if self.heap else None
+
+    def service(self, now):
+        """ Deliver all msgs due at or before now (time.perf_counter()). Returns the number delivered. """
+        heap = self.heap
+        n = 0
+        while heap and heap[0][0] <= now:
+            due, seq, function, args = heapq.heappop(heap)
+            function(*args)
+            n += 1
+        return n
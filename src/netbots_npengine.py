@@ -0,0 +1,275 @@
+import math
+
+import numpy as np
+
+import netbots_math as nbmath
+
+"""
+Optional numpy step engine for netbots_server.py (use server option -engine numpy).
+
+The dict engine in netbots_server.py moves one bot or shell at a time. This engine keeps
+the bot fields it needs in numpy arrays (one array per field, one element per bot) from
+step to step and moves all bots at once. The arrays are only loaded from d.bots when bots
+join or leave, when a game starts (see reset()), and for bots that other code changed
+since the last step (see botChanged()). Results are copied back into d.bots only for the
+bots they changed, so the message handlers, collisions, scans and viewers see the same
+data as with the dict engine.
+
+Shell explosions test every bot against the explosion, which is the most expensive part
+of a step with many bots and shells, and use the arrays directly.
+
+Every calculation below is written to produce the same floating point results as the
+dict engine (same operations in the same order) so both engines play the same game
+step for step. Obstacle and bot collisions are still resolved by netbots_server.py.
+"""
+
+
+class NumpyEngine:
+
+    def __init__(self):
+        self.bots = None  # Bot records in the same order as the arrays below. None means load all bots.
+        self.index = {}  # {src: index in arrays, ...}
+        self.classValuesConf = None  # d.classValuesConf when the arrays were loaded.
+        self.changed = set()  # {src, ...} bots changed by other code since they were loaded (see botChanged()).
+
+    def reset(self):
+        """ Load all bots from d.bots before the next step. Call when bots are changed outside of step(), eg. a new game. """
+        self.bots = None
+
+    def botChanged(self, src):
+        """ Load bot src from d.bots before it is next used. Call after changing a bot's fields outside of the engine. """
+        self.changed.add(src)
+
+    def sync(self, d):
+        """ Make the arrays match d.bots, loading all bots if bots have joined or left, otherwise only changed bots. """
+        bots = list(d.bots.values())
+        if bots != self.bots or d.classValuesConf != self.classValuesConf:
+            self.load(d, bots)
+        elif self.changed:
+            for src in self.changed:
+                i = self.index.get(src)
+                if i is not None:
+                    bot = bots[i]
+                    self.x[i] = bot.x
+                    self.y[i] = bot.y
+                    self.cs[i] = bot.currentSpeed
+                    self.rs[i] = bot.requestedSpeed
+                    self.cd[i] = bot.currentDirection
+                    self.rd[i] = bot.requestedDirection
+                    self.health[i] = bot.health
+                    self.hitSeverity[i] = bot.hitSeverity
+        self.changed.clear()
+
+    def load(self, d, bots):
+        """ Load arrays of all bot fields and class values the engine uses from bots (list of d.bots values). """
+        self.bots = bots
+        self.index = {src: i for i, src in enumerate(d.bots)}
+        self.classValuesConf = d.classValuesConf
+
+        a = np.array([(b.x, b.y, b.currentSpeed, b.requestedSpeed, b.currentDirection, b.requestedDirection,
+                       b.health, b.hitSeverity) for b in bots], dtype=float).reshape(len(bots), 8)
+        self.x, self.y, self.cs, self.rs, self.cd, self.rd, self.health, self.hitSeverity = \
+            [np.ascontiguousarray(f) for f in a.T]
+
+        cvs = [bot.classValues for bot in bots]
+        self.accRate = np.array([cv.botAccRate for cv in cvs], dtype=float)
+        self.minTurnRate = np.array([cv.botMinTurnRate for cv in cvs], dtype=float)
+        self.maxTurnRate = np.array([cv.botMaxTurnRate for cv in cvs], dtype=float)
+        self.maxSpeed = np.array([cv.botMaxSpeed for cv in cvs], dtype=float)
+        self.armor = np.array([cv.botArmor for cv in cvs], dtype=float)
+
+    def moveBots(self, d, aliveBots):
+        """
+        Same as netbots_server.moveBots() followed by netbots_server.collideWalls().
+        Bots alive at the start of the step (aliveBots) are the bots with health != 0.
+        """
+        self.sync(d)
+        if len(self.bots) == 0:
+            return
+
+        x, y, cs, rs, cd, rd = self.x, self.y, self.cs, self.rs, self.cd, self.rd
+        oldx, oldy, oldcs, oldcd, oldHitSeverity = x, y, cs, cd, self.hitSeverity
+        alive = self.health != 0
+
+        # change speed if needed
+        slower = alive & (cs > rs)
+        faster = alive & (cs < rs)
+        cs = np.where(slower, np.maximum(cs - self.accRate, rs), cs)
+        cs = np.where(faster, np.minimum(cs + self.accRate, rs), cs)
+
+        # change direction if needed, turn instantly if bot is not moving
+        turning = alive & (cd != rd)
+        instant = turning & (cs == 0)
+        turning = turning & ~instant
+
+        # how much can we turn at the speed we are going?
+        turnRate = self.minTurnRate + (self.maxTurnRate - self.minTurnRate) * (1 - cs / 100)
+
+        # the four cases below must be tested in the same order as the dict engine.
+        negative = turning & (cd > rd) & (cd - rd <= math.pi)
+        negativeOverZero = turning & ~negative & (rd > cd) & (rd - cd >= math.pi)
+        positive = turning & ~negative & ~negativeOverZero & (rd > cd) & (rd - cd <= math.pi)
+        positiveOverZero = turning & ~negative & ~negativeOverZero & ~positive & (cd > rd) & (cd - rd >= math.pi)
+
+        dirNegative = cd - turnRate
+        dirNegative = np.where(dirNegative <= rd, rd, dirNegative)
+        dirNegativeOverZero = normalizeAngles(cd - turnRate)
+        dirNegativeOverZero = np.where((dirNegativeOverZero <= rd) & (dirNegativeOverZero >= rd - math.pi),
+                                       rd, dirNegativeOverZero)
+        dirPositive = cd + turnRate
+        dirPositive = np.where(rd <= dirPositive, rd, dirPositive)
+        dirPositiveOverZero = normalizeAngles(cd + turnRate)
+        dirPositiveOverZero = np.where((dirPositiveOverZero >= rd) & (dirPositiveOverZero <= rd + math.pi),
+                                       rd, dirPositiveOverZero)
+
+        cd = np.select([instant, negative, negativeOverZero, positive, positiveOverZero],
+                       [rd, dirNegative, dirNegativeOverZero, dirPositive, dirPositiveOverZero], cd)
+
+        # move bot
+        moving = alive & (cs != 0)
+        distance = cs / 100.0 * self.maxSpeed
+        x = np.where(moving, x + distance * np.cos(cd), x)
+        y = np.where(moving, y + distance * np.sin(cd), y)
+
+        # detect if bots hit walls. if they, did move them so they are just barely not touching.
+        # Later walls replace the hitSeverity of earlier walls, like the dict engine.
+        botRadius = d.conf['botRadius']
+        arenaSize = d.conf['arenaSize']
+        hitSeverity = np.zeros(len(self.bots))
+
+        hit = x - botRadius < 0
+        x = np.where(hit, botRadius + 1, x)
+        hitSeverity = np.where(hit, self.wallHitSeverity(d, cs, cd, math.pi), hitSeverity)
+        hit = x + botRadius > arenaSize
+        x = np.where(hit, arenaSize - botRadius - 1, x)
+        hitSeverity = np.where(hit, self.wallHitSeverity(d, cs, cd, 0), hitSeverity)
+        hit = y - botRadius < 0
+        y = np.where(hit, botRadius + 1, y)
+        hitSeverity = np.where(hit, self.wallHitSeverity(d, cs, cd, math.pi * 3 / 2), hitSeverity)
+        hit = y + botRadius > arenaSize
+        y = np.where(hit, arenaSize - botRadius - 1, y)
+        hitSeverity = np.where(hit, self.wallHitSeverity(d, cs, cd, math.pi/2), hitSeverity)
+
+        self.x, self.y, self.cs, self.cd, self.hitSeverity = x, y, cs, cd, hitSeverity
+
+        # copy results back to the bots that changed (usually the ones that are moving).
+        changed = (x != oldx) | (y != oldy) | (cs != oldcs) | (cd != oldcd) | (hitSeverity != oldHitSeverity)
+        changed = np.flatnonzero(changed).tolist()
+        bots = self.bots
+        x, y, cs, cd, hitSeverity = (a[changed].tolist() for a in (x, y, cs, cd, hitSeverity))
+        for j, i in enumerate(changed):
+            bot = bots[i]
+            bot.x = x[j]
+            bot.y = y[j]
+            bot.currentSpeed = cs[j]
+            bot.currentDirection = cd[j]
+            bot.hitSeverity = hitSeverity[j]
+
+    def wallHitSeverity(self, d, cs, cd, a):
+        """ Same as netbots_server.getHitSeverity() for a bot hitting a wall, for all bots at once. """
+        hitSeverity = cs / 100.0 * self.maxSpeed / d.conf['botMaxSpeed'] * np.cos(cd - a)
+        return np.where(hitSeverity < 0, 0.0, hitSeverity)
+
+    def hitDamage(self, d):
+        """
+        Same as the loop in netbots_server.step() that gives damage to bots that hit something
+        this step and stops them. Call after collisions have been resolved.
+        """
+        self.sync(d)
+        bots = self.bots
+        for i in np.flatnonzero(self.hitSeverity).tolist():
+            bot = bots[i]
+            if d.conf['simpleCollisions']:
+                bot.hitSeverity = 1
+            bot.health = max(0, bot.health - bot.hitSeverity * d.conf['hitDamage'] * bot.classValues.botArmor)
+            bot.currentSpeed = 0
+            bot.requestedSpeed = 0
+            self.hitSeverity[i] = bot.hitSeverity
+            self.health[i] = bot.health
+            self.cs[i] = 0
+            self.rs[i] = 0
+
+    def moveShells(self, d):
+        """ Same as netbots_server.moveShells(). """
+        if len(d.shells) == 0:
+            return
+        self.sync(d)
+
+        srcs = list(d.shells.keys())
+        shells = list(d.shells.values())
+        cvs = [d.bots[src].classValues for src in srcs]
+        shellSpeed = np.array([cv.shellSpeed for cv in cvs], dtype=float)
+        explRadius = np.array([cv.explRadius for cv in cvs], dtype=float)
+
+        a = np.array([(s.x, s.y, s.direction, s.distanceRemaining) for s in shells], dtype=float)
+        oldx, oldy, direction, distanceRemaining = a.T
+
+        # move shell
+        distance = np.minimum(shellSpeed, distanceRemaining)
+        x = oldx + distance * np.cos(direction)
+        y = oldy + distance * np.sin(direction)
+        distanceRemaining = distanceRemaining - distance
+
+        # if shell's explosion would touch inside of arena
+        arenaSize = d.conf['arenaSize']
+        inArena = (x > explRadius * -1) & (x < arenaSize + explRadius) & \
+                  (y > explRadius * -1) & (y < arenaSize + explRadius)
+
+        x = x.tolist()
+        y = y.tolist()
+        distanceRemaining = distanceRemaining.tolist()
+        inArena = inArena.tolist()
+        oldx = oldx.tolist()
+        oldy = oldy.tolist()
+
+        for i, src in enumerate(srcs):
+            shell = shells[i]
+            shell.x = x[i]
+            shell.y = y[i]
+            shell.distanceRemaining = distanceRemaining[i]
+
+            # did shell hit an obstacle?
+            shellHitObstacle = False
+            for o in d.conf['obstacles']:
+                if nbmath.intersectLineCircle(oldx[i], oldy[i], x[i], y[i], o['x'], o['y'], o['radius']):
+                    shellHitObstacle = True
+                    break
+
+            if not shellHitObstacle and inArena[i]:
+                # if shell has reached it destination then explode.
+                if distanceRemaining[i] <= 0:
+                    self.explodeShell(d, src, shell)
+                    del d.shells[src]
+            else:
+                # shell hit obstacle or left arena so remove it without exploding
+                del d.shells[src]
+
+    def explodeShell(self, d, src, shell):
+        """ Same as netbots_server.explodeShell(). Call sync() first. """
+        shooter = d.bots[src]
+        explRadius = shooter.classValues.explRadius
+        explDamage = shooter.classValues.explDamage
+
+        distance = np.sqrt((shell.x - self.x)**2 + (shell.y - self.y)**2)
+        hit = np.flatnonzero((self.health > 0) & (distance < explRadius)).tolist()
+        if hit:
+            distance = distance[hit]
+            damage = explDamage * (1 - distance / explRadius)
+            health = np.maximum(0, self.health[hit] - (damage * self.armor[hit]))
+            self.health[hit] = health
+
+            # Apply damage in bot order so shellDamage is summed the same as the dict engine.
+            bots = self.bots
+            for i, h, dmg in zip(hit, health.tolist(), damage.tolist()):
+                bots[i].health = h
+                # allow recording of inflicting damage that is greater than health of hit robot.
+                # also record damage to oneself.
+                shooter.shellDamage += dmg
+
+        d.addExplosion(src, shell.x, shell.y)
+
+
+def normalizeAngles(a):
+    """ Same as netbots_math.normalizeAngle() for an array of angles in range -2pi to 4pi. """
+    a = np.where(a < 0, a + math.pi * 2, a)
+    return np.where(a >= math.pi * 2, a - math.pi * 2, a)
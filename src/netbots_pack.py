@@ -0,0 +1,272 @@
+import struct
+
+"""
+Small, fast, pure python msgpack encoder and decoder for NetBots messages.
+
+netbots_ipc uses this when the binary msgpack package is not installed. It only handles
+the types NetBots messages are made of: dict, list, tuple, str, bytes, int, float, bool,
+and None. It is much faster than the general purpose umsgpack.py because it does not
+support extension types, options, or streaming, and it caches the encoded form of short
+strings (eg. dict keys like 'type' and 'msgID' which are in every message).
+
+Output is standard msgpack (floats are always float 64, like binary msgpack) so it can talk
+to robots and servers that use binary msgpack. Like unpackb(raw=False) in binary msgpack,
+str are decoded to str and bin to bytes. Unlike binary msgpack, int map keys are allowed
+(eg. viewData explosions are keyed by int).
+"""
+
+_uint8 = struct.Struct('>B')
+_uint16 = struct.Struct('>H')
+_uint32 = struct.Struct('>I')
+_uint64 = struct.Struct('>Q')
+_int8 = struct.Struct('>b')
+_int16 = struct.Struct('>h')
+_int32 = struct.Struct('>i')
+_int64 = struct.Struct('>q')
+_float32 = struct.Struct('>f')
+_float64 = struct.Struct('>d')
+
+# {str: bytes, ...} msgpack encoding of short str. Only str up to _strCacheLen chars are cached
+# and the cache stops growing at _strCacheMax entries so robots sending random names can't fill memory.
+_strCache = {}
+_strCacheLen = 32
+_strCacheMax = 4096
+
+
+class PackException(Exception):
+    """Raised if an object can't be packed or bytes can't be unpacked."""
+    pass
+
+
+def _packStr(s):
+    b = _strCache.get(s)
+    if b is not None:
+        return b
+
+    data = s.encode('utf-8')
+    n = len(data)
+    if n < 32:
+        b = bytes((0xa0 | n,)) + data
+    elif n < 0x100:
+        b = b'\xd9' + _uint8.pack(n) + data
+    elif n < 0x10000:
+        b = b'\xda' + _uint16.pack(n) + data
+    else:
+        b = b'\xdb' + _uint32.pack(n) + data
+
+    if len(s) <= _strCacheLen and len(_strCache) < _strCacheMax:
+        _strCache[s] = b
+    return b
+
+
+def _packInt(i):
+    if 0 <= i < 0x80:
+        return bytes((i,))
+    if -32 <= i < 0:
+        return bytes((i & 0xff,))
+    if i >= 0:
+        if i < 0x100:
+            return b'\xcc' + _uint8.pack(i)
+        if i < 0x10000:
+            return b'\xcd' + _uint16.pack(i)
+        if i < 0x100000000:
+            return b'\xce' + _uint32.pack(i)
+        if i < 0x10000000000000000:
+            return b'\xcf' + _uint64.pack(i)
+    else:
+        if i >= -0x80:
+            return b'\xd0' + _int8.pack(i)
+        if i >= -0x8000:
+            return b'\xd1' + _int16.pack(i)
+        if i >= -0x80000000:
+            return b'\xd2' + _int32.pack(i)
+        if i >= -0x8000000000000000:
+            return b'\xd3' + _int64.pack(i)
+    raise PackException("int too large to pack: " + str(i))
+
+
+def _pack(obj, out):
+    """ Append msgpack encoding of obj to list out. """
+    t = type(obj)
+    if t is str:
+        out.append(_packStr(obj))
+    elif t is float:
+        out.append(b'\xcb' + _float64.pack(obj))
+    elif t is int:
+        out.append(_packInt(obj))
+    elif t is dict:
+        n = len(obj)
+        if n < 16:
+            out.append(bytes((0x80 | n,)))
+        elif n < 0x10000:
+            out.append(b'\xde' + _uint16.pack(n))
+        else:
+            out.append(b'\xdf' + _uint32.pack(n))
+        for k, v in obj.items():
+            _pack(k, out)
+            _pack(v, out)
+    elif t is bool:
+        out.append(b'\xc3' if obj else b'\xc2')
+    elif obj is None:
+        out.append(b'\xc0')
+    elif t is list or t is tuple:
+        n = len(obj)
+        if n < 16:
+            out.append(bytes((0x90 | n,)))
+        elif n < 0x10000:
+            out.append(b'\xdc' + _uint16.pack(n))
+        else:
+            out.append(b'\xdd' + _uint32.pack(n))
+        for v in obj:
+            _pack(v, out)
+    elif t is bytes or t is bytearray:
+        n = len(obj)
+        if n < 0x100:
+            out.append(b'\xc4' + _uint8.pack(n))
+        elif n < 0x10000:
+            out.append(b'\xc5' + _uint16.pack(n))
+        else:
+            out.append(b'\xc6' + _uint32.pack(n))
+        out.append(bytes(obj))
+    # subclasses (eg. numpy floats or IntEnum) are packed as their base type.
+    elif isinstance(obj, bool):
+        out.append(b'\xc3' if obj else b'\xc2')
+    elif isinstance(obj, int):
+        out.append(_packInt(int(obj)))
+    elif isinstance(obj, float):
+        out.append(b'\xcb' + _float64.pack(obj))
+    elif isinstance(obj, str):
+        out.append(_packStr(str(obj)))
+    elif isinstance(obj, dict):
+        _pack(dict(obj), out)
+    else:
+        raise PackException("Can't pack object of type " + str(type(obj)))
+
+
+def packb(obj, **kwargs):
+    """
+    Return msgpack bytes of obj. kwargs (eg. use_bin_type) are accepted so this can be
+    called like msgpack.packb() but are ignored. str is always packed as str and bytes as bin.
+    """
+    out = []
+    _pack(obj, out)
+    return b''.join(out)
+
+
+def _unpack(b, i):
+    """ Return (obj, index after obj) for the msgpack object starting at b[i]. """
+    c = b[i]
+    i += 1
+
+    if c < 0x80:  # positive fixint
+        return c, i
+    if c >= 0xe0:  # negative fixint
+        return c - 0x100, i
+    if c < 0x90:  # fixmap
+        return _unpackMap(b, i, c & 0x0f)
+    if c < 0xa0:  # fixarray
+        return _unpackArray(b, i, c & 0x0f)
+    if c < 0xc0:  # fixstr
+        n = c & 0x1f
+        return str(b[i:i + n], 'utf-8'), i + n
+
+    if c == 0xcb:
+        return _float64.unpack_from(b, i)[0], i + 8
+    if c == 0xc0:
+        return None, i
+    if c == 0xc2:
+        return False, i
+    if c == 0xc3:
+        return True, i
+    if c == 0xcc:
+        return b[i], i + 1
+    if c == 0xcd:
+        return _uint16.unpack_from(b, i)[0], i + 2
+    if c == 0xce:
+        return _uint32.unpack_from(b, i)[0], i + 4
+    if c == 0xcf:
+        return _uint64.unpack_from(b, i)[0], i + 8
+    if c == 0xd0:
+        return _int8.unpack_from(b, i)[0], i + 1
+    if c == 0xd1:
+        return _int16.unpack_from(b, i)[0], i + 2
+    if c == 0xd2:
+        return _int32.unpack_from(b, i)[0], i + 4
+    if c == 0xd3:
+        return _int64.unpack_from(b, i)[0], i + 8
+    if c == 0xca:
+        return _float32.unpack_from(b, i)[0], i + 4
+    if c == 0xd9:
+        n = b[i]
+        i += 1
+        return str(b[i:i + n], 'utf-8'), i + n
+    if c == 0xda:
+        n = _uint16.unpack_from(b, i)[0]
+        i += 2
+        return str(b[i:i + n], 'utf-8'), i + n
+    if c == 0xdb:
+        n = _uint32.unpack_from(b, i)[0]
+        i += 4
+        return str(b[i:i + n], 'utf-8'), i + n
+    if c == 0xde:
+        return _unpackMap(b, i + 2, _uint16.unpack_from(b, i)[0])
+    if c == 0xdf:
+        return _unpackMap(b, i + 4, _uint32.unpack_from(b, i)[0])
+    if c == 0xdc:
+        return _unpackArray(b, i + 2, _uint16.unpack_from(b, i)[0])
+    if c == 0xdd:
+        return _unpackArray(b, i + 4, _uint32.unpack_from(b, i)[0])
+    if c == 0xc4:
+        n = b[i]
+        i += 1
+        return bytes(b[i:i + n]), i + n
+    if c == 0xc5:
+        n = _uint16.unpack_from(b, i)[0]
+        i += 2
+        return bytes(b[i:i + n]), i + n
+    if c == 0xc6:
+        n = _uint32.unpack_from(b, i)[0]
+        i += 4
+        return bytes(b[i:i + n]), i + n
+
+    raise PackException("Can't unpack msgpack type 0x%02x" % c)
+
+
+def _unpackMap(b, i, n):
+    d = {}
+    for x in range(n):
+        c = b[i]
+        if 0xa0 <= c < 0xc0:
+            # keys are almost always short str so decode fixstr here instead of calling _unpack().
+            j = i + 1 + (c & 0x1f)
+            k = str(b[i + 1:j], 'utf-8')
+            i = j
+        else:
+            k, i = _unpack(b, i)
+        d[k], i = _unpack(b, i)
+    return d, i
+
+
+def _unpackArray(b, i, n):
+    a = []
+    for x in range(n):
+        v, i = _unpack(b, i)
+        a.append(v)
+    return a, i
+
+
+def unpackb(b, **kwargs):
+    """
+    Return object from msgpack bytes b (bytes, bytearray or memoryview). kwargs (eg. raw=False)
+    are accepted so this can be called like msgpack.unpackb() but are ignored.
+    """
+    if type(b) is memoryview:
+        # Indexing and slicing a memoryview in python is slower than copying a msg sized one to bytes.
+        b = b.tobytes()
+    try:
+        obj, i = _unpack(b, 0)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise PackException("Can't unpack truncated or invalid msgpack bytes: " + str(e))
+    if i != len(b):
+        raise PackException("Extra bytes after msgpack object.")
+    return obj
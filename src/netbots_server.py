@@ -6,212 +6,261 @@ import random
 import math
 import itertools
 import json
+import functools
+import os
+import selectors
 
 from netbots_log import log
 from netbots_log import setLogLevel
 import netbots_ipc as nbipc
 import netbots_srvmsghl as nbmsghl
 import netbots_math as nbmath
+import netbots_entities as nbent
+import netbots_netem as nbnetem
+
+try:
+    import netbots_npengine as nbnpengine
+except ImportError:
+    # numpy is not installed so only the dict engine can be used.
+    nbnpengine = None
 
 ########################################################
 # Server Data
 ########################################################
 
 
+class ClassValues:
+    """
+    Values from SrvData.conf['classFields'] for one robot class, resolved with
+    SrvData.getClassValue(). The step loop reads these instead of calling
+    getClassValue() for every bot every step.
+    """
+    __slots__ = ('botMaxSpeed', 'botAccRate', 'botMinTurnRate', 'botMaxTurnRate',
+                 'botArmor', 'shellSpeed', 'explDamage', 'explRadius')
+
+    def __init__(self, d, c):
+        for fld in self.__slots__:
+            setattr(self, fld, d.getClassValue(fld, c))
+
+
 class SrvData:
-    srvSocket = None
-
-    conf = {
-        # Static vars (some are settable at start up by server command line switches and then do not change after that.)
-        'serverName': "NetBot Server",
-        'serverVersion': "2.2.0",
-
-        # Game and Tournament
-        'botsInGame': 4,  # Number of bots required to join before game can start.
-        'gamesToPlay': 10,  # Number of games to play before server quits.
-        'stepMax': 1000,  # After this many steps in a game all bots will be killed
-        # Amount of time server targets for each step. Server will sleep if game is running faster than this.
-        'stepSec': 0.05,
-        'startPermutations':  False,  # Use all permutations of each set of random start locations.
-        'simpleCollisions': False,  # Use simple collision system, affected by -hitdamage
-        'scanMaxDistance': 1415,  # Maximum distance a scan can detect a robot.
-
-        # Messaging
-        'dropRate': 11,  # Drop a messages every N messages. Best to use primes.
-        # Number of msgs from a bot that server will respond to each step. Others in Q will be dropped.
-        'botMsgsPerStep': 4,
-        'allowRejoin': True,  # Allows crashed bots to rejoin game in progress.
-        'noViewers': False,  # if True addViewerRequest messages will be rejected. 
-
-        # Sizes
-        # Area is a square with each side = arenaSize units (0,0 is bottom left,
-        # positive x is to right and positive y is up.)
-        'arenaSize': 1000,
-        'botRadius': 25,  # bots are circles with radius botRadius
-        'explRadius': 75,  # Radius of shell explosion. Beyond this radius bots will not take any damage.
-
-        # Speeds and Rates of Change
-        'botMaxSpeed': 5,  # bots distance traveled per step at 100% speed
-        'botAccRate': 2.0,  # Amount in % bot can accelerate (or decelerate) per step
-        'shellSpeed': 40,  # distance traveled by shell per step
-        'botMinTurnRate': math.pi / 6000,  # Amount bot can rotate per turn in radians at 100% speed
-        'botMaxTurnRate': math.pi / 50,  # Amount bot can rotate per turn in radians at 0% speed
-
-        # Damage
-        'hitDamage': 10,  # Damage a bot takes from hitting wall or another bot
-        # Damage bot takes from direct hit from shell. The further from shell explosion will result in less damage.
-        'explDamage': 10,
-        'botArmor': 1.0,  # Damage multiplier
-
-        # Obstacles (robots and shells are stopped by obstacles but obstacles are transparent to scan)
-        'obstacles': [],  # Obstacles of form [{'x':float,'y':float,'radius':float},...]
-        'obstacleRadius': 5,  # Radius of obstacles as % of arenaSize
-
-        # Jam Zones (robots fully inside jam zone are not detected by scan)
-        'jamZones': [],  # Jam Zones of form [{'x':float,'y':float,'radius':float},...]
-
-        # Misc
-        'keepExplosionSteps': 10,  # Number of steps to keep old explosions in explosion dict (only useful to viewers).
-        'maxSecsToJoin': 300,  # Number of secs server will wait for botsInGame bots to join before timeout and quit.
-
-        #Robot Classes (values below override what's above for robots in that class)
-        'allowClasses': False,
-        #Only fields listed in classFields are allowed to be overwritten by classes.
-        'classFields': ('botMaxSpeed', 'botAccRate', 'botMinTurnRate', 'botMaxTurnRate', 'botArmor', 'shellSpeed', 'explDamage', 'explRadius'),
-        'classes': {
-            'default': {
-                # Default class should have no changes.
-                },
+    """
+    All data for one arena (game) run by the server. Each SrvData instance has its own
+    conf, state, bots, shells, etc. so more than one can be used in the same process.
+    """
+
+    def __init__(self):
+        self.srvSocket = None
+        self.botGrid = None  # BotGrid of alive bots, kept between steps so it can be updated incrementally.
+        self.scanCache = None  # netbots_srvmsghl.ScanCache for this step, built by the first scanRequest.
+        self.engine = None  # None uses the dict based step functions below, otherwise an engine object (eg. netbots_npengine)
+        self.netem = None  # netbots_netem.NetEm shared by all arenas when network emulation is on (see mkNetEm()).
+
+        self.conf = {
+            # Static vars (some are settable at start up by server command line switches and then do not change after that.)
+            'serverName': "NetBot Server",
+            'serverVersion': "2.2.0",
+
+            # Game and Tournament
+            'botsInGame': 4,  # Number of bots required to join before game can start.
+            'gamesToPlay': 10,  # Number of games to play before server quits.
+            'stepMax': 1000,  # After this many steps in a game all bots will be killed
+            # Amount of time server targets for each step. Server will sleep if game is running faster than this.
+            'stepSec': 0.05,
+            'startPermutations':  False,  # Use all permutations of each set of random start locations.
+            'simpleCollisions': False,  # Use simple collision system, affected by -hitdamage
+            'scanMaxDistance': 1415,  # Maximum distance a scan can detect a robot.
+            'collisionIterations': 20,  # Max times each step the server will move overlapping bots apart.
+            'arenas': 1,  # Number of arenas (games) the server runs at the same time.
+            'arenaNumber': 1,  # Number of this arena, 1 to arenas.
+
+            # Messaging
+            'dropRate': 11,  # Drop a messages every N messages. Best to use primes.
+            # Network emulation (see netbots_netem.py). If any of these are set then dropRate is not used.
+            'netLoss': 0.0,  # % of msgs to and from each bot that are lost.
+            'netBurst': [0.0, 0.0],  # % chance for each msg that a burst of lost msgs starts and ends.
+            'netLatency': 0.0,  # secs msgs to and from bots are delayed.
+            'netJitter': 0.0,  # msgs are delayed a random 0 to netJitter secs more than netLatency.
+            'netBandwidth': 0,  # bytes/sec the server can send to each bot. 0 is unlimited.
+            'netSeed': None,  # seed for network emulation losses and jitter. None is random.
+            # Number of msgs from a bot that server will respond to each step. The next botMsgsPerStep msgs
+            # are held and answered in the next step. Any more are dropped.
+            'botMsgsPerStep': 4,
+            # Max msgs/sec and burst of msgs the server reads from each bot or viewer. Others are
+            # skipped before they are decoded (see NetBotSocket.setRateLimit()). 0 is no limit.
+            'botRate': 0.0,
+            'botBurst': 8,
+            # If True, step as soon as all alive bots send a request with endTurn == True. stepSec is then
+            # the max time to wait for bots.
+            'lockStep': False,
+            # Number of recent replies kept for each bot so a resent request (same msgID) gets the same
+            # reply again without being processed twice.
+            'replyCacheSize': 8,
+            'allowRejoin': True,  # Allows crashed bots to rejoin game in progress.
+            'noViewers': False,  # if True addViewerRequest messages will be rejected. 
+
+            # Sizes
+            # Area is a square with each side = arenaSize units (0,0 is bottom left,
+            # positive x is to right and positive y is up.)
+            'arenaSize': 1000,
+            'botRadius': 25,  # bots are circles with radius botRadius
+            'explRadius': 75,  # Radius of shell explosion. Beyond this radius bots will not take any damage.
+
+            # Speeds and Rates of Change
+            'botMaxSpeed': 5,  # bots distance traveled per step at 100% speed
+            'botAccRate': 2.0,  # Amount in % bot can accelerate (or decelerate) per step
+            'shellSpeed': 40,  # distance traveled by shell per step
+            'botMinTurnRate': math.pi / 6000,  # Amount bot can rotate per turn in radians at 100% speed
+            'botMaxTurnRate': math.pi / 50,  # Amount bot can rotate per turn in radians at 0% speed
+
+            # Damage
+            'hitDamage': 10,  # Damage a bot takes from hitting wall or another bot
+            # Damage bot takes from direct hit from shell. The further from shell explosion will result in less damage.
+            'explDamage': 10,
+            'botArmor': 1.0,  # Damage multiplier
+
+            # Obstacles (robots and shells are stopped by obstacles but obstacles are transparent to scan)
+            'obstacles': [],  # Obstacles of form [{'x':float,'y':float,'radius':float},...]
+            'obstacleRadius': 5,  # Radius of obstacles as % of arenaSize
+
+            # Jam Zones (robots fully inside jam zone are not detected by scan)
+            'jamZones': [],  # Jam Zones of form [{'x':float,'y':float,'radius':float},...]
+
+            # Misc
+            'keepExplosionSteps': 10,  # Number of steps to keep old explosions in explosion dict (only useful to viewers).
+            'maxSecsToJoin': 300,  # Number of secs server will wait for botsInGame bots to join before timeout and quit.
+
+            #Robot Classes (values below override what's above for robots in that class)
+            'allowClasses': False,
+            #Only fields listed in classFields are allowed to be overwritten by classes.
+            'classFields': ('botMaxSpeed', 'botAccRate', 'botMinTurnRate', 'botMaxTurnRate', 'botArmor', 'shellSpeed', 'explDamage', 'explRadius'),
+            'classes': {
+                'default': {
+                    # Default class should have no changes.
+                    },
                 
-            'heavy': {
-                # Speeds and Rates of Change
-                'botMaxSpeed': 0.7,  # multiplier for bot max speed
-                'botAccRate': 0.55,  # multiplier for bot acceleration rate
-                'botMinTurnRate': 0.923076923,  # multiplier for bot turning rate at 100% speed
-                'botMaxTurnRate': 0.333333333,  # multiplier for bot turning rate at 0% speed
-                'botArmor': 0.862  # multiplier of robot damage taken
-                },
+                'heavy': {
+                    # Speeds and Rates of Change
+                    'botMaxSpeed': 0.7,  # multiplier for bot max speed
+                    'botAccRate': 0.55,  # multiplier for bot acceleration rate
+                    'botMinTurnRate': 0.923076923,  # multiplier for bot turning rate at 100% speed
+                    'botMaxTurnRate': 0.333333333,  # multiplier for bot turning rate at 0% speed
+                    'botArmor': 0.862  # multiplier of robot damage taken
+                    },
             
-            'light': {
-                # Speeds and Rates of Change
-                'botMaxSpeed': 2.8,  # multiplier for bot max speed
-                'botAccRate': 1.6,  # multiplier for bot acceleration rate
-                'botMinTurnRate': 1.4,  # multiplier for bot turning rate at 100% speed
-                'botMaxTurnRate': 1.75,  # multiplier for bot turning rate at 0% speed
-                'botArmor': 1.25  # multiplier of robot damage taken
-                },
+                'light': {
+                    # Speeds and Rates of Change
+                    'botMaxSpeed': 2.8,  # multiplier for bot max speed
+                    'botAccRate': 1.6,  # multiplier for bot acceleration rate
+                    'botMinTurnRate': 1.4,  # multiplier for bot turning rate at 100% speed
+                    'botMaxTurnRate': 1.75,  # multiplier for bot turning rate at 0% speed
+                    'botArmor': 1.25  # multiplier of robot damage taken
+                    },
                 
-            'machinegun': {
-                # Speeds and Rates of Change
-                'botMaxSpeed': 1.4,  # multiplier for bot max speed
-                'botAccRate': 1.2,  # multiplier for bot acceleration rate
-                'botMinTurnRate': 1.2,  # multiplier for bot turning rate at 100% speed
-                'botMaxTurnRate': 1.6,  # multiplier for bot turning rate at 0% speed
-                'botArmor': 0.93,  # multiplier of robot damage taken
-                'shellSpeed': 30,  # multiplier of distance traveled by shell per step
-                'explDamage': 0.237,
-                'explRadius': 1.1
-                },
+                'machinegun': {
+                    # Speeds and Rates of Change
+                    'botMaxSpeed': 1.4,  # multiplier for bot max speed
+                    'botAccRate': 1.2,  # multiplier for bot acceleration rate
+                    'botMinTurnRate': 1.2,  # multiplier for bot turning rate at 100% speed
+                    'botMaxTurnRate': 1.6,  # multiplier for bot turning rate at 0% speed
+                    'botArmor': 0.93,  # multiplier of robot damage taken
+                    'shellSpeed': 30,  # multiplier of distance traveled by shell per step
+                    'explDamage': 0.237,
+                    'explRadius': 1.1
+                    },
                 
-            'sniper': {
-                # Speeds and Rates of Change
-                'botMaxSpeed': 1,  # multiplier for bot max speed
-                'botAccRate': 0.7,  # multiplier for bot acceleration rate
-                'botMinTurnRate': 1,  # multiplier for bot turning rate at 100% speed
-                'botMaxTurnRate': 0.8,  # multiplier for bot turning rate at 0% speed
-                'botArmor': 1.1,  # multiplier of robot damage taken
-                'shellSpeed': 3,  # multiplier of distance traveled by shell per step
-                'explDamage': 2.85,
-                'explRadius': 0.4
-                },
+                'sniper': {
+                    # Speeds and Rates of Change
+                    'botMaxSpeed': 1,  # multiplier for bot max speed
+                    'botAccRate': 0.7,  # multiplier for bot acceleration rate
+                    'botMinTurnRate': 1,  # multiplier for bot turning rate at 100% speed
+                    'botMaxTurnRate': 0.8,  # multiplier for bot turning rate at 0% speed
+                    'botArmor': 1.1,  # multiplier of robot damage taken
+                    'shellSpeed': 3,  # multiplier of distance traveled by shell per step
+                    'explDamage': 2.85,
+                    'explRadius': 0.4
+                    },
                 
-            'turtle': {
-                # Speeds and Rates of Change
-                'botMaxSpeed': 0.5,  # multiplier for bot max speed
-                'botAccRate': 0.15,  # multiplier for bot acceleration rate
-                'botMinTurnRate': 0.6,  # multiplier for bot turning rate at 100% speed
-                'botMaxTurnRate': 0.5,  # multiplier for bot turning rate at 0% speed
-                'botArmor': 0.83,  # multiplier of robot damage taken
-                'shellSpeed': 0.38,  # multiplier of distance traveled by shell per step
-                'explDamage': 2.8,
-                'explRadius': 1.6
+                'turtle': {
+                    # Speeds and Rates of Change
+                    'botMaxSpeed': 0.5,  # multiplier for bot max speed
+                    'botAccRate': 0.15,  # multiplier for bot acceleration rate
+                    'botMinTurnRate': 0.6,  # multiplier for bot turning rate at 100% speed
+                    'botMaxTurnRate': 0.5,  # multiplier for bot turning rate at 0% speed
+                    'botArmor': 0.83,  # multiplier of robot damage taken
+                    'shellSpeed': 0.38,  # multiplier of distance traveled by shell per step
+                    'explDamage': 2.8,
+                    'explRadius': 1.6
+                    }
                 }
             }
-        }
 
-    state = {
-        # Dynamic vars (Note, these are not shared with robots so we also store server only conf here.)
-        'gameNumber': 0,
-        'gameStep': 0,
-        'dropNext': 10,  # Drop the next message in N (count down)
-        'dropCount': 0,  # How many messages have been dropped since start up.
-        'serverSteps': 0,  # Number of steps server has processed.
-        'stepTime': 0,  # Total time spent process steps
-        'msgTime': 0,  # Total time spent processing messages
-        'viewerMsgTime': 0,  # Total time spend sending information to the viewer
-        'startTime': time.time(),
-        'explIndex': 0,
-        'sleepTime': 0,
-        'sleepCount': 0,
-        'longStepCount': 0,
-        'tourStartTime': False,
-
-        # Server only conf which we don't want to share with robots
-        'onlyLastSb': False,  # Only print the scoreboard when the server quits, rather than after every game.
-        'jsonScoreboard': False,  # Save json formatted server data to filename before quiting.
-        }
-
-    starts = []  # [ [locIndex, locIndex, ...], [locIndex, locIndex, ...], ...]
-    startLocs = []  # [{'x': x, 'y' y},{'x': x, 'y' y},...]
-    startBots = []  # [src, src, ...]
-
-    bots = {}
-    botTemplate = {
-        'name': "template",
-        'class': "default",
-        'health': 0,
-        'x': 500,
-        'y': 500,
-        'currentSpeed': 0,
-        'requestedSpeed': 0,
-        'currentDirection': 0,
-        'requestedDirection': 0,
-        'points': 0,
-        'firedCount': 0,
-        'shellDamage': 0,
-        'missedSteps': 0,
-        'winHealth': 0,
-        'winCount': 0,
-        'last': {
-            # Copies of last fire and scan requests. This data is not stored elsewhere
-            # and is useful for viewer to display.
-            'fireCanonRequest': {'direction': 0, 'distance': 10},
-            'scanRequest': {'startRadians': 0, 'endRadians': 0},
+        self.state = {
+            # Dynamic vars (Note, these are not shared with robots so we also store server only conf here.)
+            'gameNumber': 0,
+            'gameStep': 0,
+            'dropNext': 10,  # Drop the next message in N (count down)
+            'dropCount': 0,  # How many messages have been dropped since start up.
+            'dupCount': 0,  # How many resent requests were answered from the reply cache.
+            # Msgs lost before the server could receive them, for the whole server socket. Only updated for -jsonsb.
+            'kernelDropCount': None,  # Dropped by the OS because the receive buffer was full. None if not known.
+            'recvQueueDropCount': 0,  # Dropped by -recvthread because its queue was full.
+            'serverSteps': 0,  # Number of steps server has processed.
+            'stepTime': 0,  # Total time spent process steps
+            'msgTime': 0,  # Total time spent processing messages
+            'msgsIn': 0,  # Number of messages received for this arena.
+            'msgsOut': 0,  # Number of messages sent by this arena (including to viewers).
+            'viewerMsgTime': 0,  # Total time spend sending information to the viewer
+            'startTime': time.time(),
+            'explIndex': 0,
+            'sleepTime': 0,
+            'sleepCount': 0,
+            'longStepCount': 0,
+            'collisionIterations': 0,  # Total collision iterations over all steps.
+            'maxCollisionIterations': 0,  # Most collision iterations needed in one step.
+            'collisionLimitCount': 0,  # Number of steps that used conf['collisionIterations'] iterations.
+            'tourStartTime': False,
+            'arenaFinished': False,  # True once this arena has played all games or could not start.
+
+            # Server only conf which we don't want to share with robots
+            'onlyLastSb': False,  # Only print the scoreboard when the server quits, rather than after every game.
+            'jsonScoreboard': False,  # Save json formatted server data to filename before quiting.
             }
-        }
 
-    shells = {}
-    shellTemplate = {
-        'x': 500,
-        'y': 500,
-        'direction': 0,
-        'distanceRemaining': 100
-        }
+        self.starts = []  # [ [locIndex, locIndex, ...], [locIndex, locIndex, ...], ...]
+        self.startLocs = []  # [Location, Location, ...]
+        self.startBots = []  # [src, src, ...]
 
-    explosions = {}
-    explosionTemplate = {
-        'x': 500,
-        'y': 500,
-        'stepsAgo': 0,
-        'src': ""  # this is needed by viewer to color this explosion
-        }
+        self.bots = {}  # {src: netbots_entities.Bot, ...}
+        self.classValuesTable = {}  # {class: ClassValues, ...}
+        self.classValuesConf = None  # conf values classValuesTable was built from.
 
-    viewers = {}
-    viewerTemplate = {
-        'lastKeepAlive': time.time(),
-        'ip': "0.0.0.0",
-        'port': 20011
-        }
+        self.shells = {}  # {src: netbots_entities.Shell, ...}
+
+        self.explosions = {}  # {explIndex: netbots_entities.Explosion, ...}
+
+        self.botMsgCount = {}  # {src: int, ...} number of msgs from each bot this step.
+        self.recvQueue = []  # [(msg, ip, port), ...] list reused by recvReplyMsgs() to receive msgs into.
+        self.heldMsgs = []  # [(msg, ip, port, src), ...] msgs over botMsgsPerStep held until next step.
+        self.endTurnBots = set()  # {src, ...} bots that have sent a msg with endTurn == True this step.
+        # {src: {msgID: (msg, bytes), ...}, ...} last replyCacheSize requests from each bot and their serialized replies.
+        self.replyCache = {}
+
+        # {src: {'ip': str, 'port': int, 'everySteps': int}, ...} bots that sent subscribeRequest.
+        self.subscribers = {}
+
+        self.viewers = {}
+        self.viewerTemplate = {
+            'lastKeepAlive': time.time(),
+            'ip': "0.0.0.0",
+            'port': 20011
+            }
+
+    def logPrefix(self):
+        """ Return prefix for log messages so messages from different arenas can be told apart. """
+        if self.conf['arenas'] > 1:
+            return "Arena " + str(self.conf['arenaNumber']) + ": "
+        return ""
 
     def getClassValue(self, fld, c="default"):
         """
@@ -231,6 +280,39 @@ class SrvData:
         
         return value
 
+    def getClassValues(self, c="default"):
+        """
+        Return the ClassValues record for class c. Records are built once and reused
+        until updateClassValues() finds that conf has changed.
+        """
+        if c not in self.classValuesTable:
+            self.classValuesTable[c] = ClassValues(self, c)
+        return self.classValuesTable[c]
+
+    def updateClassValues(self):
+        """
+        Rebuild the class values table if conf has changed since it was built and set
+        the ClassValues record of every bot.
+        """
+        confValues = repr([self.conf[fld] for fld in self.conf['classFields']] + [self.conf['classes']])
+        if confValues != self.classValuesConf:
+            self.classValuesConf = confValues
+            self.classValuesTable = {}
+
+        for bot in self.bots.values():
+            bot.classValues = self.getClassValues(bot.botClass)
+
+    def addExplosion(self, src, x, y):
+        """
+        Store an explosion at x, y from a shell fired by src so viewers can display it.
+        """
+        # we can't use src as index because it is possible for two explosions
+        # from same bot to exist (but not likly).
+        self.explosions[self.state['explIndex']] = nbent.Explosion(x, y, src)
+        self.state['explIndex'] += 1
+        if self.state['explIndex'] > 65000:
+            self.state['explIndex'] = 0
+
 ########################################################
 # Bot Message Processing
 ########################################################
@@ -244,14 +326,20 @@ def processMsg(d, msg, src):
     elif msg['type'] == 'viewKeepAlive':
         reply = nbmsghl.viewKeepAlive(d, msg, src)
     elif src in d.bots:  # all other messages are only allowed from bots that have joined the game
+        if msg['type'] == 'batchRequest':
+            reply = processBatch(d, msg, src)
         # if this is a message type suppored by server
-        if hasattr(nbmsghl, msg['type']):
+        elif hasattr(nbmsghl, msg['type']):
             reply = getattr(nbmsghl, msg['type'])(d, msg, src)
         else:
             reply = {'type': 'Error', 'result': "Msg type '" + msg['type'] + "' should not be sent to server."}
     else:
         reply = {'type': 'Error', 'result': "Bots that have not joined game may only send joinRequest Msg."}
 
+    # bot has sent its last request for this step.
+    if 'endTurn' in msg and msg['endTurn'] and src in d.bots:
+        d.endTurnBots.add(src)
+
     # if the msg carried a msgId or replyData then copy it to the reply
     if reply:
         if 'msgID' in msg:
@@ -262,8 +350,37 @@ def processMsg(d, msg, src):
     return reply
 
 
-def dropMessage(d):
-    """Returns True is the server should drop the next message"""
+def processBatch(d, msg, src):
+    """
+    Process each request in batchRequest msg, in order, and return a batchReply with a reply (or Error)
+    for each. All requests are processed together so they see the same step. Each request counts as one
+    msg towards botMsgsPerStep (see msgWeight()) so a batch may not hold more than botMsgsPerStep requests.
+    """
+    if len(msg['requests']) > d.conf['botMsgsPerStep']:
+        return {'type': 'Error', 'result': "batchRequest may contain at most " + str(d.conf['botMsgsPerStep']) + " requests."}
+
+    replies = []
+    for request in msg['requests']:
+        if not nbipc.isValidMsg(request):
+            reply = {'type': 'Error', 'result': "Request in batchRequest is not a valid msg."}
+        elif request['type'] in ('joinRequest', 'addViewerRequest', 'batchRequest') or \
+                not request['type'].endswith('Request'):
+            reply = {'type': 'Error', 'result': "Msg type '" + request['type'] + "' can't be sent in batchRequest."}
+        else:
+            reply = processMsg(d, request, src)
+        replies.append(reply)
+
+    return {'type': 'batchReply', 'replies': replies}
+
+
+def dropMessage(d, src=None):
+    """Returns True is the server should drop the next message (to or from src)"""
+    if d.netem is not None:
+        if d.netem.lose(src):
+            d.state['dropCount'] += 1
+            return True
+        return False
+
     if d.conf['dropRate'] != 0:
         if d.state['dropNext'] == 0:
             d.state['dropNext'] = d.conf['dropRate']
@@ -274,51 +391,329 @@ def dropMessage(d):
     return False
 
 
-def recvReplyMsgs(d):
+def findArena(arenas, routes, msg, src):
+    """
+    Return the arena (SrvData) from arenas that should process msg from src, or None if
+    no arena can accept it. routes is {src: SrvData, ...} of bots and viewers that have
+    already joined an arena.
+    """
+    d = routes.get(src)
+    if d is not None and (src in d.bots or src in d.viewers):
+        return d
+
+    if len(arenas) == 1:
+        return arenas[0]
+
+    if msg['type'] in ('joinRequest', 'addViewerRequest') and 'arena' in msg:
+        if msg['arena'] > len(arenas):
+            return None
+        return arenas[msg['arena'] - 1]
+
+    if msg['type'] == 'joinRequest':
+        # lobby, put bot in the first arena that is still waiting for bots to join.
+        for d in arenas:
+            if len(d.bots) < d.conf['botsInGame'] and d.state['gameNumber'] == 0 and not d.state['arenaFinished']:
+                return d
+        return None
+
+    # viewers without an arena watch the first arena and the first arena replies with an
+    # error to all other messages from bots that have not joined.
+    return arenas[0]
+
+
+def recvReplyMsgs(arenas, routes):
     # process all messages in socket recv buffer
+    srvSocket = arenas[0].srvSocket
     startTime = time.perf_counter()
-    msgQ = []
-    more = True
-    while more:
-        try:
-            msgQ.append(d.srvSocket.recvMessage())
-        except nbipc.NetBotSocketException as e:
-            more = False
-        except Exception as e:
-            log(str(type(e)) + " " + str(e), "ERROR")
-            more = False
+    msgQ = fairOrder(srvSocket.recvMessages(msgs=arenas[0].recvQueue))
+    recvTime = (time.perf_counter() - startTime) / max(1, len(msgQ))
+
+    netem = arenas[0].netem
+    if netem is not None and netem.delays:
+        now = time.perf_counter()
+        for msg, ip, port in msgQ:
+            src = srvSocket.peerName(ip, port)
+            netem.schedule(src, 0, now, deliverMsg, arenas, routes, msg, ip, port, src, recvTime)
+        return
 
-    botMsgCount = {}
     for msg, ip, port in msgQ:
+        deliverMsg(arenas, routes, msg, ip, port, srvSocket.peerName(ip, port), recvTime)
 
-        src = nbipc.formatIpPort(ip, port)
 
-        # Track src counter and drop msg if we have already proccessed the max msgs for this src this step
-        if src in botMsgCount:
-            botMsgCount[src] += 1
+def fairOrder(msgQ):
+    """
+    Return msgQ ([(msg, ip, port), ...]) reordered round-robin by sender: the first msg from
+    each sender, in the order they first arrived, then the second msg from each, and so on.
+    This stops a bot that sends many msgs at once from delaying the replies to other bots.
+    Each sender's msgs stay in the order they arrived.
+    """
+    queues = {}  # {(ip, port): [(msg, ip, port), ...], ...}
+    for item in msgQ:
+        address = (item[1], item[2])
+        q = queues.get(address)
+        if q is None:
+            queues[address] = [item]
         else:
-            botMsgCount[src] = 1
-        if botMsgCount[src] > d.conf['botMsgsPerStep']:
-            continue
-        
-        if dropMessage(d):
+            q.append(item)
+    if len(queues) == len(msgQ):
+        # one msg from each sender (the usual case) is already fair.
+        return msgQ
+    return [item for items in itertools.zip_longest(*queues.values()) for item in items if item is not None]
+
+
+def deliverMsg(arenas, routes, msg, ip, port, src, recvTime=0):
+    """ Find the arena for msg from src and reply to it. recvTime is added to the arena's msgTime. """
+    startTime = time.perf_counter()
+
+    d = findArena(arenas, routes, msg, src)
+    if d is None:
+        reply = {'type': 'Error', 'result': "Arena does not exist or no arena is waiting for bots to join."}
+        if 'msgID' in msg:
+            reply['msgID'] = msg['msgID']
+        try:
+            arenas[0].srvSocket.sendMessage(reply, ip, port)
+        except Exception as e:
+            log(str(e), "ERROR")
+        return
+
+    replyMsg(d, msg, ip, port, src)
+    if msg['type'] in ('joinRequest', 'addViewerRequest') and (src in d.bots or src in d.viewers):
+        routes[src] = d
+
+    d.state['msgTime'] += recvTime + time.perf_counter() - startTime
+
+
+def serviceNetEm(arenas):
+    """ Deliver msgs delayed by network emulation that are now due. """
+    netem = arenas[0].netem
+    if netem is not None and netem.heap:
+        netem.service(time.perf_counter())
+
+
+def countMissedSteps(arenas):
+    """
+    Call once at the end of each step. Count a missed step for every bot that did not
+    send a message this step and reset message counts and ended turns for the next step.
+    """
+    for d in arenas:
+        # Don't count missed steps while waiting for bots to join or after all games are played.
+        if d.state['gameNumber'] > 0 and not d.state['arenaFinished']:
+            for src, bot in d.bots.items():
+                if src not in d.botMsgCount:
+                    bot.missedSteps += 1
+        d.botMsgCount = {}
+        d.endTurnBots = set()
+
+
+def turnsEnded(arenas):
+    """
+    Return True if -lockstep is on and all arenas can step without waiting for stepSec.
+    An arena can step when every alive bot has ended its turn or has already sent
+    botMsgsPerStep msgs this step (any more msgs will be held until the next step anyway).
+    Arenas waiting for bots to join never end the wait early.
+    """
+    if not arenas[0].conf['lockStep']:
+        return False
+
+    for d in arenas:
+        if d.state['arenaFinished']:
             continue
+        if len(d.bots) < d.conf['botsInGame']:
+            return False
+        for src, bot in d.bots.items():
+            if bot.health != 0 and src not in d.endTurnBots and \
+                    d.botMsgCount.get(src, 0) < d.conf['botMsgsPerStep']:
+                return False
 
-        reply = processMsg(d, msg, src)
-        if reply:
-            if dropMessage(d):
+    return True
+
+
+def waitForNextStep(arenas, routes, sel, nextStepAt):
+    """
+    Wait until nextStepAt, replying to messages as soon as they arrive. With -lockstep
+    the wait ends early once all bots have ended their turn. sel is a selector with the
+    server socket registered for reading. Returns the time (time.perf_counter()) the
+    wait ended.
+    """
+    ptime = time.perf_counter()
+    if ptime >= nextStepAt or turnsEnded(arenas):
+        return ptime
+
+    netem = arenas[0].netem
+    sleepTime = 0
+    while ptime < nextStepAt:
+        # wake up when the next msg delayed by network emulation is due, if that is before the next step.
+        wakeAt = nextStepAt
+        if netem is not None and netem.heap and netem.heap[0][0] < wakeAt:
+            wakeAt = netem.heap[0][0]
+        ready = sel.select(wakeAt - ptime)
+        sleepTime += time.perf_counter() - ptime
+        if ready:
+            recvReplyMsgs(arenas, routes)
+        serviceNetEm(arenas)
+        ptime = time.perf_counter()
+        if turnsEnded(arenas):
+            break
+
+    for d in arenas:
+        d.state['sleepCount'] += 1
+        d.state['sleepTime'] += sleepTime
+
+    return ptime
+
+
+def msgWeight(d, msg):
+    """ Return number of msgs msg counts as towards botMsgsPerStep. A batchRequest counts once for each request in it. """
+    if msg['type'] == 'batchRequest':
+        # processBatch() rejects batches with more than botMsgsPerStep requests.
+        return max(1, min(len(msg['requests']), d.conf['botMsgsPerStep']))
+    return 1
+
+
+def replyMsg(d, msg, ip, port, src):
+    """ Process msg from src in arena d and send the reply. """
+    d.state['msgsIn'] += 1
+
+    # Track src counter. If msg would take src over the max msgs for this step then hold msg until
+    # the next step. Only botMsgsPerStep msgs are held, others are dropped.
+    count = d.botMsgCount.get(src, 0) + msgWeight(d, msg)
+    d.botMsgCount[src] = count
+    if count > d.conf['botMsgsPerStep'] * 2:
+        return
+    if count > d.conf['botMsgsPerStep']:
+        d.heldMsgs.append((msg, ip, port, src))
+        return
+
+    sendReply(d, msg, ip, port, src)
+
+
+def replyHeldMsgs(arenas):
+    """
+    Reply to msgs held in the last step because their bot had already sent botMsgsPerStep
+    msgs. Call after each step so held msgs count towards the new step. A held batchRequest
+    that does not fit in what is left of the new step is held again.
+    """
+    for d in arenas:
+        heldMsgs = d.heldMsgs
+        d.heldMsgs = []
+        for held in heldMsgs:
+            msg, ip, port, src = held
+            startTime = time.perf_counter()
+            count = d.botMsgCount.get(src, 0) + msgWeight(d, msg)
+            if count > d.conf['botMsgsPerStep']:
+                d.heldMsgs.append(held)
                 continue
-            try:
-                d.srvSocket.sendMessage(reply, ip, port)
-            except Exception as e:
-                log(str(e), "ERROR")
+            d.botMsgCount[src] = count
+            sendReply(d, msg, ip, port, src)
+            d.state['msgTime'] += time.perf_counter() - startTime
+
+
+def sendReply(d, msg, ip, port, src):
+    """ Process msg from src in arena d and send the reply, unless dropMessage() drops them. """
+    if dropMessage(d, src):
+        return
+
+    networkbytes = cachedReply(d, msg, src)
+    if networkbytes is None:
+        reply = processMsg(d, msg, src)
+        if not reply:
+            return
+        try:
+            networkbytes = d.srvSocket.packMessage(reply, ip, port)
+        except Exception as e:
+            log(str(e), "ERROR")
+            return
+        # cache the reply even if it is dropped below, that is when the bot will resend the request.
+        cacheReply(d, msg, src, networkbytes)
+
+    if dropMessage(d, src):
+        return
+    sendPacked(d, networkbytes, ip, port, src)
+
+
+def sendPacked(d, networkbytes, ip, port, src):
+    """
+    Send networkbytes to bot src at ip:port now or, with network emulation delays, when the
+    emulated network delivers it.
+    """
+    if d.netem is not None and d.netem.delays:
+        if not d.netem.schedule(src, len(networkbytes), time.perf_counter(), sendNow, d, networkbytes, ip, port):
+            d.state['dropCount'] += 1
+    else:
+        sendNow(d, networkbytes, ip, port)
+
 
-    if d.state['gameNumber'] > 0: # Don't count missed steps while waiting for bots to join.
-        for src in d.bots:
-            if src not in botMsgCount:
-                d.bots[src]['missedSteps'] += 1
+def sendNow(d, networkbytes, ip, port):
+    try:
+        d.srvSocket.sendMessage(networkbytes, ip, port, packedAndChecked=True)
+        d.state['msgsOut'] += 1
+    except Exception as e:
+        log(str(e), "ERROR")
+
+
+def cachedReply(d, msg, src):
+    """
+    Return the serialized reply already sent for msg if msg is a resend (same msgID and contents)
+    of a recent request from bot src, otherwise None. Robots resend requests when the request or
+    reply is dropped, so the request must not be processed again (eg. fire a second shell).
+    """
+    if 'msgID' not in msg or src not in d.replyCache:
+        return None
+    cached = d.replyCache[src].get(msg['msgID'])
+    if cached is None or cached[0] != msg:
+        return None
+
+    d.state['dupCount'] += 1
+    if 'endTurn' in msg and msg['endTurn']:
+        d.endTurnBots.add(src)
+    log(lambda: d.logPrefix() + "Resent msg from " + src + " answered from reply cache: " + str(msg), "DEBUG")
+    return cached[1]
+
+
+def cacheReply(d, msg, src, networkbytes):
+    """ Remember networkbytes as the reply to msg from bot src. Only the last replyCacheSize replies are kept. """
+    if 'msgID' not in msg or src not in d.bots or msg['type'] == 'joinRequest':
+        return
+    cache = d.replyCache.setdefault(src, {})
+    cache.pop(msg['msgID'], None)
+    cache[msg['msgID']] = (msg, networkbytes)
+    if len(cache) > d.conf['replyCacheSize']:
+        del cache[next(iter(cache))]
+
+
+def mkBotState(d, src):
+    """ Return botState msg for bot src. """
+    bot = d.bots[src]
+    return {
+        'type': 'botState',
+        'gameNumber': d.state['gameNumber'],
+        'gameStep': d.state['gameStep'],
+        'health': bot.health,
+        'points': bot.points,
+        'x': bot.x,
+        'y': bot.y,
+        'requestedSpeed': bot.requestedSpeed,
+        'currentSpeed': bot.currentSpeed,
+        'requestedDirection': bot.requestedDirection,
+        'currentDirection': bot.currentDirection,
+        'shellInProgress': src in d.shells
+        }
 
-    d.state['msgTime'] += time.perf_counter() - startTime
+
+def sendBotStates(d):
+    """
+    Push botState to each bot that sent subscribeRequest, every everySteps steps.
+    Call after each step and when a game starts.
+    """
+    for src, sub in d.subscribers.items():
+        if d.state['gameStep'] % sub['everySteps'] != 0 or dropMessage(d, src):
+            continue
+        try:
+            networkbytes = d.srvSocket.packMessage(mkBotState(d, src), sub['ip'], sub['port'])
+        except Exception as e:
+            log(str(e), "ERROR")
+            continue
+        sendPacked(d, networkbytes, sub['ip'], sub['port'], src)
 
 
 def sendToViwers(d):
@@ -331,19 +726,20 @@ def sendToViwers(d):
     bmsg = d.srvSocket.serialize({
         'type': 'viewData',
                 'state': d.state,
-                'bots': d.bots,
-                'shells': d.shells,
-                'explosions': d.explosions
+                'bots': nbent.botsToDicts(d.bots),
+                'shells': nbent.shellsToDicts(d.shells),
+                'explosions': nbent.explosionsToDicts(d.explosions)
         })
     for src in list(d.viewers.keys()):  # we need a list of keys so we can del from the viewers dict below
         v = d.viewers[src]
         if v['lastKeepAlive'] + 10 < now:
             del d.viewers[src]
-            log("Viewer " + src + " didn't send keep alive in last 10 secs and was removed.")
+            log(d.logPrefix() + "Viewer " + src + " didn't send keep alive in last 10 secs and was removed.")
         else:
             try:
                 # sending with a prepacked message makes it faster to send to a lot of viewers.
                 d.srvSocket.sendMessage(bmsg, v['ip'], v['port'], packedAndChecked=True)
+                d.state['msgsOut'] += 1
             except Exception as e:
                 log(str(e), "ERROR")
                 
@@ -363,62 +759,194 @@ def getHitSeverity(d, b1, a, b2 = None):
     'b2' is the other bot that collied if this is a bot on bot collision.
     '''
 
-    hitSeverity = b1['currentSpeed'] / 100.0 * d.getClassValue('botMaxSpeed', b1['class']) / \
-                          d.conf['botMaxSpeed'] * math.cos(b1['currentDirection'] - a)
+    hitSeverity = b1.currentSpeed / 100.0 * b1.classValues.botMaxSpeed / \
+                          d.conf['botMaxSpeed'] * math.cos(b1.currentDirection - a)
     if b2:
         # This may reduce hitSeverity if b2 is moving away from b1 or
         # increase hitSeverity if b2 moving towards b1.
-        hitSeverity += b2['currentSpeed'] / 100.0 * d.getClassValue('botMaxSpeed', b2['class']) / \
-                          d.conf['botMaxSpeed'] * math.cos(b2['currentDirection'] - a + math.pi)
+        hitSeverity += b2.currentSpeed / 100.0 * b2.classValues.botMaxSpeed / \
+                          d.conf['botMaxSpeed'] * math.cos(b2.currentDirection - a + math.pi)
     if hitSeverity < 0:
         hitSeverity = 0
 
     return hitSeverity
 
 
-def findOverlapingBots(d, bots):
+class BotGrid:
     """
-    bots is a dict/list of bot locations: {key:{'x': x,'y': y}, ...}
-    bots can also contain health: {key:{'x': x,'y': y, 'health': h}, ...}
-    Return any pair (key,key) of bots that overlap, else return False
+    Uniform grid (spatial hash) of bot locations used to find bots that may overlap
+    without testing every pair of bots. Cells are 2 * botRadius wide so two bots can
+    only overlap if they are in the same or neighbouring cells.
+
+    Keys are only moved between cells when update() finds a bot has crossed into a
+    new cell, so the grid can be kept from step to step and updated incrementally.
     """
-    try:
-        keys = list(bots.keys())
-    except AttributeError:
-        keys = range(len(bots))
 
-    for i in range(0, len(keys) - 1):
-        boti = bots[keys[i]]
-        if 'health' not in boti or boti['health'] != 0:
-            for j in range(i + 1, len(keys)):
-                botj = bots[keys[j]]
-                if 'health' not in botj or botj['health'] != 0:
-                    if nbmath.distance(boti['x'], boti['y'], botj['x'], botj['y']) <= d.conf['botRadius'] * 2:
-                        return [keys[i], keys[j]]
+    def __init__(self, cellSize):
+        self.cellSize = cellSize
+        self.cells = {}  # {(cx, cy): set(key, ...), ...}
+        self.keyCells = {}  # {key: (cx, cy), ...}
+        self.order = {}  # {key: int, ...} order keys were first added, used to sort results.
+
+    def cellOf(self, x, y):
+        return (math.floor(x / self.cellSize), math.floor(y / self.cellSize))
+
+    def update(self, key, x, y):
+        """ Add key at x, y or move it if it is already in the grid. """
+        cell = self.cellOf(x, y)
+        oldCell = self.keyCells.get(key)
+        if cell == oldCell:
+            return
+        if oldCell is not None:
+            self.cells[oldCell].discard(key)
+        elif key not in self.order:
+            self.order[key] = len(self.order)
+        self.keyCells[key] = cell
+        if cell in self.cells:
+            self.cells[cell].add(key)
+        else:
+            self.cells[cell] = {key}
+
+    def remove(self, key):
+        oldCell = self.keyCells.pop(key, None)
+        if oldCell is not None:
+            self.cells[oldCell].discard(key)
+
+    def near(self, x, y, distance):
+        """ Return keys in all cells that are within distance of x, y, in the order they were added. """
+        cx1, cy1 = self.cellOf(x - distance, y - distance)
+        cx2, cy2 = self.cellOf(x + distance, y + distance)
+        keys = []
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                if (cx, cy) in self.cells:
+                    keys.extend(self.cells[(cx, cy)])
+        keys.sort(key=self.order.__getitem__)
+        return keys
+
+    def pairs(self, keys=None):
+        """
+        Return all candidate pairs [key, key] that are in the same or neighbouring cells.
+        If keys is given then only pairs that include one of keys are returned.
+        Pairs are sorted by the order keys were added so results do not depend on hashing.
+        """
+        order = self.order
+        found = set()
+        if keys is None:
+            # Only look at half the neighbours so each pair of cells is only checked once.
+            for (cx, cy), cell in self.cells.items():
+                if not cell:
+                    continue
+                for other in ((cx, cy), (cx + 1, cy - 1), (cx + 1, cy), (cx + 1, cy + 1), (cx, cy + 1)):
+                    if other not in self.cells:
+                        continue
+                    for k1 in cell:
+                        for k2 in self.cells[other]:
+                            if k1 != k2:
+                                found.add((k1, k2) if order[k1] < order[k2] else (k2, k1))
+        else:
+            for k1 in keys:
+                if k1 not in self.keyCells:
+                    continue
+                cx, cy = self.keyCells[k1]
+                for other in itertools.product((cx - 1, cx, cx + 1), (cy - 1, cy, cy + 1)):
+                    if other not in self.cells:
+                        continue
+                    for k2 in self.cells[other]:
+                        if k1 != k2:
+                            found.add((k1, k2) if order[k1] < order[k2] else (k2, k1))
 
-    return False
+        return sorted(found, key=lambda p: (order[p[0]], order[p[1]]))
 
 
-def findOverlapingBotsAndObstacles(d, bots):
+def mkBotGrid(d, bots):
     """
-    bots is a dict/list of bot locations: {key:{'x': x,'y': y}, ...}
-    bots can also contain health: {key:{'x': x,'y': y, 'health': h}, ...}
-    Return any pair (key,i) of (key,obstacle) that overlap, else return False
+    bots is a dict/list of Bot or Location records: {key:Bot, ...} or [Location, ...]
+    Return a BotGrid with all bots that have health != 0 and all Locations.
     """
+    grid = BotGrid(d.conf['botRadius'] * 2)
+    updateBotGrid(grid, bots)
+    return grid
+
 
+def updateBotGrid(grid, bots):
+    """ Move bots in grid to their current location and remove bots with health == 0. """
     try:
-        keys = list(bots.keys())
+        items = bots.items()
     except AttributeError:
-        keys = range(len(bots))
+        items = enumerate(bots)
+
+    for k, bot in items:
+        if getattr(bot, 'health', 1) != 0:  # Locations do not have health.
+            grid.update(k, bot.x, bot.y)
+        else:
+            grid.remove(k)
 
-    for k in keys:
-        bot = bots[k]
-        if 'health' not in bot or bot['health'] != 0:
-            for obstacle in d.conf['obstacles']:
-                if nbmath.distance(bot['x'], bot['y'], obstacle['x'], obstacle['y']) <= \
+
+def findAllOverlapingBots(d, bots, grid=None, keys=None):
+    """
+    bots is a dict/list of Bot or Location records: {key:Bot, ...} or [Location, ...]
+    grid is a BotGrid of bots. If None then one is made.
+    Return list of all pairs [key,key] of bots that overlap. If keys is given then only
+    pairs that include one of keys are returned.
+    """
+    if grid is None:
+        grid = mkBotGrid(d, bots)
+
+    overlaps = []
+    for k1, k2 in grid.pairs(keys):
+        b1 = bots[k1]
+        b2 = bots[k2]
+        if nbmath.distance(b1.x, b1.y, b2.x, b2.y) <= d.conf['botRadius'] * 2:
+            overlaps.append([k1, k2])
+
+    return overlaps
+
+
+def findOverlapingBots(d, bots):
+    """
+    bots is a dict/list of Bot or Location records: {key:Bot, ...} or [Location, ...]
+    Return any pair (key,key) of bots that overlap, else return False
+    """
+    overlaps = findAllOverlapingBots(d, bots)
+    if overlaps:
+        return overlaps[0]
+    return False
+
+
+def findAllOverlapingBotsAndObstacles(d, bots, grid=None, keys=None):
+    """
+    bots is a dict/list of Bot or Location records: {key:Bot, ...} or [Location, ...]
+    grid is a BotGrid of bots. If None then one is made.
+    Return list of all pairs [key,obstacle] that overlap. If keys is given then only
+    pairs that include one of keys are returned.
+    """
+    if not d.conf['obstacles']:
+        return []
+
+    if grid is None:
+        grid = mkBotGrid(d, bots)
+
+    overlaps = []
+    for obstacle in d.conf['obstacles']:
+        for k in grid.near(obstacle['x'], obstacle['y'], d.conf['botRadius'] + obstacle['radius']):
+            if keys is None or k in keys:
+                bot = bots[k]
+                if nbmath.distance(bot.x, bot.y, obstacle['x'], obstacle['y']) <= \
                         d.conf['botRadius'] + obstacle['radius']:
-                    return [k, obstacle]
+                    overlaps.append([k, obstacle])
+
+    return overlaps
+
 
+def findOverlapingBotsAndObstacles(d, bots):
+    """
+    bots is a dict/list of Bot or Location records: {key:Bot, ...} or [Location, ...]
+    Return any pair (key,i) of (key,obstacle) that overlap, else return False
+    """
+    overlaps = findAllOverlapingBotsAndObstacles(d, bots)
+    if overlaps:
+        return overlaps[0]
     return False
 
 
@@ -451,7 +979,7 @@ def mkObstacles(d, n):
                 log("Obstacle overlapped during random layout. Trying again.", "VERBOSE")
                 if attempts > 999:
                     log("Could not layout obstacles without overlapping.", "FAILURE")
-                    quit()
+                    quit([d])
 
     return obstacles
 
@@ -481,10 +1009,9 @@ def mkStartLocations(d):
         while botsOverlap or botsObsOverlap:
             startLocs = []
             for i in range(d.conf['botsInGame']):
-                loc = {}
-                loc['x'] = random.random() * (d.conf['arenaSize'] * 0.8) + (d.conf['arenaSize'] * 0.1)
-                loc['y'] = random.random() * (d.conf['arenaSize'] * 0.8) + (d.conf['arenaSize'] * 0.1)
-                startLocs.append(loc)
+                x = random.random() * (d.conf['arenaSize'] * 0.8) + (d.conf['arenaSize'] * 0.1)
+                y = random.random() * (d.conf['arenaSize'] * 0.8) + (d.conf['arenaSize'] * 0.1)
+                startLocs.append(nbent.Location(x, y))
 
             botsOverlap = findOverlapingBots(d, startLocs)
             botsObsOverlap = findOverlapingBotsAndObstacles(d, startLocs)
@@ -496,7 +1023,7 @@ def mkStartLocations(d):
             attempts += 1
             if attempts > 999:
                 log("Could not layout bots without overlapping.", "FAILURE")
-                quit()
+                quit([d])
 
         d.startLocs.extend(startLocs)
         locIndexes = range(len(d.startLocs) - d.conf['botsInGame'], len(d.startLocs))
@@ -514,9 +1041,13 @@ def initGame(d):
     reset game state
     """
     d.state['gameNumber'] += 1
-    log("Starting Game " + str(d.state['gameNumber']))
+    log(d.logPrefix() + "Starting Game " + str(d.state['gameNumber']))
 
     d.state['gameStep'] = 0
+
+    d.updateClassValues()
+    if d.engine:
+        d.engine.reset()
     
     """
     for each bot
@@ -524,225 +1055,270 @@ def initGame(d):
         reset speed and direction values to 0
     """
     for src, bot in d.bots.items():
-        bot['health'] = 100
-        bot['currentSpeed'] = 0
-        bot['requestedSpeed'] = 0
-        bot['currentDirection'] = 0
-        bot['requestedDirection'] = 0
+        bot.health = 100
+        bot.currentSpeed = 0
+        bot.requestedSpeed = 0
+        bot.currentDirection = 0
+        bot.requestedDirection = 0
 
     # set starting location
     start = d.starts.pop()
     for i in range(d.conf['botsInGame']):
         src = d.startBots[i]
-        d.bots[src]['x'] = d.startLocs[start[i]]['x']
-        d.bots[src]['y'] = d.startLocs[start[i]]['y']
+        d.bots[src].x = d.startLocs[start[i]].x
+        d.bots[src].y = d.startLocs[start[i]].y
 
     # delete all shells and explosions.
     d.shells = {}
     d.explosions = {}
+    d.scanCache = None
 
 
-def step(d):
-    startTime = time.perf_counter()
-
-    d.state['gameStep'] += 1
-    d.state['serverSteps'] += 1
-
-    # for each bot that is alive, copy health to so we know what it was at the start of the step.
-    aliveBots = {}
-    for src, bot in d.bots.items():
-        if bot['health'] != 0:
-            aliveBots[src] = bot['health']
-
-    # for all bots that are alive
+def moveBots(d, aliveBots):
+    """
+    Change speed and direction of all alive bots towards their requested
+    values and then move them.
+    """
     for src, bot in d.bots.items():
         if src in aliveBots:
+            cv = bot.classValues
             # change speed if needed
-            if bot['currentSpeed'] > bot['requestedSpeed']:
-                bot['currentSpeed'] -= d.getClassValue('botAccRate', bot['class'])
-                if bot['currentSpeed'] < bot['requestedSpeed']:
-                    bot['currentSpeed'] = bot['requestedSpeed']
-            elif bot['currentSpeed'] < bot['requestedSpeed']:
-                bot['currentSpeed'] += d.getClassValue('botAccRate', bot['class'])
-                if bot['currentSpeed'] > bot['requestedSpeed']:
-                    bot['currentSpeed'] = bot['requestedSpeed']
+            if bot.currentSpeed > bot.requestedSpeed:
+                bot.currentSpeed -= cv.botAccRate
+                if bot.currentSpeed < bot.requestedSpeed:
+                    bot.currentSpeed = bot.requestedSpeed
+            elif bot.currentSpeed < bot.requestedSpeed:
+                bot.currentSpeed += cv.botAccRate
+                if bot.currentSpeed > bot.requestedSpeed:
+                    bot.currentSpeed = bot.requestedSpeed
 
             # change direction if needed
-            if bot['currentDirection'] != bot['requestedDirection']:
-                if bot['currentDirection'] != bot['requestedDirection'] and bot['currentSpeed'] == 0:
+            if bot.currentDirection != bot.requestedDirection:
+                if bot.currentDirection != bot.requestedDirection and bot.currentSpeed == 0:
                     # turn instanly if bot is not moving
-                    bot['currentDirection'] = bot['requestedDirection']
+                    bot.currentDirection = bot.requestedDirection
                 else:
                     # how much can we turn at the speed we are going?
-                    turnRate = d.getClassValue('botMinTurnRate', bot['class']) \
-                        + (d.getClassValue('botMaxTurnRate', bot['class']) -
-                           d.getClassValue('botMinTurnRate', bot['class'])) \
-                        * (1 - bot['currentSpeed'] / 100)
+                    turnRate = cv.botMinTurnRate + (cv.botMaxTurnRate - cv.botMinTurnRate) \
+                        * (1 - bot.currentSpeed / 100)
 
                     # if turn is negative and does not pass over 0 radians
-                    if bot['currentDirection'] > bot['requestedDirection'] and \
-                            bot['currentDirection'] - bot['requestedDirection'] <= math.pi:
-                        bot['currentDirection'] -= turnRate
-                        if bot['currentDirection'] <= bot['requestedDirection']:
-                            bot['currentDirection'] = bot['requestedDirection']
+                    if bot.currentDirection > bot.requestedDirection and \
+                            bot.currentDirection - bot.requestedDirection <= math.pi:
+                        bot.currentDirection -= turnRate
+                        if bot.currentDirection <= bot.requestedDirection:
+                            bot.currentDirection = bot.requestedDirection
 
                     # if turn is negative and passes over 0 radians, so we may need to normalize angle
-                    elif bot['requestedDirection'] > bot['currentDirection'] and \
-                            bot['requestedDirection'] - bot['currentDirection'] >= math.pi:
-                        bot['currentDirection'] = nbmath.normalizeAngle(bot['currentDirection'] - turnRate)
-                        if bot['currentDirection'] <= bot['requestedDirection'] and bot['currentDirection'] >= bot['requestedDirection'] - math.pi:
-                            bot['currentDirection'] = bot['requestedDirection']
+                    elif bot.requestedDirection > bot.currentDirection and \
+                            bot.requestedDirection - bot.currentDirection >= math.pi:
+                        bot.currentDirection = nbmath.normalizeAngle(bot.currentDirection - turnRate)
+                        if bot.currentDirection <= bot.requestedDirection and bot.currentDirection >= bot.requestedDirection - math.pi:
+                            bot.currentDirection = bot.requestedDirection
 
                     # if turn is positive and does not pass over 0 radians
-                    elif bot['requestedDirection'] > bot['currentDirection'] and \
-                            bot['requestedDirection'] - bot['currentDirection'] <= math.pi:
-                        bot['currentDirection'] += turnRate
-                        if bot['requestedDirection'] <= bot['currentDirection']:
-                            bot['currentDirection'] = bot['requestedDirection']
+                    elif bot.requestedDirection > bot.currentDirection and \
+                            bot.requestedDirection - bot.currentDirection <= math.pi:
+                        bot.currentDirection += turnRate
+                        if bot.requestedDirection <= bot.currentDirection:
+                            bot.currentDirection = bot.requestedDirection
 
                     # if turn is positive and passes over 0 radians
-                    elif bot['currentDirection'] > bot['requestedDirection'] and \
-                            bot['currentDirection'] - bot['requestedDirection'] >= math.pi:
-                        bot['currentDirection'] = nbmath.normalizeAngle(bot['currentDirection'] + turnRate)
-                        if bot['currentDirection'] >= bot['requestedDirection'] and bot['currentDirection'] <= bot['requestedDirection'] + math.pi:
-                            bot['currentDirection'] = bot['requestedDirection']
+                    elif bot.currentDirection > bot.requestedDirection and \
+                            bot.currentDirection - bot.requestedDirection >= math.pi:
+                        bot.currentDirection = nbmath.normalizeAngle(bot.currentDirection + turnRate)
+                        if bot.currentDirection >= bot.requestedDirection and bot.currentDirection <= bot.requestedDirection + math.pi:
+                            bot.currentDirection = bot.requestedDirection
             # move bot
-            if bot['currentSpeed'] != 0:
-                bot['x'], bot['y'] = nbmath.project(bot['x'], bot['y'],
-                                        bot['currentDirection'],
-                                        bot['currentSpeed'] / 100.0 * d.getClassValue('botMaxSpeed', bot['class']))
+            if bot.currentSpeed != 0:
+                bot.x, bot.y = nbmath.project(bot.x, bot.y,
+                                        bot.currentDirection,
+                                        bot.currentSpeed / 100.0 * cv.botMaxSpeed)
 
     # set starting hitSeverity to 0 for all robots. hitSeverity == 0 means robot did not 
     # hit anything this step.
-    for src, bot in d.bots.items():
-        bot['hitSeverity'] = 0.0
+    for bot in d.bots.values():
+        bot.hitSeverity = 0.0
 
-    # do until we get one clean pass where no bot hitting wall, obstacle or other bot.
-    foundOverlap = True
-    while foundOverlap:
-        foundOverlap = False
 
-        # detect if bots hit walls. if they, did move them so they are just barely not touching,
-        for src, bot in d.bots.items():
-            hitSeverity = 0
-            if bot['x'] - d.conf['botRadius'] < 0:
-                # hit left side
-                bot['x'] = d.conf['botRadius'] + 1
-                hitSeverity = getHitSeverity(d, bot, math.pi)
-            if bot['x'] + d.conf['botRadius'] > d.conf['arenaSize']:
-                # hit right side
-                bot['x'] = d.conf['arenaSize'] - d.conf['botRadius'] - 1
-                hitSeverity = getHitSeverity(d, bot, 0)
-            if bot['y'] - d.conf['botRadius'] < 0:
-                # hit bottom side
-                bot['y'] = d.conf['botRadius'] + 1
-                hitSeverity = getHitSeverity(d, bot, math.pi * 3 / 2)
-            if bot['y'] + d.conf['botRadius'] > d.conf['arenaSize']:
-                # hit top side
-                bot['y'] = d.conf['arenaSize'] - d.conf['botRadius'] - 1
-                hitSeverity = getHitSeverity(d, bot, math.pi/2)
-    
-            if hitSeverity:
-                foundOverlap = True
-                bot['hitSeverity'] = max(bot['hitSeverity'], hitSeverity)
+def collideWalls(d, keys=None):
+    """
+    Detect if bots hit walls. If they did, move them so they are just barely not touching.
+    If keys is given then only those bots are checked.
+    Returns True if any bot hit a wall.
+    """
+    if keys is None:
+        keys = d.bots.keys()
 
-        # detect if bots hit obstacles, if the did move them so they are just barely not touching,
-        overlap = findOverlapingBotsAndObstacles(d, d.bots)
-        while overlap:
+    foundOverlap = False
+    for src in keys:
+        bot = d.bots[src]
+        hitSeverity = 0
+        if bot.x - d.conf['botRadius'] < 0:
+            # hit left side
+            bot.x = d.conf['botRadius'] + 1
+            hitSeverity = getHitSeverity(d, bot, math.pi)
+        if bot.x + d.conf['botRadius'] > d.conf['arenaSize']:
+            # hit right side
+            bot.x = d.conf['arenaSize'] - d.conf['botRadius'] - 1
+            hitSeverity = getHitSeverity(d, bot, 0)
+        if bot.y - d.conf['botRadius'] < 0:
+            # hit bottom side
+            bot.y = d.conf['botRadius'] + 1
+            hitSeverity = getHitSeverity(d, bot, math.pi * 3 / 2)
+        if bot.y + d.conf['botRadius'] > d.conf['arenaSize']:
+            # hit top side
+            bot.y = d.conf['arenaSize'] - d.conf['botRadius'] - 1
+            hitSeverity = getHitSeverity(d, bot, math.pi/2)
+
+        if hitSeverity:
             foundOverlap = True
-            b = d.bots[overlap[0]]
-            o = overlap[1]
+            bot.hitSeverity = max(bot.hitSeverity, hitSeverity)
+
+    return foundOverlap
+
+
+def resolveCollisions(d, checkWalls=True, moved=None):
+    """
+    Move bots so none overlap walls, obstacles or other bots, recording the worst
+    hitSeverity of each bot. If checkWalls is False then the first wall pass is
+    skipped because the caller has already done it. If moved is a set then the keys
+    of bots moved by this function are added to it.
+
+    Each iteration finds every overlap with obstacles and other bots using the bot
+    locations at the start of the iteration, moves all the bots at once and then moves
+    bots back inside the walls. Only bots that moved are checked in the next iteration.
+    At most conf['collisionIterations'] iterations are done each step so pile ups can't
+    make a step take much longer than others. Returns the number of iterations that
+    found overlaps.
+    """
+    if d.botGrid is None or d.botGrid.cellSize != d.conf['botRadius'] * 2:
+        d.botGrid = BotGrid(d.conf['botRadius'] * 2)
+    grid = d.botGrid
+
+    if checkWalls:
+        collideWalls(d)
+
+    updateBotGrid(grid, d.bots)
+
+    iterations = 0
+    keys = None  # check all bots in the first iteration.
+    while iterations < d.conf['collisionIterations']:
+        moves = {}  # {key: [dx, dy], ...}
+
+        # detect if bots hit obstacles, if the did find how to move them so they are just barely not touching.
+        for k, o in findAllOverlapingBotsAndObstacles(d, d.bots, grid, keys):
+            b = d.bots[k]
             # find angle to move bot directly away from obstacle
-            a = nbmath.angle(o['x'], o['y'], b['x'], b['y'])
+            a = nbmath.angle(o['x'], o['y'], b.x, b.y)
             # find min distance to move bot so it don't touch (plus 0.5 for safety).
-            distance = d.conf['botRadius'] + o['radius'] + 0.5 - nbmath.distance(o['x'], o['y'], b['x'], b['y'])
-            # move bot
-            b['x'], b['y'] = nbmath.project(b['x'], b['y'], a, distance)
+            distance = d.conf['botRadius'] + o['radius'] + 0.5 - nbmath.distance(o['x'], o['y'], b.x, b.y)
+            addMove(moves, k, a, distance)
             # record damage
             hitSeverity = getHitSeverity(d, b, a + math.pi)
-            b['hitSeverity'] = max(b['hitSeverity'], hitSeverity)
-            # check for more bots overlapping
-            overlap = findOverlapingBotsAndObstacles(d, d.bots)
-                    
-        # detect if bots hit other bots, if the did move them so they are just barely not touching,
-        overlap = findOverlapingBots(d, d.bots)
-        while overlap:
-            foundOverlap = True
-            b1 = d.bots[overlap[0]]
-            b2 = d.bots[overlap[1]]
+            b.hitSeverity = max(b.hitSeverity, hitSeverity)
+
+        # detect if bots hit other bots, if the did find how to move them so they are just barely not touching.
+        for k1, k2 in findAllOverlapingBots(d, d.bots, grid, keys):
+            b1 = d.bots[k1]
+            b2 = d.bots[k2]
             # find angle to move bot directly away from each other
-            a = nbmath.angle(b1['x'], b1['y'], b2['x'], b2['y'])
+            a = nbmath.angle(b1.x, b1.y, b2.x, b2.y)
             # find min distance to move each bot so they don't touch (plus 0.5 for saftly).
-            between = nbmath.distance(b1['x'], b1['y'], b2['x'], b2['y'])
+            between = nbmath.distance(b1.x, b1.y, b2.x, b2.y)
             distance = between / 2 - (between - d.conf['botRadius']) + 0.5
-            # move bots
-            b1['x'], b1['y'] = nbmath.project(b1['x'], b1['y'], a + math.pi, distance)
-            b2['x'], b2['y'] = nbmath.project(b2['x'], b2['y'], a, distance)
+            addMove(moves, k1, a + math.pi, distance)
+            addMove(moves, k2, a, distance)
             # record damage
             hitSeverity = getHitSeverity(d, b1, a, b2)
-            b1['hitSeverity'] = max(b1['hitSeverity'], hitSeverity)
-            b2['hitSeverity'] = max(b2['hitSeverity'], hitSeverity)
-            # check for more bots overlapping
-            overlap = findOverlapingBots(d, d.bots)
+            b1.hitSeverity = max(b1.hitSeverity, hitSeverity)
+            b2.hitSeverity = max(b2.hitSeverity, hitSeverity)
+
+        if not moves:
+            break
+        iterations += 1
+
+        # move all bots at once and then keep them inside the walls.
+        for k, move in moves.items():
+            b = d.bots[k]
+            b.x += move[0]
+            b.y += move[1]
+        collideWalls(d, moves.keys())
+        for k in moves:
+            grid.update(k, d.bots[k].x, d.bots[k].y)
+        keys = moves.keys()
+        if moved is not None:
+            moved.update(keys)
+
+    d.state['collisionIterations'] += iterations
+    if iterations > d.state['maxCollisionIterations']:
+        d.state['maxCollisionIterations'] = iterations
+    if iterations == d.conf['collisionIterations']:
+        d.state['collisionLimitCount'] += 1
+
+    return iterations
+
+
+def addMove(moves, k, a, distance):
+    """ Add moving distance in direction a to the total move of bot k. """
+    dx, dy = nbmath.project(0, 0, a, distance)
+    if k in moves:
+        moves[k][0] += dx
+        moves[k][1] += dy
+    else:
+        moves[k] = [dx, dy]
 
-    # give damage (only once this step) to bots that hit things. Also stop them.
-    for src, bot in d.bots.items():
-        if bot['hitSeverity']:
-            if d.conf['simpleCollisions']:
-                bot['hitSeverity'] = 1
-            bot['health'] = max(0, bot['health'] - bot['hitSeverity'] * d.conf['hitDamage'] * d.getClassValue('botArmor', bot['class']))
-            bot['currentSpeed'] = 0
-            bot['requestedSpeed'] = 0
-        del bot['hitSeverity']
-
-    # for all shells
+
+def explodeShell(d, src, shell):
+    """
+    Apply damage from shell fired by src to all bots in range and store the explosion
+    so viewers can display it.
+    """
+    shooter = d.bots[src]
+    cv = shooter.classValues
+    # apply damage to bots.
+    for bot in d.bots.values():
+        if bot.health > 0:
+            distance = nbmath.distance(bot.x, bot.y, shell.x, shell.y)
+            if distance < cv.explRadius:
+                damage = cv.explDamage * (1 - distance / cv.explRadius)
+                bot.health = max(0, bot.health - (damage * bot.classValues.botArmor))
+                # allow recording of inflicting damage that is greater than health of hit robot.
+                # also record damage to oneself.
+                shooter.shellDamage += damage
+
+    d.addExplosion(src, shell.x, shell.y)
+
+
+def moveShells(d):
+    """ Move all shells and explode the ones that reach their destination. """
     for src in list(d.shells.keys()):
         shell = d.shells[src]
+        cv = d.bots[src].classValues
 
         # remember shells start point before moving
-        oldx = shell['x']
-        oldy = shell['y']
+        oldx = shell.x
+        oldy = shell.y
 
         # move shell
-        distance = min(d.getClassValue('shellSpeed', d.bots[src]['class']), shell['distanceRemaining'])
-        shell['x'], shell['y'] = nbmath.project(shell['x'], shell['y'], shell['direction'], distance)
-        shell['distanceRemaining'] -= distance
+        distance = min(cv.shellSpeed, shell.distanceRemaining)
+        shell.x, shell.y = nbmath.project(shell.x, shell.y, shell.direction, distance)
+        shell.distanceRemaining -= distance
 
         # did shell hit an obstacle?
         shellHitObstacle = False
         for o in d.conf['obstacles']:
-            if nbmath.intersectLineCircle(oldx, oldy, shell['x'], shell['y'], o['x'], o['y'], o['radius']):
+            if nbmath.intersectLineCircle(oldx, oldy, shell.x, shell.y, o['x'], o['y'], o['radius']):
                 shellHitObstacle = True
 
         # if did not hit an obstacle and shell's explosion would touch inside of arena
         if not shellHitObstacle and \
-           (shell['x'] > d.getClassValue('explRadius', d.bots[src]['class']) * -1 and shell['x'] < d.conf['arenaSize'] + d.getClassValue('explRadius', d.bots[src]['class']) and
-                shell['y'] > d.getClassValue('explRadius', d.bots[src]['class']) * -1 and shell['y'] < d.conf['arenaSize'] + d.getClassValue('explRadius', d.bots[src]['class'])):
+           (shell.x > cv.explRadius * -1 and shell.x < d.conf['arenaSize'] + cv.explRadius and
+                shell.y > cv.explRadius * -1 and shell.y < d.conf['arenaSize'] + cv.explRadius):
 
             # if shell has reached it destination then explode.
-            if shell['distanceRemaining'] <= 0:
-                # apply damage to bots.
-                for k, bot in d.bots.items():
-                    if bot['health'] > 0:
-                        distance = nbmath.distance(bot['x'], bot['y'], shell['x'], shell['y'])
-                        if distance < d.getClassValue('explRadius', d.bots[src]['class']):
-                            damage = d.getClassValue('explDamage', d.bots[src]['class']) * (1 - distance / d.getClassValue('explRadius', d.bots[src]['class']))
-                            bot['health'] = max(0, bot['health'] - (damage * d.getClassValue('botArmor', bot['class'])))
-                            # allow recording of inflicting damage that is greater than health of hit robot.
-                            # also record damage to oneself.
-                            d.bots[src]['shellDamage'] += damage
-
-                # store the explosion so viewers can display it. we can't use src as index because it is possible for two explosions
-                # from same bot to exist (but not likly).
-                d.explosions[d.state['explIndex']] = {
-                    'x': shell['x'],
-                    'y': shell['y'],
-                    'stepsAgo': 0,
-                    'src': src  # this is needed by viewer to color this explosion based on the bot who fired it.
-                    }
-                d.state['explIndex'] += 1
-                if d.state['explIndex'] > 65000:
-                    d.state['explIndex'] = 0
+            if shell.distanceRemaining <= 0:
+                explodeShell(d, src, shell)
 
                 # this shell exploed so remove it
                 del d.shells[src]
@@ -750,15 +1326,54 @@ def step(d):
             # shell hit obstacle or left arena so remove it without exploding
             del d.shells[src]
 
+
+def step(d):
+    startTime = time.perf_counter()
+
+    d.state['gameStep'] += 1
+    d.state['serverSteps'] += 1
+
+    # for each bot that is alive, copy health to so we know what it was at the start of the step.
+    aliveBots = {}
+    for src, bot in d.bots.items():
+        if bot.health != 0:
+            aliveBots[src] = bot.health
+
+    if d.engine:
+        # engine also does the first wall collision pass.
+        d.engine.moveBots(d, aliveBots)
+        moved = set()
+        resolveCollisions(d, checkWalls=False, moved=moved)
+        for src in moved:
+            d.engine.botChanged(src)
+        d.engine.hitDamage(d)
+    else:
+        moveBots(d, aliveBots)
+        resolveCollisions(d)
+
+        # give damage (only once this step) to bots that hit things. Also stop them.
+        for bot in d.bots.values():
+            if bot.hitSeverity:
+                if d.conf['simpleCollisions']:
+                    bot.hitSeverity = 1
+                bot.health = max(0, bot.health - bot.hitSeverity * d.conf['hitDamage'] * bot.classValues.botArmor)
+                bot.currentSpeed = 0
+                bot.requestedSpeed = 0
+
+    if d.engine:
+        d.engine.moveShells(d)
+    else:
+        moveShells(d)
+
     # Remove old explosions and add 1 to other explosions stepsAgo.
     # Note, We only keep these around so the viewer can do a nice animation
     # over a number of steps before they are removed.
     for key in list(d.explosions.keys()):
         expl = d.explosions[key]
-        if expl['stepsAgo'] == d.conf['keepExplosionSteps']:
+        if expl.stepsAgo == d.conf['keepExplosionSteps']:
             del d.explosions[key]
         else:
-            expl['stepsAgo'] += 1
+            expl.stepsAgo += 1
 
     # find how many points bots that died this step will get. (Based on how many bots have died previouly)
     if len(aliveBots) == d.conf['botsInGame']:
@@ -770,25 +1385,32 @@ def step(d):
 
     # Kill all bots if we have reached the max steps and there is still more than one bot alive.
     if d.state['gameStep'] == d.conf['stepMax'] and len(aliveBots) != 1:
-        log("Game reached stepMax with more than one bot alive. Killing all bots.")
+        log(d.logPrefix() + "Game reached stepMax with more than one bot alive. Killing all bots.")
         for src in aliveBots:
-            d.bots[src]['health'] = 0
+            d.bots[src].health = 0
+            if d.engine:
+                d.engine.botChanged(src)
 
     # Assign points to bots that died this turn
     for src in list(aliveBots.keys()):
-        if d.bots[src]['health'] == 0:
-            d.bots[src]['points'] += points
+        if d.bots[src].health == 0:
+            d.bots[src].points += points
             del aliveBots[src]
 
     # If only one bot is left then end game.
     if len(aliveBots) == 1:
         src = list(aliveBots.keys())[0]
-        d.bots[src]['winHealth'] += d.bots[src]['health']
-        d.bots[src]['winCount'] += 1
-        d.bots[src]['health'] = 0
-        d.bots[src]['points'] += 10  # last robot (winner)
+        d.bots[src].winHealth += d.bots[src].health
+        d.bots[src].winCount += 1
+        d.bots[src].health = 0
+        d.bots[src].points += 10  # last robot (winner)
+        if d.engine:
+            d.engine.botChanged(src)
         del aliveBots[src]
 
+    # bots have moved so scans need a new ScanCache.
+    d.scanCache = None
+
     d.state['stepTime'] += time.perf_counter() - startTime
 
 
@@ -798,9 +1420,12 @@ def step(d):
 
 def logScoreboard(d):
     now = time.time()
-    totalRecv = sum(d.srvSocket.recv.values())
-    totalSent = sum(d.srvSocket.sent.values())
-    output = "\n\n                  ------ Scoreboard ------" +\
+    totalRecv = d.state['msgsIn']
+    totalSent = d.state['msgsOut']
+    output = "\n\n                  ------ Scoreboard ------"
+    if d.conf['arenas'] > 1:
+        output += "\n                         Arena: " + str(d.conf['arenaNumber']) + " / " + str(d.conf['arenas'])
+    output += \
         "\n               Tournament Time: " + '%.3f' % (now - d.state['tourStartTime']) + " secs." +\
         "\n                         Games: " + str(d.state['gameNumber']) +\
         "\n             Average Game Time: " + '%.3f' % ((now - d.state['tourStartTime']) / max(1, d.state['gameNumber'])) + " secs." +\
@@ -811,13 +1436,18 @@ def logScoreboard(d):
         "\n  Time Sending Viewer Messages: " + '%.3f' % (d.state['viewerMsgTime']) + " secs." +\
         "\n                   Messages In: " + str(totalRecv) +\
         "\n                  Messages Out: " + str(totalSent) +\
-        "\n              Messages Dropped: " + str(d.state['dropCount']) +\
+        "\n              Messages Dropped: " + str(d.state['dropCount']) + \
+        (" (network emulation)" if d.netem else " (-droprate)") +\
+        "\n       OS Receive Buffer Drops: " + socketDrops(d) +\
+        "\n      Resent Requests Answered: " + str(d.state['dupCount']) + " (from reply cache)" +\
         "\n             Messages / Second: " + '%.3f' % ((totalRecv + totalSent) / float(time.time() - d.state['startTime'])) +\
         "\n         Time Processing Steps: " + '%.3f' % (d.state['stepTime']) + " secs." +\
         "\n                Steps / Second: " + '%.3f' % (d.state['serverSteps'] / float(max(1, time.time() - d.state['tourStartTime']))) +\
         "\n                 Time Sleeping: " + '%.3f' % (float(d.state['sleepTime'])) + " secs." +\
         "\n            Average Sleep Time: " + '%.6f' % (float(d.state['sleepTime']) / max(1, d.state['sleepCount'])) + " secs." +\
         "\n     Steps Slower Than stepSec: " + str(d.state['longStepCount']) + f" ({float(d.state['longStepCount']) / float(max(1,d.state['serverSteps'])) * 100.0:>4.2f}%)" +\
+        "\n  Collision Iterations / Step: " + '%.3f' % (d.state['collisionIterations'] / max(1, d.state['serverSteps'])) +\
+        " (max " + str(d.state['maxCollisionIterations']) + ", " + str(d.state['collisionLimitCount']) + " steps at limit)" +\
         "\n\n" +\
         f"  {' ':>16}" +\
         f"  {'---- Score -----':>16}" +\
@@ -834,42 +1464,68 @@ def logScoreboard(d):
         f"  {'AvgDamage':>10}" +\
         f"  {'TotDamage':>10}" +\
         f"  {'MS%':>4}" +\
+        f"  {'Throttled':>9}" +\
         f"  {'IP:Port':<21}" +\
-        "\n ------------------------------------------------------------------------------------------------------------------"
+        "\n -----------------------------------------------------------------------------------------------------------------------------"
 
-    botSort = sorted(d.bots, key=lambda b: d.bots[b]['points'], reverse=True)
+    botSort = sorted(d.bots, key=lambda b: d.bots[b].points, reverse=True)
 
     totalPoints = 0.0
     for src in botSort:
-        totalPoints += d.bots[src]['points']
+        totalPoints += d.bots[src].points
     if totalPoints == 0:
         totalPoints = 1.0
 
     for src in botSort:
         bot = d.bots[src]
         output += "\n" +\
-            f"  {bot['name']:>16}" +\
-            f"  {bot['points']:>10}" +\
-            f"  {float(bot['points'])/totalPoints*100.0:>4.1f}" +\
-            f"  {bot['winCount']:>7}" +\
-            f"  {float(bot['winHealth']) / max(1,bot['winCount']):>10.2f}" +\
-            f"  {bot['firedCount']:>7}" +\
-            f"  {float(bot['shellDamage']) / max(1,bot['firedCount']):>10.2f}" +\
-            f"  {float(bot['shellDamage']):>10.2f}" +\
-            f"  {float(bot['missedSteps'])/max(1,d.state['serverSteps'])*100.0:>4.1f}" +\
+            f"  {bot.name:>16}" +\
+            f"  {bot.points:>10}" +\
+            f"  {float(bot.points)/totalPoints*100.0:>4.1f}" +\
+            f"  {bot.winCount:>7}" +\
+            f"  {float(bot.winHealth) / max(1,bot.winCount):>10.2f}" +\
+            f"  {bot.firedCount:>7}" +\
+            f"  {float(bot.shellDamage) / max(1,bot.firedCount):>10.2f}" +\
+            f"  {float(bot.shellDamage):>10.2f}" +\
+            f"  {float(bot.missedSteps)/max(1,d.state['serverSteps'])*100.0:>4.1f}" +\
+            f"  {botThrottled(d, src):>9}" +\
             f"  {src:<21}"
 
-    output += "\n ------------------------------------------------------------------------------------------------------------------\n\n"
+    output += "\n -----------------------------------------------------------------------------------------------------------------------------\n\n"
 
     log(output)
 
+def botThrottled(d, src):
+    """ Return number of msgs from bot src skipped because it sent more than -botrate msgs/sec. """
+    peer = d.srvSocket.peers.get(nbipc.toAddress(src)) if d.srvSocket else None
+    return peer.throttled if peer else 0
+
+
+def socketDrops(d):
+    """
+    Return str of msgs lost before the server could receive them: dropped by the OS because the
+    server socket receive buffer was full (see -rcvbuf) and, with -recvthread, because the receive
+    queue was full. These are for the server socket, so they include msgs to all arenas.
+    """
+    kernelDrops = d.srvSocket.getKernelDrops() if d.srvSocket else None
+    output = "unknown" if kernelDrops is None else str(kernelDrops)
+    if d.srvSocket and d.srvSocket.recvThread:
+        output += " (receive queue drops: " + str(d.srvSocket.recvQueueDrops) + ")"
+    return output
+
+
 def jsonScoreboard(d):
     if d.state['jsonScoreboard']:
+        d.state['kernelDropCount'] = d.srvSocket.getKernelDrops() if d.srvSocket else None
+        d.state['recvQueueDropCount'] = d.srvSocket.recvQueueDrops if d.srvSocket else 0
         d.state['tourEndTime'] = time.time()
         d.state['tourTime'] = d.state['tourEndTime'] - d.state['tourStartTime']
         d.state['longStepPercent'] = float(d.state['longStepCount']) / float(max(1,d.state['serverSteps'])) * 100.0
+        bots = nbent.botsToDicts(d.bots)
+        for src, bot in bots.items():
+            bot['throttled'] = botThrottled(d, src)
         with open(d.state['jsonScoreboard'],"w") as f: 
-            f.write(json.dumps({'conf': d.conf,'state': d.state, 'bots': d.bots}))
+            f.write(json.dumps({'conf': d.conf,'state': d.state, 'bots': bots}))
 
 ########################################################
 # Main Loop
@@ -891,17 +1547,131 @@ class Range(argparse.Action):
         setattr(namespace, self.dest, value)
         
 
-def quit(signal=None, frame=None):
-    global d
-    log(d.srvSocket.getStats())
-    logScoreboard(d)
+def quit(arenas, signal=None, frame=None):
+    if arenas and arenas[0].srvSocket:
+        log(arenas[0].srvSocket.getStats())
+        for d in arenas:
+            logScoreboard(d)
     log("Quiting", "INFO")
     exit()
 
 
-def main():
-    global d  # d is global so quit() can access it.
+def mkArena(args, arenaNumber):
+    """ Return a new arena (SrvData) with conf set from the command line args. """
     d = SrvData()
+    d.conf['serverName'] = args.serverName
+    d.conf['gamesToPlay'] = args.gamesToPlay
+    d.conf['botsInGame'] = args.botsInGame
+    d.conf['stepSec'] = args.stepSec
+    d.conf['stepMax'] = args.stepMax
+    d.conf['dropRate'] = args.dropRate
+    d.state['dropNext'] = args.dropRate
+    d.conf['netLoss'] = args.netLoss
+    d.conf['netBurst'] = args.netBurst
+    d.conf['netLatency'] = args.netLatency
+    d.conf['netJitter'] = args.netJitter
+    d.conf['netBandwidth'] = args.netBandwidth
+    d.conf['netSeed'] = args.netSeed
+    d.conf['botMsgsPerStep'] = args.botMsgsPerStep
+    d.conf['lockStep'] = args.lockStep
+    # by default allow the msgs replyMsg() will reply to or hold (2 * botMsgsPerStep each step). -lockstep
+    # steps faster than stepSec so there is no default limit with it.
+    d.conf['botBurst'] = 2 * args.botMsgsPerStep
+    if args.botRate is not None:
+        d.conf['botRate'] = args.botRate
+    elif not args.lockStep and args.stepSec > 0:
+        d.conf['botRate'] = d.conf['botBurst'] / args.stepSec
+    else:
+        d.conf['botRate'] = 0.0
+    d.conf['arenaSize'] = args.arenaSize
+    d.conf['botRadius'] = args.botRadius
+    d.conf['explRadius'] = args.explRadius
+    d.conf['botMaxSpeed'] = args.botMaxSpeed
+    d.conf['botAccRate'] = args.botAccRate
+    d.conf['shellSpeed'] = args.shellSpeed
+    d.conf['hitDamage'] = args.hitDamage
+    d.conf['explDamage'] = args.explDamage
+    d.conf['obstacleRadius'] = args.obstacleRadius
+    d.conf['obstacles'] = mkObstacles(d, args.obstacles)
+    d.conf['jamZones'] = mkJamZones(d, args.jamZones)
+    d.conf['allowClasses'] = args.allowClasses
+    d.conf['simpleCollisions'] = args.simpleCollisions
+    d.conf['startPermutations'] = args.startPermutations
+    d.conf['scanMaxDistance'] = args.scanMaxDistance
+    d.conf['collisionIterations'] = args.collisionIterations
+    d.conf['noViewers'] = args.noViewers
+    d.conf['maxSecsToJoin'] = args.maxSecsToJoin
+    d.conf['arenas'] = args.arenas
+    d.conf['arenaNumber'] = arenaNumber
+    d.state['onlyLastSb'] = args.onlyLastSb
+    d.state['jsonScoreboard'] = args.jsonScoreboard
+    if args.jsonScoreboard and args.arenas > 1:
+        # each arena saves to its own file, eg. results.json becomes results-arena1.json
+        root, ext = os.path.splitext(args.jsonScoreboard)
+        d.state['jsonScoreboard'] = root + "-arena" + str(arenaNumber) + ext
+
+    if args.engine == 'numpy':
+        d.engine = nbnpengine.NumpyEngine()
+
+    mkStartLocations(d)
+
+    return d
+
+
+def mkNetEm(conf):
+    """ Return netbots_netem.NetEm for the network emulation in conf, or None if network emulation is off. """
+    if not (conf['netLoss'] or any(conf['netBurst']) or conf['netLatency'] or conf['netJitter'] or
+            conf['netBandwidth']):
+        return None
+    return nbnetem.NetEm(conf['netLoss'], conf['netBurst'], conf['netLatency'], conf['netJitter'],
+                         conf['netBandwidth'], conf['netSeed'])
+
+
+def runArena(d):
+    """
+    Step the game in arena d if one is running, otherwise start the next game when
+    enough bots have joined. Returns True if a step was processed.
+    """
+    if d.state['arenaFinished']:
+        return False
+
+    aliveBots = 0
+    for src, bot in d.bots.items():
+        if bot.health != 0:
+            aliveBots += 1
+
+    if aliveBots > 0:  # if there is an ongoing game
+        step(d)
+        sendBotStates(d)
+        return True
+    elif len(d.bots) == d.conf['botsInGame']:  # if we have enough bots to start playing
+        if not d.state['tourStartTime']:
+            d.state['tourStartTime'] = time.time()
+
+        if d.conf['gamesToPlay'] != d.state['gameNumber']:
+            if not d.state['onlyLastSb']:
+                logScoreboard(d)
+            initGame(d)
+            sendBotStates(d)
+        else:
+            log(d.logPrefix() + "All games have been played.")
+            jsonScoreboard(d)
+            d.state['arenaFinished'] = True
+    elif d.conf['maxSecsToJoin'] < float(time.time() - d.state['startTime']): 
+        log(d.logPrefix() + "Not enough bots joined game before max seconds to join (" + str(d.conf['maxSecsToJoin']) + " secs).", "ERROR")
+        if len(d.bots) >= 2:
+            d.conf['botsInGame'] = len(d.bots)
+            log(d.logPrefix() + "Starting game with only " + str(d.conf['botsInGame']) + " bots.", "WARNING")
+        else:
+            log(d.logPrefix() + "Cannot start game with less than 2 bots.", "FAILURE")
+            d.state['arenaFinished'] = True
+
+    return False
+
+
+def main():
+    arenas = []
+    signal.signal(signal.SIGINT, functools.partial(quit, arenas))
 
     random.seed()
 
@@ -922,8 +1692,32 @@ def main():
                         default=1000, help='Max steps in one game.')
     parser.add_argument('-droprate', metavar='int', dest='dropRate', type=int,
                         default=11, help='Drop over nth message, best to use primes. 0 == no drop.')
+    parser.add_argument('-netloss', dest='netLoss', type=float, min=0, max=100, action=Range,
+                        default=0.0, help='Network emulation: %% of msgs to and from each bot that are lost at random. Replaces -droprate.')
+    parser.add_argument('-netburst', metavar=('start%', 'end%'), dest='netBurst', type=float, nargs=2,
+                        default=[0.0, 0.0], help='Network emulation: %% chance for each msg that a burst of lost msgs starts, and that it ends.')
+    parser.add_argument('-netlatency', metavar='sec', dest='netLatency', type=float,
+                        default=0.0, help='Network emulation: secs msgs to and from each bot are delayed.')
+    parser.add_argument('-netjitter', metavar='sec', dest='netJitter', type=float,
+                        default=0.0, help='Network emulation: msgs are delayed a random 0 to this many secs more than -netlatency.')
+    parser.add_argument('-netbw', metavar='bytes', dest='netBandwidth', type=int,
+                        default=0, help='Network emulation: bytes/sec the server can send to each bot. 0 == unlimited.')
+    parser.add_argument('-netseed', metavar='int', dest='netSeed', type=int,
+                        default=None, help='Network emulation: seed so the same msgs are lost and delayed in every run.')
     parser.add_argument('-msgperstep', metavar='int', dest='botMsgsPerStep', type=int,
                         default=4, help='Number of msgs from a bot that server will respond to each step.')
+    parser.add_argument('-botrate', metavar='msgs/sec', dest='botRate', type=float,
+                        default=None, help='Max msgs/sec server reads from each bot, in bursts of up to 2 * msgperstep. Others are skipped before they are decoded. Default is 2 * msgperstep / stepsec (no limit with -lockstep). 0 == no limit.')
+    parser.add_argument('-rcvbuf', metavar='bytes', dest='rcvBuf', type=int,
+                        default=0, help='Size of server socket receive buffer. 0 == OS default.')
+    parser.add_argument('-mtu', metavar='bytes', dest='mtu', type=int, min=520, max=65507, action=Range,
+                        default=4096, help='Msgs longer than this are sent in fragments. Use ~1400 for ethernet.')
+    parser.add_argument('-recvthread', dest='recvThread', action='store_true',
+                        default=False, help='Receive msgs in a separate thread so they are not dropped by the OS while the server is busy.')
+    parser.add_argument('-shm', dest='shm', action='store_true',
+                        default=False, help='Use shared memory instead of UDP with robots on this computer that ask for it. Not faster than UDP in benchmarks.py.')
+    parser.add_argument('-lockstep', dest='lockStep', action='store_true',
+                        default=False, help='Step as soon as all robots have sent a request with endTurn, waiting at most stepsec.')
     parser.add_argument('-arenasize', dest='arenaSize', type=int, min=100, max=32767, action=Range,
                         default=1000, help='Size of arena.')
     parser.add_argument('-botradius', metavar='int', dest='botRadius', type=int,
@@ -952,6 +1746,8 @@ def main():
                         default=False, help='Uses the simple collision system, damage taken is the same as -hitdamage')
     parser.add_argument('-startperms', dest='startPermutations', action='store_true',
                         default=False, help='Use all permutations of each set of random start locations.')
+    parser.add_argument('-collisioniterations', metavar='int', dest='collisionIterations', type=int,
+                        default=20, help='Max times each step server will move overlapping robots apart.')
     parser.add_argument('-scanmaxdistance', metavar='int', dest='scanMaxDistance', type=int,
                         default=1415, help='Maximum distance a scan can detect a robot.')
     parser.add_argument('-noviewers', dest='noViewers', action='store_true',
@@ -962,6 +1758,10 @@ def main():
                         default=False, help='Only print the scoreboard when the server quits.')
     parser.add_argument('-jsonsb', metavar='filename', dest='jsonScoreboard', type=str,
                         default=False, help='Save json formatted server data to filename before quiting.')
+    parser.add_argument('-arenas', dest='arenas', type=int, min=1, max=1000, action=Range,
+                        default=1, help='Number of arenas (games) to run at the same time. Bots join the arena in their joinRequest or the first arena waiting for bots.')
+    parser.add_argument('-engine', dest='engine', type=str, choices=['dict', 'numpy'],
+                        default='dict', help='Step engine. numpy is faster with a few hundred bots or more, slower with fewer. Requires numpy.')
     parser.add_argument('-debug', dest='debug', action='store_true',
                         default=False, help='Print DEBUG level log messages.')
     parser.add_argument('-verbose', dest='verbose', action='store_true',
@@ -969,99 +1769,104 @@ def main():
     args = parser.parse_args()
 
     setLogLevel(args.debug, args.verbose)
-    d.conf['serverName'] = args.serverName
-    d.conf['gamesToPlay'] = args.gamesToPlay
-    d.conf['botsInGame'] = args.botsInGame
-    d.conf['stepSec'] = args.stepSec
-    d.conf['stepMax'] = args.stepMax
-    d.conf['dropRate'] = args.dropRate
-    d.state['dropNext'] = args.dropRate
-    d.conf['botMsgsPerStep'] = args.botMsgsPerStep
-    d.conf['arenaSize'] = args.arenaSize
-    d.conf['botRadius'] = args.botRadius
-    d.conf['explRadius'] = args.explRadius
-    d.conf['botMaxSpeed'] = args.botMaxSpeed
-    d.conf['botAccRate'] = args.botAccRate
-    d.conf['shellSpeed'] = args.shellSpeed
-    d.conf['hitDamage'] = args.hitDamage
-    d.conf['explDamage'] = args.explDamage
-    d.conf['obstacleRadius'] = args.obstacleRadius
-    d.conf['obstacles'] = mkObstacles(d, args.obstacles)
-    d.conf['jamZones'] = mkJamZones(d, args.jamZones)
-    d.conf['allowClasses'] = args.allowClasses
-    d.conf['simpleCollisions'] = args.simpleCollisions
-    d.conf['startPermutations'] = args.startPermutations
-    d.conf['scanMaxDistance'] = args.scanMaxDistance
-    d.conf['noViewers'] = args.noViewers
-    d.conf['maxSecsToJoin'] = args.maxSecsToJoin
-    d.state['onlyLastSb'] = args.onlyLastSb
-    d.state['jsonScoreboard'] = args.jsonScoreboard
 
-    mkStartLocations(d)
+    if args.engine == 'numpy':
+        if nbnpengine is None:
+            log("-engine numpy requires numpy. Install it with 'pip3 install numpy'.", "FAILURE")
+            exit()
+        log("Using numpy step engine.")
+
+    for i in range(args.arenas):
+        arenas.append(mkArena(args, i + 1))
+    d = arenas[0]
 
     log("Server Name: " + d.conf['serverName'])
     log("Server Version: " + d.conf['serverVersion'])
     log("Argument List:" + str(sys.argv))
+    if len(arenas) > 1:
+        log("Arenas: " + str(len(arenas)))
 
     log("Server Configuration: " + str(d.conf), "VERBOSE")
 
     try:
-        d.srvSocket = nbipc.NetBotSocket(args.serverIP, args.serverPort)
+        srvSocket = nbipc.NetBotSocket(args.serverIP, args.serverPort)
     except Exception as e:
         log(str(e), "FAILURE")
-        quit()
-
-    nextStepAt = time.perf_counter() + d.conf['stepSec']
+        quit(arenas)
+    for d in arenas:
+        d.srvSocket = srvSocket
+
+    netem = mkNetEm(arenas[0].conf)
+    if netem:
+        for d in arenas:
+            d.netem = netem
+            d.conf['netSeed'] = netem.seed
+        log("Network emulation: loss " + str(args.netLoss) + "%, burst " + str(args.netBurst) + ", latency " +
+            str(args.netLatency) + " + 0-" + str(args.netJitter) + " secs, bandwidth " +
+            (str(args.netBandwidth) + " bytes/sec" if args.netBandwidth else "unlimited") +
+            ", seed " + str(netem.seed) + ". -droprate is not used.")
+
+    srvSocket.setMtu(args.mtu)
+    if arenas[0].conf['botRate']:
+        srvSocket.setRateLimit(arenas[0].conf['botRate'], arenas[0].conf['botBurst'])
+        log("Reading at most " + '%.1f' % arenas[0].conf['botRate'] + " msgs/sec (bursts of " +
+            str(arenas[0].conf['botBurst']) + ") from each robot.", "VERBOSE")
+    if args.rcvBuf:
+        log("Server socket receive buffer size: " + str(srvSocket.setRecvBufferSize(args.rcvBuf)) + " bytes.")
+    if args.recvThread:
+        srvSocket.startRecvThread()
+        log("Receiving msgs in a separate thread.")
+
+    routes = {}  # {src: SrvData, ...} arena each bot and viewer has joined.
+    # SelectSelector is used because it supports timeouts shorter than 1 ms, unlike
+    # epoll and poll, and we only need to wait on one socket.
+    sel = selectors.SelectSelector()
+    sel.register(srvSocket, selectors.EVENT_READ)
+    if args.shm:
+        shmDoorbell = srvSocket.startSharedMemory()
+        if shmDoorbell:
+            sel.register(shmDoorbell, selectors.EVENT_READ)
+            log("Using shared memory with robots on this computer that ask for it.")
+        else:
+            log("-shm ignored because shared memory is not available on this computer.", "WARNING")
+    stepSec = arenas[0].conf['stepSec']
+    nextStepAt = time.perf_counter() + stepSec
     while True:
-        aliveBots = 0
-        for src, bot in d.bots.items():
-            if bot['health'] != 0:
-                aliveBots += 1
-
-        # only count slow steps if we actually process a step this time around.
-        countSlowStep = False
-
-        if aliveBots > 0:  # if there is an ongoing game
-            countSlowStep = True
-            step(d)
-        elif len(d.bots) == d.conf['botsInGame']:  # if we have enough bots to start playing
-            if not d.state['tourStartTime']:
-                d.state['tourStartTime'] = time.time()
-
-            if d.conf['gamesToPlay'] != d.state['gameNumber']:
-                if not d.state['onlyLastSb']:
-                    logScoreboard(d)
-                initGame(d)
-            else:
-                log("All games have been played.")
-                jsonScoreboard(d)
-                quit()
-        elif d.conf['maxSecsToJoin'] < float(time.time() - d.state['startTime']): 
-            log("Not enough bots joined game before max seconds to join (" + str(d.conf['maxSecsToJoin']) + " secs).", "ERROR")
-            if len(d.bots) >= 2:
-                d.conf['botsInGame'] = len(d.bots)
-                log("Starting game with only " + str(d.conf['botsInGame']) + " bots.", "WARNING")
-            else:
-                log("Cannot start game with less than 2 bots. Exiting.", "FAILURE")
-                quit()
+        # only count slow steps in arenas that actually processed a step this time around.
+        steppedArenas = []
 
-        recvReplyMsgs(d)
+        # step all arenas round-robin on the same timer.
+        for d in arenas:
+            if runArena(d):
+                steppedArenas.append(d)
 
-        sendToViwers(d)
+        if all(d.state['arenaFinished'] for d in arenas):
+            quit(arenas)
 
-        ptime = time.perf_counter()
-        if ptime < nextStepAt:
-            d.state['sleepCount'] += 1
-            d.state['sleepTime'] += nextStepAt - ptime
-            while ptime < nextStepAt:
-                ptime = time.perf_counter()
-        elif countSlowStep:
-            d.state['longStepCount'] += 1
-            log("Server running slower than " + str(d.conf['stepSec']) + " sec/step.", "VERBOSE")
+        replyHeldMsgs(arenas)
+
+        recvReplyMsgs(arenas, routes)
+
+        serviceNetEm(arenas)
+
+        # free fragments of msgs that will never be completed, even if no new fragments arrive.
+        srvSocket.expireFragments()
+
+        for d in arenas:
+            sendToViwers(d)
+
+        if time.perf_counter() >= nextStepAt and steppedArenas:
+            for d in steppedArenas:
+                d.state['longStepCount'] += 1
+            log("Server running slower than " + str(stepSec) + " sec/step.", "VERBOSE")
+
+        # sleep until next step but reply to messages that arrive while waiting.
+        ptime = waitForNextStep(arenas, routes, sel, nextStepAt)
+
+        countMissedSteps(arenas)
 
-        nextStepAt = ptime + d.conf['stepSec']
+        nextStepAt = ptime + stepSec
 
 
 if __name__ == "__main__":
-    signal.signal(signal.SIGINT, quit)
     main()
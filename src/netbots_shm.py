@@ -0,0 +1,320 @@
+import atexit
+import itertools
+import os
+import struct
+import tempfile
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+    available = hasattr(os, 'mkfifo')
+except ImportError:
+    shared_memory = None
+    available = False
+
+"""
+Shared memory transport for robots running on the same computer as the server.
+
+Each robot gets a ShmChannel: one shared memory block holding two rings of msgs (robot to
+server and server to robot) and a named pipe (FIFO) the server rings as a doorbell to wake
+the robot when there is something to read. The server has one doorbell FIFO (ShmDoorbell)
+that all robots ring. A ring only rings its doorbell if the reader said it is waiting
+(armed) since the reader last looked, so a busy reader is not sent a doorbell per msg.
+
+Rings hold serialized msgs (the same bytes that would be sent by UDP) so NetBotSocket can
+use a channel in place of its socket. See NetBotSocket.startSharedMemory().
+
+Only works on computers with os.mkfifo() (i.e. not Windows) and python 3.8 or higher.
+"""
+
+
+class ShmProtocolError(Exception):
+    """ The other end of a ring wrote positions or lengths that can't be right. The channel can't be trusted. """
+    pass
+
+
+class ShmRing:
+    """
+    Single writer, single reader ring of variable length msgs in shared memory buf at offset.
+    Header is write position (Q), read position (Q) and reader waiting flag (B). Positions
+    count all bytes ever written so they never wrap. Each msg is a 4 byte length followed
+    by the msg. A msg that does not fit before the end of the ring starts at the beginning
+    after a Wrap length (if there is room for one).
+    """
+    Header = struct.Struct('<QQB')
+    HeaderSize = 64
+    Length = struct.Struct('<I')
+    Wrap = 0xFFFFFFFF
+
+    def __init__(self, buf, offset, size):
+        self.buf = buf
+        self.offset = offset
+        self.data = offset + self.HeaderSize
+        self.size = size
+        self.armed = False  # reader has set the waiting flag (see arm() and rung()).
+
+    @classmethod
+    def bytesNeeded(cls, size):
+        return cls.HeaderSize + size
+
+    def put(self, msg):
+        """ Add msg (bytes) to ring. Returns False if there is no room. """
+        n = len(msg)
+        need = 4 + n
+        w, r, waiting = self.Header.unpack_from(self.buf, self.offset)
+        i = w % self.size
+        room = self.size - i
+        if room < need:
+            # msg does not fit before the end of the ring so skip to the beginning.
+            if w + room + need - r > self.size:
+                return False
+            if room >= 4:
+                self.Length.pack_into(self.buf, self.data + i, self.Wrap)
+            w += room
+            i = 0
+        elif w + need - r > self.size:
+            return False
+
+        self.Length.pack_into(self.buf, self.data + i, n)
+        self.buf[self.data + i + 4:self.data + i + 4 + n] = msg
+        # write position is stored after the msg so the reader never sees a partly written msg.
+        struct.pack_into('<Q', self.buf, self.offset, w + need)
+        return True
+
+    def get(self):
+        """
+        Return next msg (bytes) from ring or None if ring is empty. The writer may be another
+        process, so positions and lengths are checked and ShmProtocolError is raised if they
+        point outside the ring or past what has been written.
+        """
+        w, r, waiting = self.Header.unpack_from(self.buf, self.offset)
+        if r == w:
+            return None
+        if w < r or w - r > self.size:
+            raise ShmProtocolError("Ring write position is invalid.")
+        i = r % self.size
+        room = self.size - i
+        if room < 4 or self.Length.unpack_from(self.buf, self.data + i)[0] == self.Wrap:
+            r += room
+            i = 0
+            room = self.size
+        n = self.Length.unpack_from(self.buf, self.data + i)[0]
+        if n > self.size or 4 + n > room or r + 4 + n > w:
+            raise ShmProtocolError("Ring msg length is invalid.")
+        msg = bytes(self.buf[self.data + i + 4:self.data + i + 4 + n])
+        struct.pack_into('<Q', self.buf, self.offset + 8, r + 4 + n)
+        return msg
+
+    def isEmpty(self):
+        w, r, waiting = self.Header.unpack_from(self.buf, self.offset)
+        return r == w
+
+    def arm(self):
+        """ Reader is about to wait. Returns True if the ring is still empty, otherwise reader should not wait. """
+        if not self.armed:
+            self.buf[self.offset + 16] = 1
+            self.armed = True
+        return self.isEmpty()
+
+    def rung(self):
+        """ Returns True (once) if the writer rang the reader's doorbell after arm(). """
+        if self.armed and not self.buf[self.offset + 16]:
+            self.armed = False
+            return True
+        return False
+
+    def disarm(self):
+        """
+        Called by writer after put(). Returns True if the reader was waiting (armed), in which
+        case the writer must ring the reader's doorbell.
+        """
+        if self.buf[self.offset + 16]:
+            self.buf[self.offset + 16] = 0
+            return True
+        return False
+
+
+def ringDoorbell(fd):
+    try:
+        os.write(fd, b'\0')
+    except OSError:
+        # pipe is full (doorbell is already ringing) or reader has gone.
+        pass
+
+
+def openFifo(path):
+    """
+    Return non-blocking fd of FIFO at path opened for read and write. The reader opens its
+    own FIFO for writing too so select() does not see end of file when there are no writers,
+    and writers open for reading too so they can open the FIFO before the reader does.
+    """
+    return os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+
+def mkFifoPath(name):
+    return os.path.join(tempfile.gettempdir(), name + ".fifo")
+
+
+# owned (created by this process) ShmDoorbells and ShmChannels that must be removed when the process quits.
+owned = set()
+names = itertools.count(1)
+
+
+def closeOwned():
+    for o in list(owned):
+        o.close()
+
+
+atexit.register(closeOwned)
+
+
+class ShmDoorbell:
+    """
+    Reading end of a FIFO used as a doorbell. fileno() is readable when it has been rung. The
+    server creates one (see create()) that all robots ring and each robot reads its own.
+    """
+
+    def __init__(self, path, owner=False):
+        self.path = path
+        self.owner = owner  # remove FIFO on close()
+        self.fd = openFifo(path)
+        self.owed = 0  # rings known of (see ShmRing.rung()) that have not been read from the FIFO yet.
+        if owner:
+            owned.add(self)
+
+    @classmethod
+    def create(cls, port):
+        """ Return new ShmDoorbell for the server listening on port. """
+        path = mkFifoPath("netbots-" + str(os.getpid()) + "-" + str(port))
+        if os.path.exists(path):
+            os.unlink(path)
+        os.mkfifo(path, 0o600)
+        return cls(path, True)
+
+    def fileno(self):
+        return self.fd
+
+    def answer(self):
+        """
+        Read owed rings so fileno() is no longer readable. Only reads when a ring is owed so
+        the reader does not make a system call for every check of its rings.
+        """
+        if self.owed > 0:
+            try:
+                self.owed -= len(os.read(self.fd, 4096))
+            except BlockingIOError:
+                # writer has cleared the waiting flag but not written to the FIFO yet.
+                pass
+
+    def close(self):
+        owned.discard(self)
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            if self.owner:
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
+
+
+class ShmChannel:
+    """
+    Two ShmRings (robot to server, server to robot) in one shared memory block and the FIFO
+    doorbells of each end. Create with ShmChannel.create() on the server and attach to it
+    with ShmChannel.attach() in the robot using the info dict from create().
+    """
+    RingSize = 256 * 1024
+
+    def __init__(self, shm, info, server, doorbell=None):
+        self.shm = shm
+        self.info = info
+        self.server = server
+        ringBytes = ShmRing.bytesNeeded(self.RingSize)
+        toServer = ShmRing(shm.buf, 0, self.RingSize)
+        toBot = ShmRing(shm.buf, ringBytes, self.RingSize)
+        if server:
+            self.sendRing, self.recvRing = toBot, toServer
+            self.sendFd = openFifo(info['botFifo'])
+            self.recvDoorbell = doorbell  # shared by all channels so not closed by close().
+        else:
+            self.sendRing, self.recvRing = toServer, toBot
+            self.sendFd = openFifo(info['srvFifo'])
+            self.recvDoorbell = ShmDoorbell(info['botFifo'])
+        # The server only sends on the channel once the robot has sent on it, so msgs sent before
+        # the robot attached (eg. joinReply) go by UDP.
+        self.active = not server
+
+    @classmethod
+    def create(cls, doorbell):
+        """ Return new ShmChannel (server end). doorbell is the server's ShmDoorbell. """
+        name = "netbots_" + str(os.getpid()) + "_" + str(next(names))
+        botFifo = mkFifoPath(name)
+        os.mkfifo(botFifo, 0o600)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=2 * ShmRing.bytesNeeded(cls.RingSize))
+        except Exception:
+            os.unlink(botFifo)
+            raise
+        # new shared memory is all zeros, which is two empty rings.
+        channel = cls(shm, {'name': name, 'srvFifo': doorbell.path, 'botFifo': botFifo}, True, doorbell)
+        # ring the server's doorbell for the robot's first msg.
+        channel.recvRing.arm()
+        owned.add(channel)
+        return channel
+
+    @classmethod
+    def attach(cls, info):
+        """ Return ShmChannel (robot end) for info from ShmChannel.create(). """
+        try:
+            shm = shared_memory.SharedMemory(name=info['name'], track=False)
+        except TypeError:
+            # python < 3.13 always tracks shared memory and would remove it when the robot quits.
+            shm = shared_memory.SharedMemory(name=info['name'])
+            if not any(isinstance(o, ShmChannel) and o.info['name'] == info['name'] for o in owned):
+                resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm, info, False)
+
+    def send(self, msg):
+        """ Add msg to the send ring and wake the other end if it is waiting. Returns False if the ring is full. """
+        if not self.sendRing.put(msg):
+            return False
+        if self.sendRing.disarm():
+            ringDoorbell(self.sendFd)
+        return True
+
+    def recv(self):
+        """ Return next msg (bytes) from the recv ring or None if it is empty. Raises ShmProtocolError (see ShmRing.get()). """
+        return self.recvRing.get()
+
+    def answer(self):
+        """ Answer the doorbell if the other end rang it. Call before recv(). """
+        if self.recvRing.rung():
+            self.recvDoorbell.owed += 1
+        self.recvDoorbell.answer()
+
+    def wait(self):
+        """
+        Ask the other end to ring the doorbell (recvDoorbell) when it sends. Returns True if
+        the recv ring is still empty, otherwise recv() again instead of waiting.
+        """
+        return self.recvRing.arm()
+
+    def close(self):
+        owned.discard(self)
+        if self.shm is None:
+            return
+        os.close(self.sendFd)
+        if not self.server:
+            self.recvDoorbell.close()
+        self.shm.close()
+        if self.server:
+            try:
+                self.shm.unlink()
+            except OSError:
+                pass
+            try:
+                os.unlink(self.info['botFifo'])
+            except OSError:
+                pass
+        self.shm = None
@@ -1,15 +1,16 @@
 import time
-import re
-import copy
+import bisect
 
 from netbots_log import log
 import netbots_math as nbmath
+import netbots_ipc as nbipc
+import netbots_entities as nbent
 
 
 def joinRequest(d, msg, src):
     if src in d.bots:
         if d.conf['allowRejoin']:
-            d.bots[src]['name'] = msg['name']
+            d.bots[src].name = msg['name']
             result = "OK"
         else:
             result = "Bot at " + src + " is already in game. Can't join twice."
@@ -27,18 +28,37 @@ def joinRequest(d, msg, src):
         result = "Message contained class that is not known to server."
         log("Bot from " + src + " requested class that is not known to server.")
     else:
-        d.bots[src] = copy.deepcopy(d.botTemplate)
-        d.bots[src]['name'] = msg['name']
+        bot = nbent.Bot(msg['name'])
         if 'class' in msg:
-            d.bots[src]['class'] = msg['class']
+            bot.botClass = msg['class']
+        # resolve class values once so step() does not need to look them up.
+        bot.classValues = d.getClassValues(bot.botClass)
+        d.bots[src] = bot
         d.startBots.append(src)
+        d.scanCache = None
         result = "OK"
-        log("Bot joined game: " + d.bots[src]['name'] + " (" + src + ")")
+        log(d.logPrefix() + "Bot joined game: " + d.bots[src].name + " (" + src + ")")
 
-    log("Bots in Game: " + str(d.bots), "VERBOSE")
+    log(lambda: "Bots in Game: " + str(nbent.botsToDicts(d.bots)), "VERBOSE")
+
+    # A rejoining bot starts its msgIDs again so replies cached for the old bot must not be used.
+    d.replyCache.pop(src, None)
 
     if result == "OK":
-        return {'type': "joinReply", 'conf': d.conf}
+        reply = {'type': "joinReply", 'conf': d.conf}
+        # Agree to the codec the bot asked for (if we know it). Otherwise the bot keeps using msgpack.
+        codec = msg['codec'] if 'codec' in msg and msg['codec'] in nbipc.Codecs else None
+        if codec:
+            reply['codec'] = codec
+        if d.srvSocket:
+            d.srvSocket.setCodec(src, codec)
+            # Offer shared memory to bots on the same computer that ask for it.
+            shm = d.srvSocket.openSharedMemory(src) if 'shm' in msg and msg['shm'] else None
+            if shm:
+                reply['shm'] = shm
+            else:
+                d.srvSocket.closeSharedMemory(src)
+        return reply
     else:
         return {'type': 'Error', 'result': result}
 
@@ -48,66 +68,70 @@ def getInfoRequest(d, msg, src):
         'type': "getInfoReply",
         'gameNumber': d.state['gameNumber'],
         'gameStep': d.state['gameStep'],
-        'health': d.bots[src]['health'],
-        'points': d.bots[src]['points']
+        'health': d.bots[src].health,
+        'points': d.bots[src].points
     }
 
 
 def getLocationRequest(d, msg, src):
-    if d.bots[src]['health'] == 0:
+    if d.bots[src].health == 0:
         return {'type': 'Error', 'result': "Can't process getLocationRequest when health == 0"}
     else:
         return {
             'type': "getLocationReply",
-            'x': d.bots[src]['x'],
-            'y': d.bots[src]['y']
+            'x': d.bots[src].x,
+            'y': d.bots[src].y
         }
 
 
 def getSpeedRequest(d, msg, src):
-    if d.bots[src]['health'] == 0:
+    if d.bots[src].health == 0:
         return {'type': 'Error', 'result': "Can't process getSpeedRequest when health == 0"}
     else:
         return {
             'type': "getSpeedReply",
-            'requestedSpeed': d.bots[src]['requestedSpeed'],
-            'currentSpeed': d.bots[src]['currentSpeed']
+            'requestedSpeed': d.bots[src].requestedSpeed,
+            'currentSpeed': d.bots[src].currentSpeed
         }
 
 
 def setSpeedRequest(d, msg, src):
-    if d.bots[src]['health'] == 0:
+    if d.bots[src].health == 0:
         return {'type': 'Error', 'result': "Can't process setSpeedRequest when health == 0"}
     else:
-        d.bots[src]['requestedSpeed'] = msg['requestedSpeed']
+        d.bots[src].requestedSpeed = msg['requestedSpeed']
+        if d.engine:
+            d.engine.botChanged(src)
         return {
             'type': "setSpeedReply",
         }
 
 
 def getDirectionRequest(d, msg, src):
-    if d.bots[src]['health'] == 0:
+    if d.bots[src].health == 0:
         return {'type': 'Error', 'result': "Can't process getDirectionRequest when health == 0"}
     else:
         return {
             'type': "getDirectionReply",
-            'requestedDirection': d.bots[src]['requestedDirection'],
-            'currentDirection': d.bots[src]['currentDirection']
+            'requestedDirection': d.bots[src].requestedDirection,
+            'currentDirection': d.bots[src].currentDirection
         }
 
 
 def setDirectionRequest(d, msg, src):
-    if d.bots[src]['health'] == 0:
+    if d.bots[src].health == 0:
         return {'type': 'Error', 'result': "Can't process setDirectionRequest when health == 0"}
     else:
-        d.bots[src]['requestedDirection'] = msg['requestedDirection']
+        d.bots[src].requestedDirection = msg['requestedDirection']
+        if d.engine:
+            d.engine.botChanged(src)
         return {
             'type': "setDirectionReply"
         }
 
 
 def getCanonRequest(d, msg, src):
-    if d.bots[src]['health'] == 0:
+    if d.bots[src].health == 0:
         return {'type': 'Error', 'result': "Can't process getCanonRequest when health == 0"}
     else:
         return {
@@ -117,53 +141,101 @@ def getCanonRequest(d, msg, src):
 
 
 def fireCanonRequest(d, msg, src):
-    if d.bots[src]['health'] == 0:
+    if d.bots[src].health == 0:
         return {'type': 'Error', 'result': "Can't process fireCanonRequest when health == 0"}
     else:
         # Note, if shell in progress then this will replace it with new shell without causing any damage.
         # This overwriting is the expected behaviour.
 
-        d.shells[src] = {
-            'x': d.bots[src]['x'],
-            'y': d.bots[src]['y'],
-            'direction': msg['direction'],
-            'distanceRemaining': msg['distance']
-        }
+        bot = d.bots[src]
+        d.shells[src] = nbent.Shell(bot.x, bot.y, msg['direction'], msg['distance'])
 
-        d.bots[src]['firedCount'] += 1
+        bot.firedCount += 1
 
-        d.bots[src]['last']['fireCanonRequest'] = {'direction': msg['direction'], 'distance': msg['distance']}
+        bot.lastFireDirection = msg['direction']
+        bot.lastFireDistance = msg['distance']
 
         return {
             'type': "fireCanonReply",
         }
 
 
+class ScanCache:
+    """
+    Bots only move and change health in step() so which bots are jammed and the angle and
+    distance from a scanning bot to every other bot only need to be found once per step,
+    not once per scanRequest. The server sets d.scanCache to None whenever bots move, join,
+    or change health and scanRequest() builds a new ScanCache when it is needed.
+    """
+
+    def __init__(self, d):
+        self.d = d
+        self.visible = None  # [bot, ...] alive bots that are not fully inside a jam zone.
+        self.tables = {}  # {src: ([angle, ...], [distance, ...]), ...} bots src can see, sorted by angle.
+
+    def getVisible(self):
+        """ Return alive bots that are not fully inside a jam zone. """
+        if self.visible is None:
+            d = self.d
+            self.visible = []
+            for bot2 in d.bots.values():
+                if bot2.health != 0:
+                    # don't detect bot2 if it's fully inside a jam Zone.
+                    jammed = False
+                    for jz in d.conf['jamZones']:
+                        if nbmath.distance(bot2.x, bot2.y, jz['x'], jz['y']) + d.conf['botRadius'] < jz['radius']:
+                            jammed = True
+                            break
+                    if not jammed:
+                        self.visible.append(bot2)
+        return self.visible
+
+    def getTable(self, src):
+        """
+        Return ([angle, ...], [distance, ...]) from bot src to each bot it could detect with a
+        scan, sorted by angle. Bots farther than scanMaxDistance are not included.
+        """
+        if src not in self.tables:
+            bot = self.d.bots[src]
+            polar = []
+            for bot2 in self.getVisible():
+                if bot2 is not bot:
+                    # same values as nbmath.contains() would find.
+                    dis = nbmath.distance(bot.x, bot.y, bot2.x, bot2.y)
+                    if dis <= self.d.conf['scanMaxDistance'] and dis != 0:
+                        polar.append((nbmath.angle(bot.x, bot.y, bot2.x, bot2.y), dis))
+            polar.sort()
+            self.tables[src] = ([p[0] for p in polar], [p[1] for p in polar])
+        return self.tables[src]
+
+    def scan(self, src, startRad, endRad):
+        """
+        Return distance to the nearest bot src can detect between startRad and counter clockwise
+        to endRad or 0 if no bot is detected. Same as testing every bot with nbmath.contains().
+        """
+        angles, distances = self.getTable(src)
+        if startRad >= endRad:  # if we are scanning clockwise over 0 radians.
+            found = distances[bisect.bisect_left(angles, startRad):] + \
+                distances[:bisect.bisect_right(angles, endRad)]
+        else:
+            found = distances[bisect.bisect_left(angles, startRad):bisect.bisect_right(angles, endRad)]
+
+        if found:
+            return min(found)
+        return 0
+
+
 def scanRequest(d, msg, src):
-    if d.bots[src]['health'] == 0:
+    if d.bots[src].health == 0:
         return {'type': 'Error', 'result': "Can't process ScanRequest when health == 0"}
     else:
-        distance = 0
         bot = d.bots[src]
-        for src2, bot2 in d.bots.items():
-            if src != src2 and bot2['health'] != 0:
-                # don't detect bot2 if it's fully inside a jam Zone.
-                jammed = False
-                for jz in d.conf['jamZones']:
-                    if nbmath.distance(bot2['x'], bot2['y'], jz['x'], jz['y']) + d.conf['botRadius'] < jz['radius']:
-                        jammed = True
-
-                if not jammed:
-                    dis = nbmath.contains(bot['x'], bot['y'], msg['startRadians'],
-                                          msg['endRadians'], bot2['x'], bot2['y'])
-                    
-                    if dis <= d.conf['scanMaxDistance'] and dis != 0:
-                        if distance == 0:
-                            distance = dis
-                        elif dis < distance:
-                            distance = dis
-        
-        d.bots[src]['last']['scanRequest'] = {'startRadians': msg['startRadians'], 'endRadians': msg['endRadians']}
+        if d.scanCache is None:
+            d.scanCache = ScanCache(d)
+        distance = d.scanCache.scan(src, msg['startRadians'], msg['endRadians'])
+
+        bot.lastScanStart = msg['startRadians']
+        bot.lastScanEnd = msg['endRadians']
 
         return {
             'type': "scanReply",
@@ -171,6 +243,18 @@ def scanRequest(d, msg, src):
         }
 
 
+def subscribeRequest(d, msg, src):
+    everySteps = msg['everySteps'] if 'everySteps' in msg else 1
+    if everySteps == 0:
+        if src in d.subscribers:
+            del d.subscribers[src]
+    else:
+        ip, port = nbipc.toAddress(src)
+        d.subscribers[src] = {'ip': ip, 'port': port, 'everySteps': everySteps}
+
+    return {'type': "subscribeReply"}
+
+
 def addViewerRequest(d, msg, src):
     if d.conf['noViewers']:
         return {'type': 'Error', 'result': "Viewers are not allowed to join."}
@@ -181,11 +265,11 @@ def addViewerRequest(d, msg, src):
     elif src in d.viewers:
         d.viewers[src]['lastKeepAlive'] = time.time()
     else:
-        ipPort = re.split('[-:]', src)  # create [str(ip),str(port)]
+        ip, port = nbipc.toAddress(src)
         d.viewers[src] = {
             'lastKeepAlive': time.time(),
-            'ip': ipPort[0],
-            'port': int(ipPort[1])
+            'ip': ip,
+            'port': port
         }
         log("Viewer started watching game: " + src)
 
@@ -441,6 +441,8 @@ def main():
                         default='127.0.0.1', help='Server IP Address')
     parser.add_argument('-sp', metavar='Server Port', dest='serverPort', type=int, nargs='?',
                         default=20000, help='Server port number')
+    parser.add_argument('-arena', metavar='int', dest='arena', type=int, nargs='?',
+                        default=None, help='Arena to watch if server runs more than one arena (see server -arenas).')
     parser.add_argument('-randcolors', dest='randomColors', action='store_true',
                         default=False, help='Randomizes bot colors in viewer')
     parser.add_argument('-debug', dest='debug', action='store_true',
@@ -456,7 +458,10 @@ def main():
 
     try:
         d.viewerSocket = nbipc.NetBotSocket(args.myIP, args.myPort, d.srvIP, d.srvPort)
-        reply = d.viewerSocket.sendRecvMessage({'type': 'addViewerRequest'}, retries=60, delay=1, delayMultiplier=1)
+        msg = {'type': 'addViewerRequest'}
+        if args.arena:
+            msg['arena'] = args.arena
+        reply = d.viewerSocket.sendRecvMessage(msg, retries=60, delay=1, delayMultiplier=1)
         d.conf = reply['conf']
         log("Server Configuration: " + str(d.conf), "VERBOSE")
     except Exception as e:
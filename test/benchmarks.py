@@ -0,0 +1,319 @@
+import os
+import sys
+import math
+import time
+import random
+import contextlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# include the netbot src directory in sys.path so we can import modules from it.
+robotpath = os.path.dirname(os.path.abspath(__file__))
+srcpath = os.path.join(os.path.dirname(robotpath), "src")
+sys.path.insert(0, srcpath)
+
+import netbots_server as nbsrv
+import netbots_ipc as nbipc
+import netbots_entities as nbent
+import netbots_pack as nbpack
+import netbots_shm as nbshm
+import netbots_netem as nbnetem
+import umsgpack
+from netbots_log import log
+
+"""
+Micro benchmarks of server hot spots. Run with: python test/benchmarks.py
+Results are printed as microseconds per call so they can be compared between changes.
+"""
+
+
+def timeIt(f, n):
+    """ Return microseconds per call of f() averaged over n calls. """
+    startTime = time.perf_counter()
+    for i in range(n):
+        f()
+    return (time.perf_counter() - startTime) / n * 1000000
+
+
+def mkViewData(numBots):
+    """ Return a viewData msg like the server sends to viewers for an arena with numBots bots. """
+    d = nbsrv.SrvData()
+    for i in range(numBots):
+        bot = nbent.Bot("bot" + str(i))
+        bot.health = 100
+        d.bots["127.0.0.1:" + str(20100 + i)] = bot
+        d.shells["127.0.0.1:" + str(20100 + i)] = nbent.Shell()
+    return {
+        'type': 'viewData',
+        'state': d.state,
+        'bots': nbent.botsToDicts(d.bots),
+        'shells': nbent.shellsToDicts(d.shells),
+        'explosions': {}
+        }
+
+
+def benchmarkIsValidMsg(n=100000):
+    """ Print cost of nbipc.isValidMsg() for a typical msg of each type. """
+    msgs = [
+        {'type': 'joinRequest', 'name': "Robot", 'class': "heavy"},
+        {'type': 'getInfoRequest', 'msgID': 1},
+        {'type': 'getInfoRequest', 'msgID': 1, 'endTurn': True},
+        {'type': 'getInfoReply', 'gameNumber': 1, 'gameStep': 10, 'health': 100, 'points': 0, 'msgID': 1},
+        {'type': 'getLocationReply', 'x': 100.5, 'y': 200.5, 'msgID': 1},
+        {'type': 'setSpeedRequest', 'requestedSpeed': 50, 'msgID': 1},
+        {'type': 'setDirectionRequest', 'requestedDirection': math.pi, 'msgID': 1},
+        {'type': 'fireCanonRequest', 'direction': math.pi, 'distance': 100, 'msgID': 1},
+        {'type': 'scanRequest', 'startRadians': 0, 'endRadians': math.pi, 'msgID': 1},
+        {'type': 'scanReply', 'distance': 300.5, 'msgID': 1},
+        {'type': 'Error', 'result': "Error message", 'msgID': 1},
+        mkViewData(4),
+        ]
+
+    log("isValidMsg() cost per msg type:")
+    for msg in msgs:
+        us = timeIt(lambda: nbipc.isValidMsg(msg), n)
+        log("    {:>20} {:8.3f} us".format(msg['type'], us))
+
+
+def benchmarkLog(n=20000):
+    """ Print cost of log() for a msg that is turned off and for a msg that is printed. """
+    viewData = mkViewData(4)
+
+    log("log() cost:")
+    us = timeIt(lambda: log(lambda: "viewData: " + str(viewData), "DEBUG"), n)
+    log("    {:>20} {:8.3f} us".format("DEBUG off", us))
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        us = timeIt(lambda: log("Short message."), n)
+    log("    {:>20} {:8.3f} us".format("INFO", us))
+
+
+def benchmarkCodecs(n=20000):
+    """ Print size and cost to serialize and deserialize typical bot msgs with each codec. """
+    msgs = [
+        {'type': 'getInfoRequest', 'msgID': 1},
+        {'type': 'getInfoReply', 'gameNumber': 1, 'gameStep': 10, 'health': 100, 'points': 0, 'msgID': 1},
+        {'type': 'scanRequest', 'startRadians': 0, 'endRadians': math.pi, 'msgID': 1},
+        {'type': 'scanReply', 'distance': 300.5, 'msgID': 1},
+        ]
+    s = nbipc.NetBotSocket("127.0.0.1", 0)
+
+    log("Codec size and cost (serialize + deserialize) per msg type:")
+    for codec in nbipc.Codecs:
+        for msg in msgs:
+            b = s.serialize(msg, codec)
+            us = timeIt(lambda: s.deserialize(s.serialize(msg, codec)), n)
+            log("    {:>8} {:>20} {:4d} bytes {:8.3f} us".format(codec, msg['type'], len(b), us))
+
+    s.s.close()
+
+
+def benchmarkMsgpack(n=5000):
+    """ Print cost to pack and unpack msgs with netbots_pack, umsgpack, and binary msgpack (if installed). """
+    msgs = [
+        {'type': 'getInfoReply', 'gameNumber': 1, 'gameStep': 10, 'health': 100, 'points': 0, 'msgID': 1},
+        {'type': 'scanRequest', 'startRadians': 0, 'endRadians': math.pi, 'msgID': 1},
+        mkViewData(4),
+        ]
+    packers = [('netbots_pack', nbpack.packb, nbpack.unpackb), ('umsgpack', umsgpack.packb, umsgpack.unpackb)]
+    if msgpack:
+        packers.append(('msgpack', lambda o: msgpack.packb(o, use_bin_type=True),
+                        lambda b: msgpack.unpackb(b, raw=False)))
+
+    log("msgpack pack / unpack cost per msg type:")
+    for name, packb, unpackb in packers:
+        for msg in msgs:
+            b = packb(msg)
+            packUs = timeIt(lambda: packb(msg), n)
+            try:
+                unpackUs = "{:8.3f} us".format(timeIt(lambda: unpackb(b), n))
+            except Exception as e:
+                # umsgpack.unpackb() does not work on newer versions of python.
+                unpackUs = "failed: " + str(e)
+            log("    {:>12} {:>14} {:8.3f} us / {}".format(name, msg['type'], packUs, unpackUs))
+
+
+def benchmarkSocket(n=20000):
+    """ Print cost of sendMessage() + recvMessage() of one msg between two sockets on localhost. """
+    s1 = nbipc.NetBotSocket("127.0.0.1", 0)
+    s2 = nbipc.NetBotSocket("127.0.0.1", 0)
+    port2 = s2.s.getsockname()[1]
+    msg = {'type': 'getInfoRequest', 'msgID': 1}
+
+    def sendRecv():
+        s1.sendMessage(msg, "127.0.0.1", port2)
+        s2.recvMessage()
+
+    burst = [s1.serialize(msg)] * 100
+    msgs = []
+
+    def drain():
+        for b in burst:
+            s1.sendMessage(b, "127.0.0.1", port2, packedAndChecked=True)
+        s2.recvMessages(msgs=msgs)
+
+    log("Socket cost per msg:")
+    us = timeIt(sendRecv, n)
+    log("    {:>20} {:8.3f} us".format("send + recv", us))
+    us = timeIt(drain, n // len(burst)) / len(burst)
+    log("    {:>20} {:8.3f} us".format("send + recvMessages", us))
+
+    s1.s.close()
+    s2.s.close()
+
+
+def benchmarkSharedMemory(n=20000):
+    """ Print cost of a request and reply between a robot and the server socket by UDP and by shared memory. """
+    srv = nbipc.NetBotSocket("127.0.0.1", 0)
+    bot = nbipc.NetBotSocket("127.0.0.1", 0)
+    srvPort = srv.s.getsockname()[1]
+    botPort = bot.s.getsockname()[1]
+    bot.settimeout(1)
+    request = {'type': 'getInfoRequest', 'msgID': 1}
+    reply = {'type': 'getInfoReply', 'gameNumber': 1, 'gameStep': 10, 'health': 100, 'points': 0, 'msgID': 1}
+    msgs = []
+
+    def roundTrip():
+        bot.sendMessage(request, "127.0.0.1", srvPort)
+        del msgs[:]
+        while not msgs:
+            srv.recvMessages(msgs=msgs)
+        srv.sendMessage(reply, "127.0.0.1", botPort)
+        bot.recvMessage()
+
+    log("Request + reply cost:")
+    us = timeIt(roundTrip, n)
+    log("    {:>20} {:8.3f} us".format("UDP", us))
+
+    if srv.startSharedMemory():
+        info = srv.openSharedMemory(("127.0.0.1", botPort))
+        bot.attachSharedMemory(("127.0.0.1", srvPort), info)
+        roundTrip()  # server sends by shared memory once bot has.
+        us = timeIt(roundTrip, n)
+        log("    {:>20} {:8.3f} us".format("shared memory", us))
+        srv.closeSharedMemory(("127.0.0.1", botPort))
+        bot.closeSharedMemory(("127.0.0.1", srvPort))
+        srv.shmDoorbell.close()
+
+    srv.s.close()
+    bot.s.close()
+
+
+def benchmarkNetEm(n=100000):
+    """ Print cost per msg of -droprate and of network emulation loss and delay with many msgs in flight. """
+    d = nbsrv.SrvData()
+    em = nbnetem.NetEm(loss=5, burst=(1, 30), latency=0.05, jitter=0.01, bandwidth=100000, seed=1)
+    srcs = ["127.0.0.1:" + str(20100 + i) for i in range(64)]
+    now = [0.0]
+
+    def lose():
+        em.lose(srcs[int(now[0]) % 64])
+        now[0] += 1
+
+    def delay():
+        # deliver msgs 0.1 secs after they are scheduled so thousands of msgs are in flight.
+        now[0] += 0.00001
+        em.schedule(srcs[int(now[0] * 100000) % 64], 50, now[0], int)
+        em.service(now[0] - 0.1)
+
+    log("Network emulation cost per msg:")
+    us = timeIt(lambda: nbsrv.dropMessage(d), n)
+    log("    {:>20} {:8.3f} us".format("-droprate", us))
+    us = timeIt(lose, n)
+    log("    {:>20} {:8.3f} us".format("loss", us))
+    us = timeIt(delay, n)
+    log("    {:>20} {:8.3f} us ({} in flight)".format("delay", us, len(em.heap)))
+
+
+def benchmarkRateLimit(n=100000):
+    """ Print cost per datagram received of decoding a msg and of skipping one over the rate limit. """
+    s = nbipc.NetBotSocket("127.0.0.1", 0)
+    networkbytes = s.serialize({'type': 'scanRequest', 'startRadians': 0.5, 'endRadians': 1.5, 'msgID': 2})
+    msgs = []
+
+    def decode():
+        msgs.clear()
+        s.decodeInto(msgs, networkbytes, ("127.0.0.1", 20100))
+
+    log("Rate limit cost per datagram:")
+    us = timeIt(decode, n)
+    log("    {:>20} {:8.3f} us".format("no limit", us))
+    s.setRateLimit(1e9, 1e9)
+    us = timeIt(decode, n)
+    log("    {:>20} {:8.3f} us".format("admitted", us))
+    s.setRateLimit(0.001, 1)
+    us = timeIt(decode, n)
+    log("    {:>20} {:8.3f} us".format("throttled", us))
+
+    s.s.close()
+
+
+def mkEngineGame(numBots, engine):
+    """ Return SrvData with numBots bots spread over an arena sized so bots have room to move. """
+    d = nbsrv.SrvData()
+    rand = random.Random(1)
+    d.conf['botsInGame'] = numBots
+    d.conf['arenaSize'] = max(1000, int(math.sqrt(numBots) * 150))
+    for i in range(numBots):
+        bot = nbent.Bot("bot" + str(i))
+        bot.health = 100
+        bot.x = rand.random() * d.conf['arenaSize']
+        bot.y = rand.random() * d.conf['arenaSize']
+        d.bots["127.0.0.1:" + str(20100 + i)] = bot
+    d.updateClassValues()
+    if engine == 'numpy':
+        d.engine = nbsrv.nbnpengine.NumpyEngine()
+    return d
+
+
+def benchmarkEngines(n=100):
+    """ Print cost of a server step with the dict and numpy engines while bots move and fire. """
+    log("Step cost (20% of bots change speed or direction and 10% fire each step):")
+    for numBots in (4, 100, 500, 2000):
+        for engine in ('dict', 'numpy'):
+            if engine == 'numpy' and nbsrv.nbnpengine is None:
+                log("    numpy not installed, skipping numpy engine.")
+                continue
+            d = mkEngineGame(numBots, engine)
+            rand = random.Random(2)
+            stepTime = [0.0]
+
+            def step():
+                # bots send requests between steps as they would during a game.
+                for src, bot in d.bots.items():
+                    if bot.health == 0:
+                        continue
+                    r = rand.random()
+                    if r < 0.1:
+                        nbsrv.processMsg(d, {'type': 'setSpeedRequest', 'requestedSpeed': rand.random() * 100}, src)
+                    elif r < 0.2:
+                        nbsrv.processMsg(d, {'type': 'setDirectionRequest',
+                                             'requestedDirection': rand.random() * 2 * math.pi}, src)
+                    if rand.random() < 0.1:
+                        nbsrv.processMsg(d, {'type': 'fireCanonRequest', 'direction': rand.random() * 2 * math.pi,
+                                             'distance': rand.random() * 300 + 10}, src)
+                startTime = time.perf_counter()
+                nbsrv.step(d)
+                stepTime[0] += time.perf_counter() - startTime
+
+            for i in range(n):
+                step()
+            log("    {:>20} {:10.1f} us".format(str(numBots) + " bots " + engine, stepTime[0] / n * 1000000))
+
+
+def main():
+    benchmarkIsValidMsg()
+    benchmarkLog()
+    benchmarkCodecs()
+    benchmarkMsgpack()
+    benchmarkSocket()
+    benchmarkSharedMemory()
+    benchmarkNetEm()
+    benchmarkRateLimit()
+    benchmarkEngines()
+
+
+if __name__ == "__main__":
+    main()
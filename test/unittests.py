@@ -1,6 +1,11 @@
 import os
 import sys
 import math
+import random
+import select
+import selectors
+import tempfile
+import time
 
 # include the netbot src directory in sys.path so we can import modules from it.
 robotpath = os.path.dirname(os.path.abspath(__file__))
@@ -10,13 +15,20 @@ sys.path.insert(0, srcpath)
 import netbots_server as nbsrv
 import netbots_ipc as nbipc
 import netbots_math as nbmath
+import netbots_entities as nbent
+import netbots_pack as nbpack
+import netbots_shm as nbshm
+import netbots_netem as nbnetem
 from netbots_log import setLogLevel
+from netbots_log import setLogFile
+from netbots_log import isEnabled
 from netbots_log import log
 
 def testHitSeverity():
     d = nbsrv.SrvData()
 
-    b1 = {'class': "default", 'currentSpeed': 100, 'currentDirection': 0}
+    b1 = nbent.Bot(currentSpeed=100, currentDirection=0)
+    b1.classValues = d.getClassValues(b1.botClass)
     if round(nbsrv.getHitSeverity(d,b1,0),8) != round(1,8):
         log("test 1 failed","ERROR")
 
@@ -44,7 +56,8 @@ def testHitSeverity():
     if round(nbsrv.getHitSeverity(d,b1,2*math.pi - math.pi/2-0.01),8) != round(0,8):
         log("test 8 failed","ERROR")
 
-    b1 = {'class': "default", 'currentSpeed': 50, 'currentDirection': math.pi + math.pi/2}
+    b1 = nbent.Bot(currentSpeed=50, currentDirection=math.pi + math.pi/2)
+    b1.classValues = d.getClassValues(b1.botClass)
     if round(nbsrv.getHitSeverity(d,b1, math.pi + math.pi/2),8) != round(0.5,8):
         log("test 9 failed","ERROR")
 
@@ -63,29 +76,1125 @@ def testHitSeverity():
     if round(nbsrv.getHitSeverity(d,b1, math.pi + math.pi/2 + math.pi/4),8) != round(0.7071067811865476*0.5,8):
         log("test 14 failed","ERROR")
 
-    b1 = {'class': "default", 'currentSpeed': 100, 'currentDirection': 0}
-    b2 = {'class': "default", 'currentSpeed': 100, 'currentDirection': math.pi}
+    b1 = nbent.Bot(currentSpeed=100, currentDirection=0)
+    b1.classValues = d.getClassValues(b1.botClass)
+    b2 = nbent.Bot(currentSpeed=100, currentDirection=math.pi)
+    b2.classValues = d.getClassValues(b2.botClass)
     if round(nbsrv.getHitSeverity(d,b1, 0, b2),8) != round(2,8):
         log("test 15 failed","ERROR")
 
-    b2 = {'class': "default", 'currentSpeed': 100, 'currentDirection': math.pi/2}
+    b2 = nbent.Bot(currentSpeed=100, currentDirection=math.pi/2)
+    b2.classValues = d.getClassValues(b2.botClass)
     if round(nbsrv.getHitSeverity(d,b1, 0, b2),8) != round(1,8):
         log("test 16 failed","ERROR")
 
-    b2 = {'class': "default", 'currentSpeed': 100, 'currentDirection': math.pi/4}
+    b2 = nbent.Bot(currentSpeed=100, currentDirection=math.pi/4)
+    b2.classValues = d.getClassValues(b2.botClass)
     if round(nbsrv.getHitSeverity(d,b1, 0, b2),8) != round(1-0.7071067811865476,8):
         log("test 17 failed","ERROR")
 
-    b2 = {'class': "default", 'currentSpeed': 100, 'currentDirection': math.pi-math.pi/4}
+    b2 = nbent.Bot(currentSpeed=100, currentDirection=math.pi-math.pi/4)
+    b2.classValues = d.getClassValues(b2.botClass)
     if round(nbsrv.getHitSeverity(d,b1, 0, b2),8) != round(1+0.7071067811865476,8):
         log("test 18 failed","ERROR")
 
-    b2 = {'class': "default", 'currentSpeed': 100, 'currentDirection': math.pi/4}
+    b2 = nbent.Bot(currentSpeed=100, currentDirection=math.pi/4)
+    b2.classValues = d.getClassValues(b2.botClass)
     if round(nbsrv.getHitSeverity(d,b1, math.pi, b2),8) != round(0,8):
         log("test 19 failed","ERROR")
 
+def mkTestGame(d, seed):
+    """ Put bots with random locations, speeds, directions and shells into d. """
+    rand = random.Random(seed)
+    d.bots = {}
+    d.shells = {}
+    d.explosions = {}
+    d.conf['obstacles'] = [{'x': 500, 'y': 500, 'radius': 50}]
+    classes = list(d.conf['classes'].keys())
+    for i in range(12):
+        src = "127.0.0.1:" + str(20100 + i)
+        bot = nbent.Bot("bot" + str(i), classes[i % len(classes)])
+        bot.health = 100
+        bot.x = rand.random() * 1000
+        bot.y = rand.random() * 1000
+        bot.currentSpeed = rand.choice([0, 50, 100])
+        bot.requestedSpeed = rand.random() * 100
+        bot.currentDirection = rand.random() * 2 * math.pi
+        bot.requestedDirection = rand.random() * 2 * math.pi
+        d.bots[src] = bot
+        d.shells[src] = nbent.Shell(bot.x, bot.y, rand.random() * 2 * math.pi, rand.random() * 300 + 10)
+    d.updateClassValues()
+
+
+def testNumpyEngine():
+    if nbsrv.nbnpengine is None:
+        log("numpy not installed, skipping numpy engine tests.", "WARNING")
+        return
+
+    d1 = nbsrv.SrvData()
+    d2 = nbsrv.SrvData()
+    mkTestGame(d1, 1)
+    mkTestGame(d2, 1)
+    d2.engine = nbsrv.nbnpengine.NumpyEngine()
+
+    # bots send requests between steps so the engine must pick up changes made outside of it.
+    rand = random.Random(1)
+    for i in range(200):
+        for src in d1.bots:
+            if rand.random() < 0.2:
+                msg = rand.choice([
+                    {'type': 'setSpeedRequest', 'requestedSpeed': rand.random() * 100},
+                    {'type': 'setDirectionRequest', 'requestedDirection': rand.random() * 2 * math.pi},
+                    {'type': 'fireCanonRequest', 'direction': rand.random() * 2 * math.pi,
+                     'distance': rand.random() * 300 + 10}])
+                nbsrv.processMsg(d1, msg, src)
+                nbsrv.processMsg(d2, msg, src)
+        nbsrv.step(d1)
+        nbsrv.step(d2)
+        for src in d1.bots:
+            for fld in ('x', 'y', 'health', 'currentSpeed', 'currentDirection', 'shellDamage', 'points'):
+                if getattr(d1.bots[src], fld) != getattr(d2.bots[src], fld):
+                    log("numpy engine test failed at step " + str(i) + ": " + src + " " + fld, "ERROR")
+                    return
+        if d1.shells != d2.shells or d1.explosions != d2.explosions:
+            log("numpy engine test failed at step " + str(i) + ": shells or explosions differ", "ERROR")
+            return
+
+
+def testBotGrid():
+    d = nbsrv.SrvData()
+    rand = random.Random(2)
+    bots = {}
+    for i in range(200):
+        bot = nbent.Bot()
+        bot.x = rand.random() * 1000
+        bot.y = rand.random() * 1000
+        bot.health = rand.choice([0, 100])
+        bots['bot' + str(i)] = bot
+
+    # compare with testing every pair of bots.
+    expected = []
+    keys = list(bots.keys())
+    for i in range(len(keys)):
+        for j in range(i + 1, len(keys)):
+            b1 = bots[keys[i]]
+            b2 = bots[keys[j]]
+            if b1.health != 0 and b2.health != 0 and \
+                    nbmath.distance(b1.x, b1.y, b2.x, b2.y) <= d.conf['botRadius'] * 2:
+                expected.append([keys[i], keys[j]])
+
+    if nbsrv.findAllOverlapingBots(d, bots) != expected:
+        log("bot grid test 1 failed", "ERROR")
+
+    if nbsrv.findOverlapingBots(d, bots) != expected[0]:
+        log("bot grid test 2 failed", "ERROR")
+
+    # move one bot onto another and check only pairs with that bot are found.
+    grid = nbsrv.mkBotGrid(d, bots)
+    k1, k2 = expected[0]
+    bots['bot199'].health = 100
+    bots['bot199'].x = bots[k1].x
+    bots['bot199'].y = bots[k1].y
+    nbsrv.updateBotGrid(grid, bots)
+    overlaps = nbsrv.findAllOverlapingBots(d, bots, grid, {'bot199'})
+    if [k1, 'bot199'] not in overlaps or [k2, 'bot199'] not in overlaps or \
+            any('bot199' not in pair for pair in overlaps):
+        log("bot grid test 3 failed", "ERROR")
+
+
+def testCollisionSolver():
+    d = nbsrv.SrvData()
+    mkTestGame(d, 3)
+    d.shells = {}
+
+    # pile all bots up in a corner.
+    rand = random.Random(3)
+    for bot in d.bots.values():
+        bot.x = 30 + rand.random() * 20
+        bot.y = 30 + rand.random() * 20
+        bot.requestedSpeed = 0
+        bot.hitSeverity = 0.0
+
+    iterations = nbsrv.resolveCollisions(d)
+    if iterations < 1 or iterations > d.conf['collisionIterations']:
+        log("collision solver test 1 failed", "ERROR")
+
+    d.conf['collisionIterations'] = 1000
+    nbsrv.resolveCollisions(d)
+    if nbsrv.findOverlapingBots(d, d.bots) or nbsrv.findOverlapingBotsAndObstacles(d, d.bots):
+        log("collision solver test 2 failed", "ERROR")
+
+    for bot in d.bots.values():
+        if bot.x < d.conf['botRadius'] or bot.y < d.conf['botRadius']:
+            log("collision solver test 3 failed", "ERROR")
+            break
+
+    if d.state['maxCollisionIterations'] < iterations:
+        log("collision solver test 4 failed", "ERROR")
+
+
+def testClassValues():
+    d = nbsrv.SrvData()
+    d.bots = {'127.0.0.1:20100': nbent.Bot(botClass='heavy'), '127.0.0.1:20101': nbent.Bot(botClass='sniper')}
+    d.updateClassValues()
+
+    for c in d.conf['classes']:
+        cv = d.getClassValues(c)
+        for fld in d.conf['classFields']:
+            if getattr(cv, fld) != d.getClassValue(fld, c):
+                log("class values test 1 failed for " + c + " " + fld, "ERROR")
+
+    if d.bots['127.0.0.1:20101'].classValues is not d.getClassValues('sniper'):
+        log("class values test 2 failed", "ERROR")
+
+    # changing conf must rebuild the table.
+    d.conf['botMaxSpeed'] = 10
+    d.updateClassValues()
+    if d.bots['127.0.0.1:20100'].classValues.botMaxSpeed != d.getClassValue('botMaxSpeed', 'heavy'):
+        log("class values test 3 failed", "ERROR")
+
+
+def testEntities():
+    bot = nbent.Bot("test", "sniper")
+    bot.lastFireDirection = 1.5
+    bot.lastScanEnd = 2.5
+    b = bot.toDict()
+    if b['class'] != "sniper" or b['name'] != "test" or b['health'] != 0:
+        log("entities test 1 failed", "ERROR")
+
+    if b['last'] != {'fireCanonRequest': {'direction': 1.5, 'distance': 10},
+                     'scanRequest': {'startRadians': 0, 'endRadians': 2.5}}:
+        log("entities test 2 failed", "ERROR")
+
+    if 'hitSeverity' in b or 'classValues' in b:
+        log("entities test 3 failed", "ERROR")
+
+    shells = nbent.shellsToDicts({'a': nbent.Shell(1, 2, 3, 4)})
+    if shells != {'a': {'x': 1, 'y': 2, 'direction': 3, 'distanceRemaining': 4}}:
+        log("entities test 4 failed", "ERROR")
+
+    explosions = nbent.explosionsToDicts({0: nbent.Explosion(1, 2, 'a')})
+    if explosions != {0: {'x': 1, 'y': 2, 'stepsAgo': 0, 'src': 'a'}}:
+        log("entities test 5 failed", "ERROR")
+
+
+def testSrvDataInstances():
+    # two arenas in one process must not share any state.
+    d1 = nbsrv.SrvData()
+    d2 = nbsrv.SrvData()
+    mkTestGame(d1, 1)
+    d1.conf['botMaxSpeed'] = 10
+    d1.conf['classes']['heavy']['botArmor'] = 2
+    d1.state['gameStep'] = 5
+    d1.startBots.append('127.0.0.1:20100')
+    for i in range(10):
+        nbsrv.step(d1)
+
+    d = nbsrv.SrvData()
+    if d2.conf != d.conf or d2.conf['classes']['heavy']['botArmor'] != 0.862:
+        log("SrvData instances test 1 failed", "ERROR")
+
+    if d2.state['gameStep'] != 0 or d2.state['serverSteps'] != 0 or d2.state['explIndex'] != 0:
+        log("SrvData instances test 2 failed", "ERROR")
+
+    if d2.bots or d2.shells or d2.explosions or d2.startBots or d2.botGrid is not None:
+        log("SrvData instances test 3 failed", "ERROR")
+
+
+def testArenas():
+    arenas = []
+    for i in range(3):
+        d = nbsrv.SrvData()
+        d.conf['arenas'] = 3
+        d.conf['arenaNumber'] = i + 1
+        d.conf['botsInGame'] = 2
+        arenas.append(d)
+    routes = {}
+
+    def join(src, arena=None):
+        msg = {'type': 'joinRequest', 'name': src}
+        if arena:
+            msg['arena'] = arena
+        d = nbsrv.findArena(arenas, routes, msg, src)
+        if d is None:
+            return None
+        reply = nbsrv.processMsg(d, msg, src)
+        if reply['type'] == 'joinReply':
+            routes[src] = d
+        return d.conf['arenaNumber']
+
+    # bots go to the first arena waiting for bots unless they ask for an arena.
+    if join('bot1') != 1 or join('bot2', 3) != 3 or join('bot3') != 1 or join('bot4') != 2:
+        log("arenas test 1 failed", "ERROR")
+
+    if join('bot5', 4) is not None:
+        log("arenas test 2 failed", "ERROR")
+
+    # messages from bots that joined go to their arena.
+    if nbsrv.findArena(arenas, routes, {'type': 'getInfoRequest'}, 'bot2') is not arenas[2]:
+        log("arenas test 3 failed", "ERROR")
+
+    # arenas that have started can't take more bots from the lobby.
+    arenas[1].state['gameNumber'] = 1
+    if join('bot6') != 3 or join('bot7') is not None:
+        log("arenas test 4 failed", "ERROR")
+
+
+def testMissedSteps():
+    d = nbsrv.SrvData()
+    mkTestGame(d, 1)
+    srcs = list(d.bots.keys())
+    d.botMsgCount = {srcs[0]: 3}
+
+    # no missed steps are counted before the first game.
+    nbsrv.countMissedSteps([d])
+    if any(bot.missedSteps for bot in d.bots.values()) or d.botMsgCount:
+        log("missed steps test 1 failed", "ERROR")
+
+    d.state['gameNumber'] = 1
+    d.botMsgCount = {srcs[0]: 3}
+    nbsrv.countMissedSteps([d])
+    if d.bots[srcs[0]].missedSteps != 0 or d.bots[srcs[1]].missedSteps != 1 or d.botMsgCount:
+        log("missed steps test 2 failed", "ERROR")
+
+
+def testHeldMsgs():
+    d = nbsrv.SrvData()
+    mkTestGame(d, 1)
+    d.state['gameNumber'] = 1
+    d.conf['dropRate'] = 0
+    d.srvSocket = nbipc.NetBotSocket("127.0.0.1", 0)
+    botSocket = nbipc.NetBotSocket("127.0.0.1", 0)
+    port = botSocket.sourcePort
+    perStep = d.conf['botMsgsPerStep']
+
+    # replace the first bot with one at botSocket's address.
+    src = "127.0.0.1:" + str(port)
+    d.bots[src] = d.bots.pop(list(d.bots.keys())[0])
+
+    # botMsgsPerStep msgs are answered, the next botMsgsPerStep are held and any more are dropped.
+    for msgID in range(perStep * 2 + 2):
+        nbsrv.replyMsg(d, {'type': 'getInfoRequest', 'msgID': msgID}, "127.0.0.1", port, src)
+    if d.state['msgsOut'] != perStep or len(d.heldMsgs) != perStep or d.botMsgCount[src] != perStep * 2 + 2:
+        log("held msgs test 1 failed", "ERROR")
+
+    # held msgs are answered in the next step and count towards it.
+    nbsrv.countMissedSteps([d])
+    nbsrv.replyHeldMsgs([d])
+    if d.state['msgsOut'] != perStep * 2 or d.heldMsgs or d.botMsgCount[src] != perStep or \
+            d.bots[src].missedSteps != 0:
+        log("held msgs test 2 failed", "ERROR")
+    nbsrv.replyMsg(d, {'type': 'getInfoRequest', 'msgID': 100}, "127.0.0.1", port, src)
+    if d.state['msgsOut'] != perStep * 2 or [m['msgID'] for m, ip, p, s in d.heldMsgs] != [100]:
+        log("held msgs test 3 failed", "ERROR")
+
+    # the held replies are to the msgs after the first botMsgsPerStep, in order.
+    msgIDs = []
+    for i in range(100):
+        try:
+            msgIDs.append(botSocket.recvMessage()[0]['msgID'])
+        except nbipc.NetBotSocketException:
+            if len(msgIDs) == perStep * 2:
+                break
+            time.sleep(0.01)
+    if msgIDs != list(range(perStep * 2)):
+        log("held msgs test 4 failed: " + str(msgIDs), "ERROR")
+
+    botSocket.s.close()
+    d.srvSocket.s.close()
+
+
+def testLockStep():
+    d = nbsrv.SrvData()
+    mkTestGame(d, 1)
+    d.state['gameNumber'] = 1
+    srcs = list(d.bots.keys())
+    for src in srcs[1:]:
+        nbsrv.processMsg(d, {'type': 'getInfoRequest', 'endTurn': True}, src)
+
+    if nbsrv.turnsEnded([d]):
+        log("lockstep test 1 failed", "ERROR")
+
+    d.conf['lockStep'] = True
+    if nbsrv.turnsEnded([d]):
+        log("lockstep test 2 failed", "ERROR")
+
+    # bots that are dead or have sent botMsgsPerStep msgs don't need to end their turn.
+    d.bots[srcs[0]].health = 0
+    if not nbsrv.turnsEnded([d]):
+        log("lockstep test 3 failed", "ERROR")
+    d.bots[srcs[0]].health = 100
+    d.botMsgCount[srcs[0]] = d.conf['botMsgsPerStep']
+    if not nbsrv.turnsEnded([d]):
+        log("lockstep test 4 failed", "ERROR")
+
+    nbsrv.countMissedSteps([d])
+    if nbsrv.turnsEnded([d]) or d.endTurnBots:
+        log("lockstep test 5 failed", "ERROR")
+
+
+def testScanCache():
+    d = nbsrv.SrvData()
+    mkTestGame(d, 1)
+    d.conf['jamZones'] = [{'x': 500, 'y': 500, 'radius': 300}]
+    d.conf['scanMaxDistance'] = 600
+    srcs = list(d.bots.keys())
+    d.bots[srcs[1]].health = 0
+    rand = random.Random(1)
+
+    for i in range(500):
+        src = rand.choice(srcs[2:])
+        startRad = rand.choice([0, math.pi, rand.random() * 2 * math.pi])
+        endRad = rand.choice([0, startRad, rand.random() * 2 * math.pi])
+
+        # find distance the same way scanRequest did before ScanCache.
+        bot = d.bots[src]
+        expected = 0
+        for src2, bot2 in d.bots.items():
+            if src != src2 and bot2.health != 0:
+                jz = d.conf['jamZones'][0]
+                if nbmath.distance(bot2.x, bot2.y, jz['x'], jz['y']) + d.conf['botRadius'] < jz['radius']:
+                    continue
+                dis = nbmath.contains(bot.x, bot.y, startRad, endRad, bot2.x, bot2.y)
+                if dis <= d.conf['scanMaxDistance'] and dis != 0 and (expected == 0 or dis < expected):
+                    expected = dis
+
+        reply = nbsrv.processMsg(d, {'type': 'scanRequest', 'startRadians': startRad, 'endRadians': endRad}, src)
+        if reply['distance'] != expected:
+            log("scan cache test 1 failed: " + str(reply) + " != " + str(expected), "ERROR")
+            break
+
+    # moving bots invalidates the cache.
+    nbsrv.step(d)
+    if d.scanCache is not None:
+        log("scan cache test 2 failed", "ERROR")
+
+
+def testMsgValidation():
+    valid = [
+        {'type': 'joinRequest', 'name': "Robot"},
+        {'type': 'joinRequest', 'name': "Robot", 'class': "heavy", 'arena': 2},
+        {'type': 'getInfoRequest', 'msgID': 1, 'replyData': [1, 2], 'endTurn': True},
+        {'type': 'scanRequest', 'startRadians': 0, 'endRadians': math.pi * 2},
+        {'type': 'getInfoReply', 'gameNumber': 1, 'gameStep': 2, 'health': 55.5, 'points': 0},
+        ]
+    invalid = [
+        "getInfoRequest",
+        {'msgID': 1},
+        {'type': 'noSuchRequest'},
+        {'type': ['getInfoRequest']},
+        {'type': 'joinRequest'},
+        {'type': 'joinRequest', 'name': ""},
+        {'type': 'joinRequest', 'name': 5},
+        {'type': 'joinRequest', 'name': "Robot", 'class_o': "heavy"},
+        {'type': 'joinRequest', 'name': "Robot", 'arena': 1001},
+        {'type': 'getInfoRequest', 'endTurn': 1},
+        {'type': 'scanRequest', 'startRadians': -1, 'endRadians': 0},
+        {'type': 'scanRequest', 'startRadians': "0", 'endRadians': 0},
+        ]
+
+    # collect the errors isValidMsg logs for invalid msgs instead of printing them.
+    logged = []
+    nbipc.log = lambda msg, level="INFO": logged.append(level)
+    failed = [msg for msg in valid if not nbipc.isValidMsg(msg)]
+    failed += [msg for msg in invalid if nbipc.isValidMsg(msg)]
+    nbipc.log = log
+
+    for msg in failed:
+        log("msg validation test failed: " + str(msg), "ERROR")
+    if logged.count("ERROR") != len(invalid):
+        log("msg validation test failed, errors logged: " + str(logged), "ERROR")
+
+
+def testLog():
+    def fail():
+        raise Exception("msg should not be built when DEBUG is off.")
+
+    setLogLevel(False, False)
+    if isEnabled("DEBUG") or isEnabled("VERBOSE") or not isEnabled("INFO"):
+        log("log test 1 failed", "ERROR")
+    log(fail, "DEBUG")
+    log("%s", "VERBOSE", fail)
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        filename = os.path.join(tmpDir, "log.txt")
+        setLogFile(filename)
+        log("log test %s %d", "INFO", "line", 2)
+        log(lambda: "log test line 3")
+        setLogFile(False)
+        with open(filename) as f:
+            lines = f.read().splitlines()
+        if len(lines) != 3 or not lines[1].endswith("__main__.testLog(): log test line 2") or \
+                not lines[2].endswith("log test line 3"):
+            log("log test 2 failed: " + str(lines), "ERROR")
+
+
+def testCompactCodec():
+    d = nbsrv.SrvData()
+    d.srvSocket = nbipc.NetBotSocket("127.0.0.1", 0)
+    src = "127.0.0.1:20100"
+
+    reply = nbsrv.processMsg(d, {'type': 'joinRequest', 'name': "bot", 'codec': 'compact'}, src)
+    if reply.get('codec') != 'compact' or d.srvSocket.getCodec(src) != 'compact':
+        log("compact codec test 1 failed: " + str(reply.get('codec')), "ERROR")
+
+    msgs = [
+        {'type': 'getInfoRequest', 'msgID': 1, 'endTurn': False},
+        {'type': 'joinRequest', 'name': "Robot", 'class': "heavy", 'codec': 'compact'},
+        {'type': 'scanRequest', 'startRadians': 0.25, 'endRadians': math.pi * 2, 'msgID': 65000},
+        {'type': 'getCanonReply', 'shellInProgress': True},
+        {'type': 'Error', 'result': "Error message"},
+        ]
+    for msg in msgs:
+        b = d.srvSocket.serialize(msg, 'compact')
+        if b[0] != nbipc.CompactCodec.CompactMarker or d.srvSocket.deserialize(b) != msg:
+            log("compact codec test 2 failed: " + str(msg), "ERROR")
+
+    # msgs that can't be packed compactly are sent as msgpack.
+    msgs = [
+        {'type': 'getInfoRequest', 'msgID': 65536},
+        {'type': 'getInfoRequest', 'replyData': [1, 2]},
+        {'type': 'joinReply', 'conf': {'stepSec': 0.05}},
+        ]
+    for msg in msgs:
+        b = d.srvSocket.serialize(msg, 'compact')
+        if b[0] == nbipc.CompactCodec.CompactMarker or d.srvSocket.deserialize(b) != msg:
+            log("compact codec test 3 failed: " + str(msg), "ERROR")
+
+    # bots that rejoin without asking for a codec go back to msgpack.
+    nbsrv.processMsg(d, {'type': 'joinRequest', 'name': "bot"}, src)
+    if d.srvSocket.getCodec(src) is not None:
+        log("compact codec test 4 failed", "ERROR")
+
+    d.srvSocket.s.close()
+
+
+def testPack():
+    # bytes from binary msgpack.packb(obj, use_bin_type=True)
+    known = [
+        ({'type': 'getInfoRequest', 'msgID': 300},
+         b'\x82\xa4type\xaegetInfoRequest\xa5msgID\xcd\x01\x2c'),
+        ([-1, -33, 1.5, None, True, b'\x01'],
+         b'\x96\xff\xd0\xdf\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00\xc0\xc3\xc4\x01\x01'),
+        ]
+    for obj, b in known:
+        if nbpack.packb(obj) != b or nbpack.unpackb(b) != obj or nbpack.unpackb(memoryview(b)) != obj:
+            log("pack test 1 failed: " + str(obj), "ERROR")
+
+    d = nbsrv.SrvData()
+    mkTestGame(d, 1)
+    d.addExplosion(list(d.bots.keys())[0], 100, 100)
+    viewData = {
+        'type': 'viewData',
+        'state': d.state,
+        'bots': nbent.botsToDicts(d.bots),
+        'shells': nbent.shellsToDicts(d.shells),
+        'explosions': nbent.explosionsToDicts(d.explosions)
+        }
+    if nbpack.unpackb(nbpack.packb(viewData)) != viewData:
+        log("pack test 2 failed", "ERROR")
+
+    for b in [b'', b'\x92\x01', b'\xc1', b'\x01\x02']:
+        try:
+            nbpack.unpackb(b)
+            log("pack test 3 failed: " + str(b), "ERROR")
+        except nbpack.PackException:
+            pass
+
+
+def testBatch():
+    d = nbsrv.SrvData()
+    mkTestGame(d, 1)
+    src = list(d.bots.keys())[0]
+
+    # requests in a batch are processed in order.
+    reply = nbsrv.processMsg(d, {'type': 'batchRequest', 'msgID': 7, 'requests': [
+        {'type': 'setSpeedRequest', 'requestedSpeed': 42},
+        {'type': 'getSpeedRequest'},
+        {'type': 'batchRequest', 'requests': []},
+        {'type': 'getLocationReply', 'x': 1, 'y': 1},
+        ]}, src)
+    replies = reply.get('replies', [])
+    if reply['type'] != 'batchReply' or reply['msgID'] != 7 or len(replies) != 4 or \
+            replies[0]['type'] != 'setSpeedReply' or replies[1].get('requestedSpeed') != 42 or \
+            replies[2]['type'] != 'Error' or replies[3]['type'] != 'Error':
+        log("batch test 1 failed: " + str(reply), "ERROR")
+
+    # a batch may not have more requests than a bot can send in a step.
+    reply = nbsrv.processMsg(d, {'type': 'batchRequest', 'requests':
+                                 [{'type': 'getInfoRequest'}] * (d.conf['botMsgsPerStep'] + 1)}, src)
+    if reply['type'] != 'Error':
+        log("batch test 2 failed: " + str(reply), "ERROR")
+
+    nbsrv.processMsg(d, {'type': 'batchRequest', 'requests': [{'type': 'getInfoRequest', 'endTurn': True}]}, src)
+    if src not in d.endTurnBots:
+        log("batch test 3 failed", "ERROR")
+
+    # each request in a batch counts towards botMsgsPerStep, so several batches in one step are held and
+    # answered in later steps once they fit.
+    d.conf['dropRate'] = 0
+    d.srvSocket = nbipc.NetBotSocket("127.0.0.1", 0)
+    botSocket = nbipc.NetBotSocket("127.0.0.1", 0)
+    port = botSocket.sourcePort
+    src = "127.0.0.1:" + str(port)
+    d.bots[src] = d.bots.pop(list(d.bots.keys())[1])
+    d.botMsgCount = {}
+    for msgID, n in enumerate([3, 3, 2, 1]):
+        nbsrv.replyMsg(d, {'type': 'batchRequest', 'msgID': msgID, 'requests': [{'type': 'getInfoRequest'}] * n},
+                       "127.0.0.1", port, src)
+    if d.state['msgsOut'] != 1 or [m['msgID'] for m, ip, p, s in d.heldMsgs] != [1, 2] or d.botMsgCount[src] != 9:
+        log("batch test 4 failed", "ERROR")
+    # a held batch that is held again does not count towards the new step.
+    nbsrv.countMissedSteps([d])
+    nbsrv.replyHeldMsgs([d])
+    if d.state['msgsOut'] != 2 or [m['msgID'] for m, ip, p, s in d.heldMsgs] != [2] or d.botMsgCount[src] != 3:
+        log("batch test 5 failed", "ERROR")
+    nbsrv.countMissedSteps([d])
+    nbsrv.replyHeldMsgs([d])
+    if d.state['msgsOut'] != 3 or d.heldMsgs or d.botMsgCount[src] != 2:
+        log("batch test 6 failed", "ERROR")
+
+    botSocket.s.close()
+    d.srvSocket.s.close()
+
+
+def testSubscribe():
+    d = nbsrv.SrvData()
+    mkTestGame(d, 1)
+    d.conf['dropRate'] = 0
+    d.srvSocket = nbipc.NetBotSocket("127.0.0.1", 0)
+    botSocket = nbipc.NetBotSocket("127.0.0.1", 0)
+
+    # replace the first bot with one at botSocket's address.
+    src = "127.0.0.1:" + str(botSocket.s.getsockname()[1])
+    oldSrc = list(d.bots.keys())[0]
+    d.bots[src] = d.bots.pop(oldSrc)
+    d.shells[src] = d.shells.pop(oldSrc)
+
+    reply = nbsrv.processMsg(d, {'type': 'subscribeRequest', 'everySteps': 2}, src)
+    if reply['type'] != 'subscribeReply':
+        log("subscribe test 1 failed: " + str(reply), "ERROR")
+
+    for gameStep in (1, 2, 3):
+        d.state['gameStep'] = gameStep
+        nbsrv.sendBotStates(d)
+
+    # wait for the botState sent on step 2 to arrive.
+    botState = None
+    for i in range(100):
+        botState = botSocket.getBotState()
+        if botState:
+            break
+        time.sleep(0.01)
+    if not botState or botState['gameStep'] != 2 or botState['x'] != d.bots[src].x or \
+            botState['shellInProgress'] != True:
+        log("subscribe test 2 failed: " + str(botState), "ERROR")
+
+    nbsrv.processMsg(d, {'type': 'subscribeRequest', 'everySteps': 0}, src)
+    if d.subscribers:
+        log("subscribe test 3 failed", "ERROR")
+
+    botSocket.s.close()
+    d.srvSocket.s.close()
+
+
+def testReplyCache():
+    d = nbsrv.SrvData()
+    mkTestGame(d, 1)
+    d.conf['dropRate'] = 0
+    d.srvSocket = nbipc.NetBotSocket("127.0.0.1", 0)
+    botSocket = nbipc.NetBotSocket("127.0.0.1", 0)
+    port = botSocket.s.getsockname()[1]
+
+    # replace the first bot with one at botSocket's address.
+    src = "127.0.0.1:" + str(port)
+    oldSrc = list(d.bots.keys())[0]
+    d.bots[src] = d.bots.pop(oldSrc)
+    d.shells.pop(oldSrc, None)
+    d.bots[src].health = 100
+    firedCount = d.bots[src].firedCount
+
+    # the resent request gets the same reply without firing again.
+    msg = {'type': 'fireCanonRequest', 'direction': 1, 'distance': 100, 'msgID': 5}
+    nbsrv.sendReply(d, msg, "127.0.0.1", port, src)
+    nbsrv.sendReply(d, dict(msg), "127.0.0.1", port, src)
+    replies = []
+    for i in range(100):
+        try:
+            replies.append(botSocket.recvMessage()[0])
+        except nbipc.NetBotSocketException:
+            if len(replies) == 2:
+                break
+            time.sleep(0.01)
+    if len(replies) != 2 or replies[0] != replies[1] or replies[0]['type'] != 'fireCanonReply' or \
+            d.bots[src].firedCount != firedCount + 1 or d.state['dupCount'] != 1:
+        log("reply cache test 1 failed: " + str(replies), "ERROR")
+
+    # a different msg with the same msgID is processed.
+    nbsrv.sendReply(d, {'type': 'getInfoRequest', 'msgID': 5}, "127.0.0.1", port, src)
+    if d.state['dupCount'] != 1 or len(d.replyCache[src]) != 1:
+        log("reply cache test 2 failed", "ERROR")
+
+    # only replyCacheSize replies are kept and rejoining clears them.
+    for msgID in range(6, 6 + d.conf['replyCacheSize']):
+        nbsrv.sendReply(d, {'type': 'getInfoRequest', 'msgID': msgID}, "127.0.0.1", port, src)
+    if len(d.replyCache[src]) != d.conf['replyCacheSize'] or 5 in d.replyCache[src]:
+        log("reply cache test 3 failed", "ERROR")
+    nbsrv.processMsg(d, {'type': 'joinRequest', 'name': "again"}, src)
+    if src in d.replyCache:
+        log("reply cache test 4 failed", "ERROR")
+
+    botSocket.s.close()
+    d.srvSocket.s.close()
+
+
+def testPeers():
+    s1 = nbipc.NetBotSocket("127.0.0.1", 0)
+    s2 = nbipc.NetBotSocket("127.0.0.1", 0)
+    port1 = s1.s.getsockname()[1]
+    port2 = s2.s.getsockname()[1]
+
+    for i in range(3):
+        s1.sendMessage({'type': 'getInfoRequest'}, "127.0.0.1", port2)
+    s1.sendMessage(s1.serialize({'type': 'getInfoRequest'}), "127.0.0.1", port2, packedAndChecked=True)
+    recvd = 0
+    for i in range(100):
+        try:
+            msg, ip, port = s2.recvMessage()
+            recvd += 1
+        except nbipc.NetBotSocketException:
+            if recvd == 4:
+                break
+            time.sleep(0.01)
+
+    # counts are kept per (ip, port) and only rendered as 'ip:port' by getStats().
+    sent = s1.peers.get(("127.0.0.1", port2))
+    recv = s2.peers.get(("127.0.0.1", port1))
+    if not sent or sent.sent != 4 or sent.sendTypes != {'getInfoRequest': 3, 'Serialized': 1} or \
+            not recv or recv.recv != 4 or recv.recvTypes != {'getInfoRequest': 4}:
+        log("peers test 1 failed", "ERROR")
+    if "To/From: 127.0.0.1:" + str(port1) not in s2.getStats() or \
+            s2.peerName("127.0.0.1", port1) != "127.0.0.1:" + str(port1):
+        log("peers test 2 failed", "ERROR")
+
+    s1.setCodec("127.0.0.1:" + str(port2), 'compact')
+    if s1.getCodec(("127.0.0.1", port2)) != 'compact' or \
+            s1.packMessage({'type': 'getInfoRequest'}, "127.0.0.1", port2)[0] != nbipc.CompactCodec.CompactMarker:
+        log("peers test 3 failed", "ERROR")
+
+    s1.s.close()
+    s2.s.close()
+
+
+def testRecvMessages():
+    s1 = nbipc.NetBotSocket("127.0.0.1", 0)
+    s2 = nbipc.NetBotSocket("127.0.0.1", 0)
+    port2 = s2.s.getsockname()[1]
+
+    msgs = [
+        {'type': 'getInfoRequest', 'msgID': 1},
+        {'type': 'scanRequest', 'startRadians': 0.5, 'endRadians': 1.5, 'msgID': 2},
+        {'type': 'joinRequest', 'name': "Robot"},
+        {'type': 'getLocationReply', 'x': 1.5, 'y': 2.5},
+        ]
+    for msg in msgs[:2]:
+        s1.sendMessage(msg, "127.0.0.1", port2)
+    # datagrams that are not msgs are skipped.
+    s1.sendMessage(b'\x01\x02', "127.0.0.1", port2, packedAndChecked=True)
+    s1.setCodec(("127.0.0.1", port2), 'compact')
+    for msg in msgs[2:]:
+        s1.sendMessage(msg, "127.0.0.1", port2)
+
+    recvd = []
+    for i in range(100):
+        recvd.extend(m for m, ip, port in s2.recvMessages(2))
+        if len(recvd) >= len(msgs):
+            break
+        time.sleep(0.01)
+    if recvd != msgs:
+        log("recvMessages test 1 failed: " + str(recvd), "ERROR")
+
+    # the list given is reused and the buffer being empty is not an error.
+    q = [None]
+    if s2.recvMessages(msgs=q) is not q or q:
+        log("recvMessages test 2 failed", "ERROR")
+
+    s1.s.close()
+    s2.s.close()
+
+
+def testRecvThread():
+    s1 = nbipc.NetBotSocket("127.0.0.1", 0)
+    s2 = nbipc.NetBotSocket("127.0.0.1", 0)
+    port2 = s2.s.getsockname()[1]
+    if s2.setRecvBufferSize(65536) < 65536 or s2.getKernelDrops() not in (0, None):
+        log("recv thread test 1 failed", "ERROR")
+
+    s2.startRecvThread(maxQueued=3)
+    sel = selectors.SelectSelector()
+    sel.register(s2, selectors.EVENT_READ)
+    if sel.select(0):
+        log("recv thread test 2 failed", "ERROR")
+
+    for i in range(5):
+        s1.sendMessage({'type': 'getInfoRequest', 'msgID': i}, "127.0.0.1", port2)
+    for i in range(100):
+        if s2.recvQueueDrops == 2:
+            break
+        time.sleep(0.01)
+
+    # fileno() is readable while msgs are queued.
+    if not sel.select(1) or [m['msgID'] for m, ip, port in s2.recvMessages(2)] != [0, 1] or not sel.select(0):
+        log("recv thread test 3 failed", "ERROR")
+    if s2.recvMessage()[0]['msgID'] != 2 or sel.select(0) or s2.recvQueueDrops != 2:
+        log("recv thread test 4 failed", "ERROR")
+
+    # a msg queued (and the doorbell rung) by the thread while recvMessages() answers the doorbell
+    # is received, and a msg queued after that still makes fileno() readable.
+    port1 = s1.s.getsockname()[1]
+
+    class RacingDoorbell:
+        def __init__(self, s):
+            self.s = s
+            self.raced = False
+
+        def fileno(self):
+            return self.s.fileno()
+
+        def recv(self, n):
+            if not self.raced:
+                self.raced = True
+                s2.recvQueue.put((s1.serialize({'type': 'getInfoRequest', 'msgID': 6}), ("127.0.0.1", port1)))
+                s2.ringDoorbell()
+            return self.s.recv(n)
+
+    s2.doorbell = (RacingDoorbell(s2.doorbell[0]), s2.doorbell[1])
+    s2.ringDoorbell()
+    if [m['msgID'] for m, ip, port in s2.recvMessages()] != [6] or sel.select(0):
+        log("recv thread test 5 failed", "ERROR")
+    s2.recvQueue.put((s1.serialize({'type': 'getInfoRequest', 'msgID': 7}), ("127.0.0.1", port1)))
+    s2.ringDoorbell()
+    if not sel.select(0) or [m['msgID'] for m, ip, port in s2.recvMessages()] != [7]:
+        log("recv thread test 6 failed", "ERROR")
+    s2.doorbell = (s2.doorbell[0].s, s2.doorbell[1])
+
+    s2.stopRecvThread()
+    s1.sendMessage({'type': 'getInfoRequest', 'msgID': 5}, "127.0.0.1", port2)
+    time.sleep(0.05)
+    if s2.recvMessage()[0]['msgID'] != 5:
+        log("recv thread test 7 failed", "ERROR")
+
+    sel.close()
+    s1.s.close()
+    s2.s.close()
+
+
+def testFragments():
+    s1 = nbipc.NetBotSocket("127.0.0.1", 0)
+    s2 = nbipc.NetBotSocket("127.0.0.1", 0)
+    port1 = s1.s.getsockname()[1]
+    port2 = s2.s.getsockname()[1]
+    s1.setMtu(600)
+
+    # a joinReply with many obstacles is longer than mtu so it is sent as fragments.
+    d = nbsrv.SrvData()
+    d.conf['obstacleRadius'] = 1
+    d.conf['obstacles'] = nbsrv.mkObstacles(d, 30)
+    reply = {'type': 'joinReply', 'conf': d.conf}
+    short = {'type': 'getInfoRequest', 'msgID': 1}
+    if len(s1.fragment(s1.serialize(reply))) < 2:
+        log("fragments test 1 failed", "ERROR")
+    s1.sendMessage(reply, "127.0.0.1", port2)
+    s1.sendMessage(short, "127.0.0.1", port2)
+
+    recvd = []
+    for i in range(100):
+        recvd.extend(m for m, ip, port in s2.recvMessages())
+        if len(recvd) >= 2:
+            break
+        time.sleep(0.01)
+    if recvd != [nbipc.umsgpack.unpackb(s1.serialize(reply), raw=False), short] or s2.fragments:
+        log("fragments test 2 failed", "ERROR")
+
+    # fragments arriving out of order are put back in order and duplicates are ignored.
+    frags = s1.fragment(s1.serialize(short) * 100)
+    frags = [frags[-1], frags[0]] + frags[:-1]
+    result = None
+    for f in frags:
+        if result is not None:
+            log("fragments test 3 failed", "ERROR")
+        result = s2.reassemble(memoryview(f), ("127.0.0.1", port1))
+    if result != s1.serialize(short) * 100:
+        log("fragments test 4 failed", "ERROR")
+
+    # msgs that never get all their fragments are discarded after FragmentTimeout.
+    s2.reassemble(frags[0], ("127.0.0.1", port1))
+    for key in s2.fragments:
+        s2.fragments[key][3] -= s2.FragmentTimeout + 1
+    s2.reassemble(s1.fragment(s1.serialize(short) * 100)[0], ("127.0.0.1", port1))
+    if s2.fragmentsEvicted != 1 or len(s2.fragments) != 1:
+        log("fragments test 5 failed", "ERROR")
+
+    # fragments claiming to be part of a huge msg, or too short to be anything but the last fragment,
+    # are rejected without making room for them.
+    header = nbipc.NetBotSocket.FragmentHeader
+    minSize = s2.FragmentMinSize
+    for count, size in ((0xFFFF, minSize), (s2.FragmentMaxBytes // minSize + 2, minSize), (2, minSize - 1)):
+        try:
+            s2.reassemble(header.pack(nbipc.CompactCodec.CompactMarker, s2.FragmentCode, 9, 0, count) + b'x' * size,
+                          ("127.0.0.1", 30000))
+            log("fragments test 6 failed", "ERROR")
+        except nbipc.NetBotSocketException:
+            pass
+    # a last fragment arriving first only uses memory for itself.
+    s2.reassemble(header.pack(nbipc.CompactCodec.CompactMarker, s2.FragmentCode, 9, 0xFFFE, 0xFFFF) + b'x',
+                  ("127.0.0.1", 30000))
+    if len(s2.fragments[(("127.0.0.1", 30000), 9)][2]) != 1:
+        log("fragments test 7 failed", "ERROR")
+
+    # one address can only have FragmentMaxPendingPerPeer msgs waiting for fragments.
+    s2.fragments = {}
+    s2.fragmentsBytes = 0
+    for fragmentID in range(s2.FragmentMaxPendingPerPeer + 5):
+        s2.reassemble(header.pack(nbipc.CompactCodec.CompactMarker, s2.FragmentCode, fragmentID, 0, 2) + b'x' * minSize,
+                      ("127.0.0.1", 30000))
+    s2.reassemble(header.pack(nbipc.CompactCodec.CompactMarker, s2.FragmentCode, 0, 0, 2) + b'x' * minSize,
+                  ("127.0.0.1", 30001))
+    if len(s2.fragments) != s2.FragmentMaxPendingPerPeer + 1 or \
+            sorted(k[1] for k in s2.fragments if k[0][1] == 30000) != list(range(5, s2.FragmentMaxPendingPerPeer + 5)):
+        log("fragments test 8 failed", "ERROR")
+    if s2.fragmentsBytes != (s2.FragmentMaxPendingPerPeer + 1) * (minSize + s2.FragmentOverhead):
+        log("fragments test 9 failed", "ERROR")
+
+    # memory used by all msgs waiting for fragments, counting overhead, is kept under FragmentMaxPendingBytes
+    # by discarding the oldest msgs.
+    s2.FragmentMaxPendingBytes = 10 * (minSize + s2.FragmentOverhead)
+    for port in range(30002, 30006):
+        for index in range(3):
+            s2.reassemble(header.pack(nbipc.CompactCodec.CompactMarker, s2.FragmentCode, 0, index, 4) + b'x' * minSize,
+                          ("127.0.0.1", port))
+    if s2.fragmentsBytes > s2.FragmentMaxPendingBytes or len(s2.fragments[(("127.0.0.1", 30005), 0)][2]) != 3 or \
+            s2.fragmentsBytes != sum(p[4] for p in s2.fragments.values()):
+        log("fragments test 10 failed", "ERROR")
+
+    # msgs that time out are discarded by expireFragments() without any new fragments arriving.
+    for key in s2.fragments:
+        s2.fragments[key][3] -= s2.FragmentTimeout + 1
+    s2.expireFragments()
+    if s2.fragments or s2.fragmentsBytes != 0:
+        log("fragments test 11 failed", "ERROR")
+
+    s1.s.close()
+    s2.s.close()
+
+
+def testSharedMemory():
+    # msgs of many sizes go through a ring in order, wrapping around its end.
+    ring = nbshm.ShmRing(bytearray(nbshm.ShmRing.bytesNeeded(100)), 0, 100)
+    for i in range(200):
+        msg = bytes([i % 256]) * (i % 40)
+        if not ring.put(msg) or ring.get() != msg or ring.get() is not None:
+            log("shared memory test 1 failed", "ERROR")
+            break
+    ring = nbshm.ShmRing(bytearray(nbshm.ShmRing.bytesNeeded(100)), 0, 100)
+    if ring.put(b'x' * 60) is not True or ring.put(b'x' * 60) is not False:
+        log("shared memory test 2 failed", "ERROR")
+
+    # positions and lengths written by the other end are checked before they are used.
+    for w, length in ((200, 10), (10, 90), (10, 1000000), (10, 8)):
+        buf = bytearray(nbshm.ShmRing.bytesNeeded(100))
+        ring = nbshm.ShmRing(buf, 0, 100)
+        nbshm.ShmRing.Header.pack_into(buf, 0, w, 0, 0)
+        nbshm.ShmRing.Length.pack_into(buf, nbshm.ShmRing.HeaderSize, length)
+        try:
+            ring.get()
+            log("shared memory test 7 failed", "ERROR")
+        except nbshm.ShmProtocolError:
+            pass
+
+    if not nbshm.available:
+        return
+
+    srv = nbipc.NetBotSocket("127.0.0.1", 0)
+    bot = nbipc.NetBotSocket("127.0.0.1", 0)
+    srvPort = srv.s.getsockname()[1]
+    botPort = bot.s.getsockname()[1]
+    doorbell = srv.startSharedMemory()
+
+    # joinReply goes by UDP and tells the bot to attach to the channel.
+    info = srv.openSharedMemory(("127.0.0.1", botPort))
+    srv.sendMessage({'type': 'joinReply', 'conf': nbsrv.SrvData().conf, 'shm': info}, "127.0.0.1", botPort)
+    bot.settimeout(1)
+    msg, ip, port = bot.recvMessage()
+    if msg['type'] != 'joinReply' or ("127.0.0.1", srvPort) not in bot.shmChannels:
+        log("shared memory test 3 failed", "ERROR")
+
+    # after that msgs go both ways in shared memory and ring the doorbell of a waiting server.
+    bot.sendMessage({'type': 'getInfoRequest', 'msgID': 1}, "127.0.0.1", srvPort)
+    ready = select.select([doorbell], [], [], 1)[0]
+    msgs = srv.recvMessages()
+    if not ready or msgs != [({'type': 'getInfoRequest', 'msgID': 1}, "127.0.0.1", botPort)]:
+        log("shared memory test 4 failed", "ERROR")
+    srv.sendMessage({'type': 'getInfoReply', 'gameNumber': 1, 'gameStep': 1, 'health': 100, 'points': 0, 'msgID': 1},
+                    "127.0.0.1", botPort)
+    if bot.recvMessage()[0]['type'] != 'getInfoReply' or srv.peers[("127.0.0.1", botPort)].shm is None:
+        log("shared memory test 5 failed", "ERROR")
+
+    # closing the server end removes the shared memory.
+    bot.closeSharedMemory(("127.0.0.1", srvPort))
+    srv.closeSharedMemory(("127.0.0.1", botPort))
+    if os.path.exists(info['botFifo']) or srv.shmChannels:
+        log("shared memory test 6 failed", "ERROR")
+
+    # a robot that writes a bad msg length loses its channel and goes back to UDP.
+    info = srv.openSharedMemory(("127.0.0.1", botPort))
+    bot.attachSharedMemory(("127.0.0.1", srvPort), info)
+    ring = bot.shmChannels[("127.0.0.1", srvPort)].sendRing
+    ring.put(b'x' * 10)
+    ring.Length.pack_into(ring.buf, ring.data, 0xFFFFFF)
+    if srv.recvMessages() or srv.shmChannels or srv.peers[("127.0.0.1", botPort)].shm is not None:
+        log("shared memory test 8 failed", "ERROR")
+    bot.closeSharedMemory(("127.0.0.1", srvPort))
+
+    doorbell.close()
+    srv.s.close()
+    bot.s.close()
+
+
+def testUnixSockets():
+    if not hasattr(nbipc.socket, 'AF_UNIX'):
+        return
+    sockDir = os.path.join(tempfile.mkdtemp(), "sockets")
+    srv = nbipc.NetBotSocket(sockDir, 20000)
+    bot = nbipc.NetBotSocket(sockDir, 0, sockDir, 20000)
+    if not os.path.exists(nbipc.unixPath(sockDir, 20000)) or bot.sourcePort == 0 or not bot.unix:
+        log("unix sockets test 1 failed", "ERROR")
+
+    # msgs are from (directory, port) and sent back to it like UDP ip and port.
+    bot.sendMessage({'type': 'getInfoRequest', 'msgID': 1})
+    msgs = srv.recvMessages()
+    if msgs != [({'type': 'getInfoRequest', 'msgID': 1}, sockDir, bot.sourcePort)] or \
+            srv.peerName(sockDir, bot.sourcePort) != sockDir + ":" + str(bot.sourcePort):
+        log("unix sockets test 2 failed", "ERROR")
+    srv.sendMessage({'type': 'Error', 'result': "test", 'msgID': 1}, sockDir, bot.sourcePort)
+    if bot.recvMessage() != ({'type': 'Error', 'result': "test", 'msgID': 1}, sockDir, 20000):
+        log("unix sockets test 3 failed", "ERROR")
+
+    # sending to a socket that is not there drops the msg like UDP.
+    srv.sendMessage({'type': 'Error', 'result': "test", 'msgID': 1}, sockDir, 20099)
+
+    # socket files left behind by a process that quit are replaced.
+    srv.s.close()
+    srv = nbipc.NetBotSocket(sockDir, 20000)
+
+    srv.s.close()
+    bot.s.close()
+
+
+def testNetEm():
+    # each bot's losses only depend on the seed and its own msgs.
+    em1 = nbnetem.NetEm(loss=30, seed=1)
+    em2 = nbnetem.NetEm(loss=30, seed=1)
+    lost1 = [em1.lose("a") for i in range(2000)]
+    lost2 = []
+    for i in range(2000):
+        em2.lose("b")
+        lost2.append(em2.lose("a"))
+    if lost1 != lost2 or not 500 < sum(lost1) < 700:
+        log("netem test 1 failed", "ERROR")
+
+    # bursts lose runs of msgs, on average 1 / end% long.
+    em = nbnetem.NetEm(burst=(5, 25), seed=2)
+    lost = [em.lose("a") for i in range(20000)]
+    runs = sum(1 for i in range(1, len(lost)) if lost[i] and not lost[i - 1])
+    if not 2500 < sum(lost) < 4200 or not 3 < sum(lost) / runs < 5:
+        log("netem test 2 failed", "ERROR")
+
+    # msgs are delivered in order of latency + jitter.
+    em = nbnetem.NetEm(latency=0.1, jitter=0.05, seed=3)
+    out = []
+    for i in range(100):
+        em.schedule("a", 0, 0, out.append, i)
+    if em.service(0.099) != 0 or em.service(0.2) != 100 or sorted(out) != list(range(100)) or em.nextDue():
+        log("netem test 3 failed", "ERROR")
+
+    # bandwidth spaces out msgs on a link and drops them once MaxQueueSecs are waiting.
+    em = nbnetem.NetEm(bandwidth=1000)
+    out = []
+    for i in range(3):
+        em.schedule("a", 500, 0, out.append, i)
+    em.schedule("b", 500, 0, out.append, "b")
+    em.service(0.6)
+    if out != [0, "b"] or em.schedule("a", 500, 0, out.append, 3) or em.queueDrops != 1:
+        log("netem test 4 failed", "ERROR")
+
+    # server counts msgs lost by network emulation as dropped instead of using dropRate.
+    d = nbsrv.SrvData()
+    d.netem = nbnetem.NetEm(loss=100)
+    if not nbsrv.dropMessage(d, "127.0.0.1:20010") or d.state['dropCount'] != 1:
+        log("netem test 5 failed", "ERROR")
+
+
+def testRateLimit():
+    s1 = nbipc.NetBotSocket("127.0.0.1", 0)
+    s2 = nbipc.NetBotSocket("127.0.0.1", 0)
+    s2.setRateLimit(0.001, 3)
+
+    # only burst msgs are read from a flood. The rest are skipped without being decoded.
+    for i in range(5):
+        s1.sendMessage({'type': 'getInfoRequest', 'msgID': i}, "127.0.0.1", s2.sourcePort)
+    for i in range(5):
+        s1.sendMessage(b'\x01\x02', "127.0.0.1", s2.sourcePort, packedAndChecked=True)
+    recvd = []
+    for i in range(100):
+        recvd.extend(m['msgID'] for m, ip, port in s2.recvMessages())
+        peer = s2.peers.get(("127.0.0.1", s1.sourcePort))
+        if peer and peer.recv + peer.throttled >= 10:
+            break
+        time.sleep(0.01)
+    if recvd != [0, 1, 2] or peer.recv != 3 or peer.throttled != 7:
+        log("rate limit test 1 failed: " + str(recvd), "ERROR")
+
+    # the server replies to msgs round-robin by sender, keeping each sender's msgs in order.
+    msgQ = [("a1", "a", 1), ("a2", "a", 1), ("b1", "b", 1), ("a3", "a", 1), ("c1", "c", 1), ("b2", "b", 1)]
+    if [m for m, ip, port in nbsrv.fairOrder(msgQ)] != ["a1", "b1", "c1", "a2", "b2", "a3"]:
+        log("rate limit test 2 failed", "ERROR")
+    msgQ = [("a1", "a", 1), ("b1", "b", 1)]
+    if nbsrv.fairOrder(msgQ) is not msgQ:
+        log("rate limit test 3 failed", "ERROR")
+
+    s1.s.close()
+    s2.s.close()
+
+
 def main():
     testHitSeverity()
+    testEntities()
+    testClassValues()
+    testNumpyEngine()
+    testBotGrid()
+    testCollisionSolver()
+    testSrvDataInstances()
+    testArenas()
+    testMissedSteps()
+    testHeldMsgs()
+    testLockStep()
+    testScanCache()
+    testMsgValidation()
+    testLog()
+    testCompactCodec()
+    testPack()
+    testBatch()
+    testSubscribe()
+    testReplyCache()
+    testPeers()
+    testRecvMessages()
+    testRecvThread()
+    testFragments()
+    testSharedMemory()
+    testUnixSockets()
+    testNetEm()
+    testRateLimit()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file